@@ -1,1010 +1,1584 @@
-"""
-    app.py is the main app document for the web app. It contains
-    all of the routes and handles all requests between the server and client.
-
-    :author: Andrew Bruce
-    :year: 2018
-"""
-
-# all imports for the app to work
-from flask import (Flask, g, render_template, flash, redirect, url_for, abort, request, session, send_file)
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from flask_bcrypt import check_password_hash
-from flask_mail import Mail, Message
-import os
-
-import stripe
-import forms
-import models
-
-stripe_pub_key = ''
-stripe_secret_key = ''
-stripe.api_key = stripe_secret_key
-
-# creates instance of the flask class and if the script is run directly
-# it gets the name "__main__"
-app = Flask(__name__)
-
-# Flask needs a secret key to create session objects, this one is randomly generated
-# and is used to cryptographically sign user cookies to prevent them being modified
-app.secret_key = ""
-
-# constant to store the file path for the product images
-UPLOAD_FOLDER = 'static\\img\\product_img'
-
-# tells the app that the constant is the upload folder
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-app.config['RECAPTCHA_PUBLIC_KEY'] = ''
-app.config['RECAPTCHA_PRIVATE_KEY'] = ''
-
-# dictionary containing the SMTP settings for outgoing mail
-app.config.update(dict(
-    MAIL_SERVER='',
-    MAIL_PORT=587,
-    MAIL_USE_TLS=True,
-    MAIL_USERNAME='',
-    MAIL_PASSWORD=''
-))
-
-# associates the mail module with the app
-mail = Mail(app)
-
-
-def send_email(subject, reply_to, recipient, body, html):
-    """
-     **Function for sending emails.**
-
-     Takes the parameters mentioned below and uses them to send an
-     email using the outgoing SMTP settings I have declared in the app.
-
-    :param subject: email subject
-    :param reply_to: reply address
-    :param recipient: email recipient
-    :param body: email body
-    :param html: html file to style body
-    :return: sends an email with the html file
-    """
-    msg = Message(
-        subject,
-        sender='',
-        reply_to=reply_to,
-        recipients=[recipient])
-    msg.body = body
-    msg.html = html
-    try:
-        mail.send(msg)
-    except ConnectionRefusedError as e:
-        flash(e, "error")
-
-
-# creates an instance of the LoginManager class and passes
-# in the Flask object from above
-login_manager = LoginManager(app)
-
-# the login view is where the app will redirect non_authenticated users
-# if @login_required is set
-login_manager.login_view = 'login'
-
-
-@login_manager.user_loader
-def load_user(userid):
-    """
-    **Loads the user between sessions.**
-
-    Takes in the user id stored in the cookies and uses it to pull
-    the user from the database.
-
-    :param userid: users primary key id
-    :return: the user object
-    """
-
-    try:
-        return models.User.get(models.User.id == userid)
-    except models.DoesNotExist:
-        return None
-
-
-@app.before_request
-def before_request():
-    """
-    **Handles all actions before request.**
-
-    This is a built in Flask function that fires before each server request.
-    I use this to do a number of things -
-
-    1. Establishes a connection to the database.
-    2. Assigns the current user to a global variable
-    3. Finds the current users open order and assigns to a global variable
-    4. Find the current users basket amount and assigns to a global variable
-    5. Checks the status of all orders under the current user for tracking.
-    """
-
-    g.db = models.db
-    g.db.connect()
-    g.user = current_user
-
-    g.current_order = models.Order.find_current_order(current_user)
-    g.current_basket = models.Order.get_current_basket(g.current_order, current_user)
-    try:
-        g.default_address = models.AddressDetails.get_default_address(current_user.id)
-    except AttributeError:
-        g.default_address = None
-
-    try:
-        models.Order.check_order_status(current_user.id)
-    except AttributeError:
-        pass
-
-
-@app.after_request
-def after_request(response):
-    """
-    **Handles all actions after server request.**
-
-    This is a built in Flask function that fires after each server request.
-    I use it to close the database connection, then it returns the response from the browser.
-
-    :param response: browser response
-    :return: any response from the browser
-    """
-    g.db.close()
-    return response
-
-
-# app.route is the path after the domain in the URL
-# methods is if data will be POST, GOT, or both
-@app.route('/login', methods=('GET', 'POST'))
-def login():
-    """
-    **Login route.**
-
-    Handles POST data from the login form then validates credentials against hashed credentials
-    in database. If login is correct then it calls Flasks :func:`~login_user` method which creates an authentication cookie.
-    If not it gives an error.
-
-    :return: A html template containing the login form
-    """
-
-    # instance of LoginForm in forms.py
-    form = forms.LoginForm()
-    # if the form is submitted without errors
-    if form.validate_on_submit():
-        try:
-            # query the db to find a user email address equal to the one given
-            user = models.User.get(models.User.email_address == form.email_address.data)
-        except models.DoesNotExist:
-            # errors if not found
-            flash("Email or password incorrect", "error")
-        else:
-            # check password hash is a method from the bcrypt library imported
-            # it compares the password given to the encrypted password in the db
-            # and returns true or false
-            if check_password_hash(user.password, form.password.data):
-                login_user(user)
-                flash("Log in successful", "success")
-                return redirect(url_for('index'))
-            else:
-                # flash messaging appears at the top of the screen
-                # the category given second is used to style the message
-                flash("Email or password incorrect", "error")
-    # render_template returns one of the page templates
-    return render_template('login.html', form=form)
-
-
-@app.route('/register', methods=('GET', 'POST'))
-def register():
-    """
-    **Registration route.**
-
-    Takes POST data from html form and calls :func:`~models.User.create_user`
-    which creates a user in the database, with the default user role of "customer". It then calls Flasks :func:`~login_user` method
-    and redirects the user home.
-
-    :return: html template containing registration form
-    """
-
-    form = forms.RegisterForm()
-    if form.validate_on_submit():
-        # method from the User model that creates user in db
-        models.User.create_user(
-            first_name=form.first_name.data.title(),
-            last_name=form.last_name.data.title(),
-            email_address=form.email.data,
-            password=form.password.data,
-            user_role="customer"
-        )
-        flash("Account Created", "success")
-        user = models.User.get(models.User.email_address == form.email.data)
-        login_user(user)
-        return redirect(url_for('index'))
-    return render_template('register.html', form=form)
-
-
-@app.route('/logout')
-@login_required
-def logout():
-    """
-    **Logout route.**
-
-    *This route requires authentication*
-
-    Calls Flasks :func:`~flask.logout_user` method which removes authentication cookies.
-    Then redirects user to the login page.
-    :return: a redirect for the login page
-    """
-
-    logout_user()
-    flash("Logged out", "success")
-    return redirect(url_for('login'))
-
-
-@app.route('/create_user', methods=('GET', 'POST'))
-# redirects to login if the user isn't authenticated
-@login_required
-def create_user():
-    """
-    **Create user route.**
-
-    *Route can only be accessed if user role is "admin"*
-
-    Takes in POST data from html form and calls :func:`~models.User.create_user`.
-    Unlike the :func:`~register` route it takes in a user role and assigns it to the created user.
-
-    :return: html template with create user form
-    """
-
-    form = forms.CreateUser()
-    # if the user isn't an admin
-    if current_user.user_role != "admin":
-        # return a 404 error
-        abort(404)
-    else:
-        if form.validate_on_submit():
-            if form.user_role.data == "blank":
-                flash("Must select user role", "error")
-            else:
-                models.User.create_user(
-                    first_name=form.first_name.data.title(),
-                    last_name=form.last_name.data.title(),
-                    email_address=form.email.data,
-                    password=form.password.data,
-                    user_role=form.user_role.data
-                )
-                flash("User created", "success")
-                return redirect(url_for('create_user'))
-        return render_template('create_user.html', form=form, current_basket=g.current_basket)
-
-
-@app.route('/account/<int:user_id>')
-# redirects user to login page if they're not logged in
-@login_required
-def account(user_id):
-    """
-    **Account route**
-
-    *This route requires authentication*
-
-    Takes in a user id and returns that users account page.
-
-    :param user_id: current users id (primary key)
-    :return: html template for account page
-    """
-    if current_user.id != user_id:
-        # tests if a user is trying to access another accounts details
-        # if they are it returns a 404 error
-        abort(404)
-    else:
-        # renders the template
-        return render_template('account.html', current_basket=g.current_basket)
-
-
-@app.route('/orders/<int:user_id>')
-@login_required
-def orders(user_id):
-    """
-    **Orders route**
-
-    *This route requires authentication*
-
-    Pulls the current users placed, dispatched, complete, and canelled orders
-    and assigns them to variables. It then returns a html template and passes
-    the lists of orders in.
-
-    :param user_id: current users id (primary key)
-    :return: html template displaying passed in user orders
-    """
-    # checks the user is accessing their own orders page
-    if current_user.id != user_id:
-        abort(404)
-    else:
-
-        # gets all placed and dispatched orders belonging to the current user
-        # orders them by order_placed_on and assigns to current_orders
-        current_orders = models.Order.select()\
-            .where((models.Order.order_status == "placed") |
-                   (models.Order.order_status == "dispatched"), models.Order.user == current_user.id)\
-            .order_by(models.Order.order_placed_on.desc())
-
-        # gets all complete orders belonging to the current user
-        # orders them by order_placed_on and assigns to complete_orders
-        complete_orders = models.Order.select()\
-            .where(models.Order.order_status == "complete", models.Order.user == current_user.id) \
-            .order_by(models.Order.order_placed_on.desc())
-
-        # gets all cancelled orders belonging to the current user
-        # orders them by order_placed_on and assigns to cancelled_orders
-        cancelled_orders = models.Order.select()\
-            .where(models.Order.order_status == "cancelled", models.Order.user == current_user.id) \
-            .order_by(models.Order.order_placed_on.desc())
-
-        # checks current order status
-        models.Order.check_order_status(current_user.id)
-        return render_template('orders.html', current_basket=g.current_basket,
-                               current_orders=current_orders, complete_orders=complete_orders,
-                               cancelled_orders=cancelled_orders)
-
-
-@app.route('/cancel_order/<int:order_id>')
-@login_required
-def cancel_order(order_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    elif order.order_status != "placed":
-        flash("Order has been dispatched and can not be cancelled")
-        return redirect(url_for('orders', user_id=current_user.id))
-    else:
-        models.Order.cancel_order(order_id)
-        flash("Order cancelled", "success")
-        return redirect(url_for('orders', user_id=current_user.id))
-
-
-@app.route('/continue_order/<int:order_id>')
-@login_required
-def continue_order(order_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    models.Order.place_order(order_id)
-    flash("Re-Placed Order")
-    return redirect(url_for('orders', user_id=current_user.id))
-
-
-@app.route('/view_order_details/<int:order_id>')
-@login_required
-def view_order_details(order_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    address = models.AddressDetails.get(models.AddressDetails.id == order.address)
-    if order.user_id != current_user.id:
-        abort(404)
-    else:
-        return render_template("view_order_details.html", current_basket=g.current_basket,
-                               order=order, address=address)
-
-
-@app.route('/view_order_details/change_address/<int:user_id>/<int:order_id>')
-@login_required
-def change_order_address(user_id, order_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    if order.order_status != "placed":
-        flash("Order has been dispatched and can no longer be changed", "error")
-        return redirect(url_for('view_order_details', order_id=order_id))
-    address_list = models.AddressDetails \
-        .select() \
-        .where(models.AddressDetails.user_id == current_user.id) \
-        .order_by(models.AddressDetails.default.desc())
-    return render_template("change_order_address.html", current_basket=g.current_basket,
-                           address_list=address_list, order=order)
-
-
-@app.route('/view_order_details/change_address/add_address/<int:order_id>', methods=('POST', 'GET'))
-@login_required
-def change_order_add_address(order_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    form = forms.AddAddress()
-    if form.validate_on_submit():
-        models.AddressDetails.add_address(
-            user_id=current_user.id,
-            address_line_1=form.address_line_1.data,
-            address_line_2=form.address_line_2.data,
-            town=form.town.data,
-            city=form.city.data,
-            postcode=form.postcode.data
-        )
-        address = models.AddressDetails.select().order_by(models.AddressDetails.id.desc()).get()
-        models.Order.add_address_to_order(order_id, address.id)
-        return redirect(url_for('view_order_details', order_id=order_id))
-    return render_template('add_address.html', form=form, current_basket=g.current_basket)
-
-
-@app.route('/set_order_address/<int:order_id>/<int:address_id>')
-@login_required
-def set_order_address(order_id, address_id):
-    order = models.Order.get(models.Order.id == order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    models.Order.add_address_to_order(order_id, address_id)
-    return redirect(url_for('view_order_details', order_id=order_id))
-
-
-@app.route('/remove_from_order/<int:line_id>/<int:quantity>')
-@login_required
-def remove_from_order(line_id, quantity):
-    line = models.OrderLine.get(models.OrderLine.id == line_id)
-    product = models.Product.get(models.Product.id == line.product_id)
-    order = models.Order.get(models.Order.id == line.order_id)
-    lines = models.OrderLine.select().where(models.OrderLine.order == order.id)
-    if order.user_id != current_user.id:
-        abort(404)
-    else:
-        if product.product_category == "tshirt":
-            models.Product.increase_tshirt_stock(product.id, quantity, line.size)
-        else:
-            models.Product.increase_other_stock(product.id, quantity)
-        if len(list(lines)) == 1:
-            return redirect(url_for('cancel_order', order_id=order.id))
-        models.OrderLine.remove_order_line(line_id)
-        models.Order.update_order_total(order.id)
-        flash("Item removed", "success")
-        return redirect(url_for('view_order_details', order_id=order.id))
-
-
-@app.route('/addresses/<int:user_id>')
-# redirects user to login page if they're not logged in
-@login_required
-def addresses(user_id):
-    """This route returns the addresses for the user that requests it.
-
-    This route takes the user ID as a parameter as it needs it for the url
-    """
-    if current_user.id != user_id:
-        # tests if a user is trying to access another accounts details
-        # if they are it returns a 404 error
-        abort(404)
-    else:
-        # pulls all addresses of the current user out of the database and assigns them to address_list
-        # It orders them by the default attribute so the default address always appears first
-        address_list = models.AddressDetails\
-            .select()\
-            .where(models.AddressDetails.user_id == current_user.id)\
-            .order_by(models.AddressDetails.default.desc())
-        return render_template('addresses.html', current_basket=g.current_basket, address_list=address_list)
-
-
-@app.route('/add_address', methods=('POST', 'GET'))
-# redirects user to login page if they're not logged in
-@login_required
-def add_address():
-    """This route returns a template to allow a user to add a new address"""
-    # assigns the add address form to the form variable
-    form = forms.AddAddress()
-    # if the form is posted and valid
-    if form.validate_on_submit():
-        # add address to the database
-        models.AddressDetails.add_address(
-            user_id=current_user.id,
-            address_line_1=form.address_line_1.data,
-            address_line_2=form.address_line_2.data,
-            town=form.town.data,
-            city=form.city.data,
-            postcode=form.postcode.data
-        )
-        # gets the last added address out of the database, which will be the one created above
-        address = models.AddressDetails.select().order_by(models.AddressDetails.id.desc()).get()
-        # uses my change_default_address method to make the new address default
-        models.AddressDetails.change_default(address.id, current_user.id)
-        # if there is an open order assigned to this users account
-        if g.current_order is not None:
-            # uses my add_address_to_order to add the new default address to the order
-            models.Order.add_address_to_order(g.current_order.id, address.id)
-        flash("Address added", "success")
-        # checks for a session variable created if the user was redirected here during the checkout process
-        if session.get('checking out'):
-            # deletes the session variable
-            session.pop('checking out', None)
-            # return the user to the checkout
-            return redirect(url_for('checkout'))
-        else:
-            # otherwise it just returns them to the addresses page
-            return redirect(url_for('addresses', user_id=current_user.id))
-        # renders the add address template
-    return render_template('add_address.html', form=form, current_basket=g.current_basket)
-
-
-@app.route('/set_address_default/<int:address_id>')
-# redirects user to login page if they're not logged in
-@login_required
-def set_address_default(address_id):
-    """This route is used to change the default address
-
-    It is fired when the Set Default link is clicked on the address.
-    It takes the new address Id in as a parameter
-    """
-    # uses my change_default method under AddressDetails to change the default to the one passed in
-    models.AddressDetails.change_default(address_id, current_user.id)
-    # success message
-    flash("New default set", "success")
-
-    # redirects user back to addresses
-    return redirect(url_for('addresses', user_id=current_user.id))
-
-
-@app.route('/edit_address/<int:address_id>/<int:user_id>', methods=('POST', 'GET'))
-# redirects user to login page if they're not logged in
-@login_required
-def edit_address(address_id, user_id):
-    """This route returns a template to allow a user to edit an address"""
-    form = forms.AddAddress()
-    # gets address from db and assigns it to address
-    address = models.AddressDetails.get(models.AddressDetails.id == address_id)
-    # creates empty list called address_items
-    address_items = []
-    # if the address bering edited does not belong to the current user
-    if user_id != current_user.id:
-        # give a 404 error
-        abort(404)
-    else:
-        # if the form is submitted and is valid
-        if form.validate_on_submit():
-            # call my edit_address method and pass in the form details
-            models.AddressDetails.edit_address(
-                address_id=address_id,
-                address_line_1=form.address_line_1.data,
-                address_line_2=form.address_line_2.data,
-                town=form.town.data,
-                city=form.city.data,
-                postcode=form.postcode.data
-            )
-            # success message
-            flash("Address updated", "success")
-            # redirect user to addresses
-            return redirect(url_for('addresses', user_id=current_user.id))
-
-        # when it gets the address it returns it as a dictionary, which has key (column name) and value(the data)
-        # this loops through the dictionary assigning the key to key, and the value to value
-        for key, value in address.__data__.items():
-            # if the key isn't id, user_id, and default (we don't need these)
-            if key != 'id' and key != 'user_id' and key != 'default':
-                # add the value (cell data) to the address_items list
-                address_items.append(value)
-    # render the template passing in the address_items so they can pre-populate the form
-    return render_template('edit_address.html', address_items=address_items, form=form, current_basket=g.current_basket)
-
-
-@app.route('/delete_address/<int:address_id>/<int:user_id>')
-# redirects user to login page if they're not logged in
-@login_required
-def delete_address(address_id, user_id):
-    """This route removes an address
-
-    An address id is passed in from the link, it then calls methods
-    in the model to remove the address
-    """
-    # if the address doesn't belong to the current user
-    if user_id != current_user.id:
-        # give 404 error
-        abort(404)
-    else:
-        # calls delete_address method and passes in the address id
-        models.AddressDetails.delete_address(address_id)
-        # gets the most recently added address
-        new_default = models.AddressDetails.select()\
-            .order_by(models.AddressDetails.id.desc())\
-            .get()
-        # uses the change_default method to set that to default
-        models.AddressDetails.change_default(new_default, current_user.id)
-        # success message
-        flash("Address Removed", "success")
-        # redirects the user to addresses
-        return redirect(url_for('addresses', user_id=current_user.id))
-
-
-@app.route('/login_details/<int:user_id>')
-@login_required
-def login_details(user_id):
-    if user_id != current_user.id:
-        abort(404)
-    else:
-        return render_template("login_details.html", current_basket=g.current_basket, user=current_user)
-
-
-@app.route('/edit_login_details/<int:user_id>', methods=('GET', 'POST'))
-def edit_login_details(user_id):
-    if user_id != current_user.id:
-        abort(404)
-    else:
-        form = forms.EditLoginDetails()
-        if form.validate_on_submit():
-            try:
-                models.User.edit_details(
-                    user_id=current_user.id,
-                    first_name=form.first_name.data,
-                    last_name=form.last_name.data,
-                    email_address=form.email_address.data
-                )
-                return redirect(url_for('login_details', user_id=current_user.id))
-            except ValueError as e:
-                e = str(e)
-                flash(e, "error")
-        detail_list = []
-        for key, value in current_user.__data__.items():
-            if key == "first_name" or key == "last_name" or key == "email_address":
-                detail_list.append(value)
-        return render_template("edit_login_details.html",
-                               current_basket=g.current_basket, detail_list=detail_list, form=form)
-
-
-@app.route('/reset_password/<int:user_id>', methods=('GET', 'POST'))
-def reset_password(user_id):
-    if user_id != current_user.id:
-        abort(404)
-    else:
-        form = forms.ResetPassword()
-        if form.validate_on_submit():
-            if not check_password_hash(current_user.password, form.current_password.data):
-                flash("Current Password Incorrect", "error")
-            else:
-                models.User.reset_password(current_user.id, form.new_password.data)
-                flash("Password Reset", "success")
-                return redirect(url_for('login_details', user_id=current_user.id))
-        return render_template("reset_password.html", current_basket=g.current_basket, form=form)
-
-
-@app.route('/create_product', methods=('GET', 'POST'))
-@login_required
-def create_product():
-    """Route that returns the page for administrators to create products.
-
-    On this route it takes input from the create product form and
-    uses a method inside the Product class to create a product
-    in the database.
-    """
-
-    form = forms.CreateProduct()
-
-    # if the user is a customer, give them a 404 page
-    if current_user.user_role == "customer":
-        abort(404)
-    else:
-        # if the form is validated
-        if form.validate_on_submit():
-            models.Product.create(
-                product_category=form.product_category.data,
-                product_name=form.product_name.data,
-                product_price=form.product_price.data,
-                product_description=form.product_description.data,
-                one_size_stock=form.one_size_stock.data,
-                small_stock=form.small_stock.data,
-                medium_stock=form.medium_stock.data,
-                large_stock=form.large_stock.data
-            )
-            new_product = models.Product.select().order_by(models.Product.id.desc()).get()
-            file = request.files['image']
-            name = request.files['image'].filename
-            parts = name.split('.')
-            ext = parts[1]
-            file_name = str(new_product.id) + "." + ext
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
-            file.save(file_path)
-            models.Product.add_image(new_product.id, file_path)
-            flash("Product added", "success")
-            return redirect(url_for('create_product'))
-        # returns the create_product template
-        return render_template('create_product.html', form=form, current_basket=g.current_basket)
-
-
-@app.route('/products', methods=('POST', 'GET'))
-def products():
-    sorting_form = forms.OrderProducts()
-    product_list = models.Product.select().order_by(models.Product.product_name)
-    if sorting_form.validate_on_submit():
-        sort_by = sorting_form.order_by.data
-        if sort_by == "price_lth":
-            product_list = models.Product.select().order_by(models.Product.product_price)
-        elif sort_by == "price_htl":
-            product_list = models.Product.select().order_by(models.Product.product_price.desc())
-        elif sort_by == 'alphabet':
-            product_list = models.Product.select().order_by(models.Product.product_name)
-        elif sort_by == 'tshirt':
-            product_list = models.Product.select().where(models.Product.product_category == "tshirt")
-        elif sort_by == 'hat':
-            product_list = models.Product.select().where(models.Product.product_category == "hat")
-        elif sort_by == 'cd':
-            product_list = models.Product.select().where(models.Product.product_category == "cd")
-    return render_template('products.html', products=product_list,
-                           current_basket=g.current_basket, sorting_form=sorting_form)
-
-
-@app.route('/remove_product/<int:product_id>')
-@login_required
-def remove_product(product_id):
-    if current_user.user_role == "customer":
-        abort(404)
-    else:
-        product_list = models.Product.select()
-        product = models.Product.get(models.Product.id == product_id)
-        product.delete_instance()
-        flash("Product deleted", "success")
-        return redirect(url_for('products', products=product_list, current_basket=g.current_basket))
-
-
-@app.route('/add_to_order/<int:product_id>/<product_category>', methods=('POST', 'GET'))
-@login_required
-def add_to_order(product_id, product_category):
-    if request.method == 'POST':
-        quantity = int(request.form.get('quantity'))
-        size = request.form.get('size')
-        if g.current_order is not None:
-            for line in g.current_order.order_lines:
-                if product_category == "tshirt":
-                    if product_id == line.product_id and size == line.size:
-                        if models.Product.tshirt__in_stock(quantity, product_id, size):
-                            models.OrderLine.increase_line_quantity(line.id, quantity)
-                            models.Product.reduce_tshirt_stock(product_id, quantity, size)
-                            flash("Added to basket", "success")
-                        else:
-                            flash("Please enter a quantity less than the stock", "error")
-                        break
-                else:
-                    if product_id == line.product_id:
-                        if models.Product.other_in_stock(quantity, product_id):
-                            models.OrderLine.increase_line_quantity(line.id, quantity)
-                            models.Product.reduce_other_stock(product_id, quantity)
-                            flash("Added to basket", "success")
-                        else:
-                            flash("Please enter a quantity less than the stock", "error")
-                        break
-            else:
-                if product_category == "tshirt":
-                    if models.Product.tshirt__in_stock(quantity, product_id, size):
-                        models.OrderLine.create_order_line(product_id, g.current_order.id, quantity, size=size)
-                        models.Product.reduce_tshirt_stock(product_id, quantity, size)
-                        flash("Added to basket", "success")
-                    else:
-                        flash("Please enter a quantity less than the stock", "error")
-                else:
-                    if models.Product.other_in_stock(quantity, product_id):
-                        models.OrderLine.create_order_line(product_id, g.current_order.id, quantity, size="one_size")
-                        models.Product.reduce_other_stock(product_id, quantity)
-                        flash("Added to basket", "success")
-                    else:
-                        flash("Please enter a quantity less than the stock", "error")
-            models.Order.update_order_total(g.current_order.id)
-        else:
-            if g.default_address is not None:
-                models.Order.create_order_with_address(current_user.id, g.default_address.id)
-            else:
-                models.Order.create_order(current_user.id)
-            g.current_order = models.Order.find_current_order(current_user)
-            if product_category == "tshirt":
-                if models.Product.tshirt__in_stock(quantity, product_id, size):
-                    models.OrderLine.create_order_line(product_id, g.current_order.id, quantity, size=size)
-                    models.Product.reduce_tshirt_stock(product_id, quantity, size)
-                    flash("Added to basket", "success")
-                else:
-                    flash("Please enter a quantity less than the stock", "error")
-            else:
-                if models.Product.other_in_stock(quantity, product_id):
-                    models.OrderLine.create_order_line(product_id, g.current_order.id, quantity, size="one_size")
-                    models.Product.reduce_other_stock(product_id, quantity)
-                    flash("Added to basket", "success")
-                else:
-                    flash("Please enter a quantity less than the stock", "error")
-            models.Order.update_order_total(g.current_order.id)
-    return redirect(url_for('products'))
-
-
-@app.route('/basket/<int:user_id>')
-@login_required
-def basket(user_id):
-    if current_user.id != user_id:
-        abort(404)
-    else:
-        return render_template('basket.html', current_basket=g.current_basket, current_order=g.current_order)
-
-
-@app.route('/remove_from_basket/<int:line_id>/<int:quantity>')
-@login_required
-def remove_from_basket(line_id, quantity):
-    line = models.OrderLine.get(models.OrderLine.id == line_id)
-    product = models.Product.get(models.Product.id == line.product_id)
-    order = models.Order.get(models.Order.id == line.order_id)
-    if order.user_id != current_user.id:
-        abort(404)
-    else:
-        if product.product_category == "tshirt":
-            models.Product.increase_tshirt_stock(product.id, quantity, line.size)
-        else:
-            models.Product.increase_other_stock(product.id, quantity)
-        models.OrderLine.remove_order_line(line_id)
-        models.Order.update_order_total(g.current_order.id)
-        flash("Item removed", "success")
-        return redirect(url_for('basket', user_id=current_user.id))
-
-
-@app.route('/edit_quantity/<int:line_id>', methods=('GET', 'POST'))
-@login_required
-def edit_quantity(line_id):
-    if request.method == "POST":
-        order_line = models.OrderLine.get(models.OrderLine.id == line_id)
-        new_quantity = int(request.form.get('quantity'))
-        old_quantity = order_line.quantity
-        product_id = order_line.product_id
-        size = order_line.size
-        if order_line.size == "one_size":
-            if old_quantity > new_quantity:
-                difference = old_quantity - new_quantity
-                models.Product.increase_other_stock(product_id, difference)
-            elif old_quantity < new_quantity:
-                difference = new_quantity - old_quantity
-                models.Product.reduce_other_stock(product_id, difference)
-            else:
-                flash("Quantity not changed", "error")
-        else:
-            if old_quantity > new_quantity:
-                difference = old_quantity - new_quantity
-                models.Product.increase_tshirt_stock(product_id, difference, size)
-            elif old_quantity < new_quantity:
-                difference = new_quantity - old_quantity
-                models.Product.reduce_tshirt_stock(product_id, difference, size)
-            else:
-                flash("Quantity not changed", "error")
-        models.OrderLine.edit_line_quantity(line_id, new_quantity)
-        models.Order.update_order_total(g.current_order.id)
-    return redirect(url_for('basket', user_id=current_user.id))
-
-
-@app.route('/change_shipping', methods=['POST'])
-@login_required
-def change_shipping():
-    shipping_id = int(request.form.get('shipping'))
-    models.Order.change_shipping(shipping_id, g.current_order.id)
-    return redirect(url_for('checkout'))
-
-
-@app.route('/checkout', methods=('GET', 'POST'))
-@login_required
-def checkout():
-    if g.current_order.order_lines.count() == 0:
-        flash("No items to checkout", "error")
-        return redirect(url_for('products'))
-    elif g.default_address is not None:
-        return render_template("checkout.html", current_basket=g.current_basket,
-                               current_order=g.current_order, default_address=g.default_address,
-                               stripe_pub_key=stripe_pub_key)
-    else:
-        flash("Please add delivery address", "error")
-        session["checking out"] = True
-        return redirect(url_for("add_address"))
-
-
-@app.route('/pay', methods=['GET', 'POST'])
-def pay():
-    order = models.Order.get(models.Order.id == g.current_order)
-    shipping_option = models.ShippingOption.get(models.ShippingOption.id == order.shipping_id)
-    total = order.order_total + shipping_option.cost
-    total = round(total * 100)
-    customer = stripe.Customer.create(
-        email=current_user.email_address,
-        source=request.form.get('stripeToken'),
-    )
-
-    charge = stripe.Charge.create(
-        customer=customer.id,
-        amount=total,
-        currency='gbp',
-        description='Native Sins'
-    )
-
-    send_email(
-        "Order Confirmation",
-        'contact@nativesins.com',
-        current_user.email_address,
-        render_template("order_confirmation.html"),
-        render_template("order_confirmation.html"))
-
-    models.Order.place_order(order.id)
-    flash("Order Complete", "success")
-    return redirect(url_for('index'))
-
-
-@app.route('/reports', methods=['POST', 'GET'])
-@login_required
-def reports():
-    form = forms.CreateReport()
-    file_name = None
-    if current_user.user_role == "customer":
-        abort(404)
-    if form.validate_on_submit():
-        start_date = form.start_date.data
-        end_date = form.end_date.data
-        test = form.report_type.data
-        if form.report_type.data == "user":
-            file_name = models.User.generate_user_report(start_date, end_date)
-        elif form.report_type.data == "order":
-            file_name = models.Order.generate_order_report(start_date, end_date)
-
-        if file_name is None:
-            flash("No data found between those dates", "error")
-        else:
-            file_path = 'static\\tmp_reports\\' + file_name
-            return send_file(file_path, attachment_filename='report.csv', as_attachment=True)
-    return render_template('reports.html', form=form, current_basket=g.current_basket)
-
-
-@app.route('/about')
-def about():
-    return render_template('about.html', current_basket=g.current_basket)
-
-
-@app.route('/contact', methods=('GET', 'POST'))
-def contact():
-    form = forms.Contact()
-    if form.validate_on_submit():
-        name = form.name.data
-        email = form.email.data
-        message = form.message.data
-        try:
-            send_email(
-                "Contact Form",
-                email,
-                'contact@nativesins.com',
-                render_template("contact_email.html", name=name, message=message),
-                render_template("contact_email.html", name=name, message=message))
-
-            flash('Email sent, we will reply as soon as possible', 'success')
-            return redirect(url_for('contact'))
-        except ConnectionRefusedError:
-            flash("connection Refused", "error")
-
-    return render_template('contact.html', current_basket=g.current_basket, form=form)
-
-
-@app.route('/')
-def index():
-    """Route that returns the index(home) page"""
-    return render_template('index.html', current_basket=g.current_basket, user=current_user)
-
-
-@app.errorhandler(404)
-def not_found(error):
-    """Route that returns a custom 404 page if the user encounters that error"""
-    return render_template('404.html', current_basket=g.current_basket, current_order=g.current_order)
-
-
-# if the app is being run directly, rather than imported
-if __name__ == '__main__':
-    # run the initialize method in models to create tables if they don't exist
-    models.initialize()
-
-    # creates base admin user
-    try:
-        models.User.create_user(
-            first_name="Admin",
-            last_name="User",
-            email_address="contact@nativesins.com",
-            password="password",
-            user_role="admin"
-        )
-
-        models.ShippingOption.create_shipping_option(
-            name="first_class",
-            cost=2
-        )
-
-        models.ShippingOption.create_shipping_option(
-            name="second_class",
-            cost=1
-        )
-
-    except ValueError:
-        pass
-
-    app.run(host='localhost', debug=True, port=5000)
+"""
+    app.py is the main app document for the web app. It contains
+    all of the routes and handles all requests between the server and client.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+# all imports for the app to work
+from flask import (Flask, g, render_template, flash, redirect, url_for, abort, request, session, send_file,
+                   jsonify)
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from flask_bcrypt import check_password_hash
+import datetime
+import hashlib
+import json
+import os
+
+import cache
+import payments
+import metrics
+import models
+import money
+import rate_limit
+import resilience
+import template_cache
+from lazy import lazy_import
+
+# the forms are only needed once a page with a form is requested, so the
+# module (and WTForms with it) is loaded then rather than at start up
+forms = lazy_import('forms')
+
+# creates instance of the flask class and if the script is run directly
+# it gets the name "__main__"
+app = Flask(__name__)
+
+# loads the default settings from config.py so the app works when imported,
+# create_app is used to swap them for others
+app.config.from_object('config.Config')
+
+# adds the {% cache %} tag used to keep rendered product cards and order lines
+# in memory, see template_cache.py
+app.jinja_env.add_extension(template_cache.FragmentCacheExtension)
+app.jinja_env.globals['catalog_version'] = lambda: cache.catalog.version
+app.jinja_env.globals['shipping_option'] = lambda shipping_id: cache.reference.shipping_option(shipping_id)
+# money is kept in pence, {{ amount|money }} shows it in pounds
+app.jinja_env.filters['money'] = money.format_pence
+
+# the mail extension and Stripe are created the first time they are used,
+# see get_mail and get_stripe
+mail = None
+
+
+def create_app(config='config.Config', **settings):
+    """
+    **Application factory.**
+
+    Loads the settings, points the models at the database and sets up the
+    caches, then pre-warms the app if the settings ask for it.
+    The app is created once per process, so preforking servers should call
+    this before forking the workers (see ``wsgi.py``).
+
+    :param config: settings class or import path of one in config.py
+    :param settings: individual settings that override the ones in config
+    :return: the Flask app
+    """
+    app.config.from_object(config)
+    app.config.update(settings)
+
+    models.configure_database(
+        app.config['DATABASE'],
+        pool_size=app.config['DATABASE_POOL_SIZE'],
+        pragmas=app.config['DATABASE_PRAGMAS']
+    )
+    models.reservation_time = datetime.timedelta(minutes=app.config['RESERVATION_MINUTES'])
+    models.low_stock_threshold = app.config['LOW_STOCK_THRESHOLD']
+    models.write_attempts = app.config['DATABASE_WRITE_ATTEMPTS']
+    models.write_retry_delay = app.config['DATABASE_RETRY_DELAY']
+    cache.configure(app.config)
+    rate_limit.configure(app.config)
+    resilience.configure(app.config)
+    template_cache.configure(
+        app.jinja_env,
+        app.config['FRAGMENT_CACHE_SIZE'],
+        app.config['TEMPLATE_CACHE_FOLDER']
+    )
+
+    if app.config['PREWARM']:
+        prewarm()
+    return app
+
+
+def prewarm():
+    """
+    **Loads everything the first request would otherwise have to.**
+
+    Compiles every template and loads the shipping options, the product names
+    and each sort of the product list into memory. When it is run before a preforking server
+    forks, the workers share these copy-on-write and the first request after
+    a deploy is as fast as the rest.
+    """
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+
+    models.db.connect()
+    try:
+        cache.reference.load()
+        cache.product_names.load()
+        for sort_by, label in forms.OrderProducts.order_by.kwargs['choices']:
+            cache.catalog.products(sort_by)
+    finally:
+        models.db.close()
+
+    # pooled connections must not be carried over into the forked workers
+    if hasattr(models.db, 'close_all'):
+        models.db.close_all()
+
+
+def get_mail():
+    """
+    **Returns the mail extension, creating it the first time.**
+
+    Flask-Mail is only imported when the first email is sent.
+
+    :return: the :class:`~flask_mail.Mail` instance
+    """
+    global mail
+    if mail is None:
+        from flask_mail import Mail
+        mail = Mail(app)
+    return mail
+
+
+def get_stripe():
+    """
+    **Returns the Stripe library, importing it the first time.**
+
+    :return: the stripe module with the secret key set
+    """
+    import stripe
+    stripe.api_key = app.config['STRIPE_SECRET_KEY']
+    if app.config['STRIPE_API_BASE']:
+        stripe.api_base = app.config['STRIPE_API_BASE']
+    if stripe.default_http_client is None:
+        # the library waits 80 seconds by default, it is given as long as its breaker allows
+        stripe.default_http_client = stripe.new_default_http_client(
+            timeout=app.config['SERVICES']['stripe']['timeout'])
+    # a declined card or a bad request means Stripe itself is working
+    resilience.breaker('stripe').ignored = (stripe.error.CardError, stripe.error.InvalidRequestError)
+    return stripe
+
+
+def send_email(subject, reply_to, recipient, body, html):
+    """
+     **Function for sending emails.**
+
+     Takes the parameters mentioned below and uses them to send an
+     email using the outgoing SMTP settings I have declared in the app.
+
+    :param subject: email subject
+    :param reply_to: reply address
+    :param recipient: email recipient
+    :param body: email body
+    :param html: html file to style body
+    :return: True if the email was sent, if it wasn't an error is flashed and False returned
+    """
+    from flask_mail import Message
+
+    # the message needs the extension to find the default sender
+    mail = get_mail()
+    msg = Message(
+        subject,
+        sender='',
+        reply_to=reply_to,
+        recipients=[recipient])
+    msg.body = body
+    msg.html = html
+
+    def deliver():
+        # runs on a thread of the SMTP breaker, which needs an app context of its own
+        with app.app_context():
+            mail.send(msg)
+
+    try:
+        resilience.call('smtp', deliver)
+    except (resilience.ServiceUnavailable, OSError):
+        flash("The email couldn't be sent, please try again later", "error")
+        return False
+    return True
+
+
+def session_basket_count():
+    """
+    **Counts the items in the basket kept in the session.**
+
+    :return: number of items, or None if the basket is empty
+    """
+    items = session.get('basket')
+    if not items:
+        return None
+    return sum(quantity for product_id, size, quantity in items)
+
+
+def add_to_session_basket(product_id, product_category, quantity, size):
+    """
+    **Adds an item to the basket of a visitor who isn't logged in.**
+
+    The basket is a list of ``[product id, size, quantity]`` in the signed session
+    cookie. Stock is checked but not reserved, nothing is written to the database
+    until :func:`~merge_session_basket` runs when they log in.
+
+    :param product_id: product id (primary key)
+    :param product_category: the products category
+    :param quantity: amount to add
+    :param size: the size chosen, ignored for products that aren't t-shirts
+    """
+    if product_category != "tshirt":
+        size = "one_size"
+    items = session.get('basket', [])
+    for item in items:
+        if item[0] == product_id and item[1] == size:
+            break
+    else:
+        item = [product_id, size, 0]
+        items.append(item)
+    if size == "one_size":
+        in_stock = models.Product.other_in_stock(item[2] + quantity, product_id)
+    else:
+        in_stock = models.Product.tshirt__in_stock(item[2] + quantity, product_id, size)
+    if in_stock:
+        item[2] += quantity
+        session['basket'] = items
+        flash("Added to basket", "success")
+    else:
+        flash("Please enter a quantity less than the stock", "error")
+
+
+def merge_session_basket(user):
+    """
+    **Moves the session basket into the users open order once they log in.**
+
+    :param user: the user that just logged in
+    :return: True if there was anything to move
+    """
+    items = session.pop('basket', None)
+    if not items:
+        return False
+    default_address = models.AddressDetails.get_default_address(user.id)
+    unavailable = models.Order.merge_basket(
+        user,
+        default_address.id if default_address is not None else None,
+        [tuple(item) for item in items]
+    )
+    if unavailable:
+        flash("Some items in your basket are no longer in stock", "error")
+    return True
+
+
+# creates an instance of the LoginManager class and passes
+# in the Flask object from above
+login_manager = LoginManager(app)
+
+# the login view is where the app will redirect non_authenticated users
+# if @login_required is set
+login_manager.login_view = 'login'
+
+
+@login_manager.user_loader
+def load_user(userid):
+    """
+    **Loads the user between sessions.**
+
+    Takes in the user id stored in the cookies and uses it to pull
+    the user from the database.
+
+    :param userid: users primary key id
+    :return: the user object
+    """
+
+    try:
+        return models.User.get_by_id(int(userid))
+    except (models.DoesNotExist, ValueError):
+        return None
+
+
+# pages that look the same to every visitor who isn't logged in, so they can
+# be served from cache.pages
+CACHED_PAGES = {'index', 'about', 'contact', 'products'}
+
+
+def cached_page_stamps(endpoint):
+    """
+    **Returns the stamps a cached page has to be thrown away with.**
+
+    :param endpoint: the pages endpoint
+    :return: list of :class:`~cache.VersionStamp`
+    """
+    stamps = [cache.pages.content]
+    if endpoint == 'products':
+        stamps.append(cache.catalog.stamp)
+    return stamps
+
+
+def page_cache_key():
+    """
+    **Works out if a request can use the page cache.**
+
+    Only GET requests for CACHED_PAGES from visitors who aren't logged in and
+    have no messages waiting to be flashed qualify. The session is checked
+    directly so the user isn't loaded from the database.
+
+    :return: key of the page for this visitor, or None
+    """
+    if (not app.config['PAGE_CACHE'] or request.method != 'GET' or request.endpoint not in CACHED_PAGES
+            or '_flashes' in session or session.get('_user_id') or session.get('user_id')
+            or 'remember_token' in request.cookies):
+        return None
+    # the basket count in the menu is the only part that changes between visitors
+    return request.full_path, session_basket_count()
+
+
+def add_page_cache_headers(response, body, rendered_on):
+    """
+    **Adds the validators and caching headers to a page for the page cache.**
+
+    :param response: the response
+    :param body: the page as sent
+    :param rendered_on: when the page was rendered, None for pages with a CSRF
+                        token as they can only be checked by ETag
+    """
+    response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    if rendered_on is not None:
+        response.last_modified = rendered_on
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+
+
+def cached_page_response(page):
+    """
+    **Builds the response for a cached page.**
+
+    The CSRF token rendered into the page belongs to whoever requested it first,
+    so it is swapped for this visitors token.
+
+    :param page: the page from :func:`~cache.PageCache.get`
+    :return: a 200 response, or 304 if the browsers copy is still current
+    """
+    body = page['body']
+    if page['csrf_token']:
+        from flask_wtf.csrf import generate_csrf
+        body = body.replace(page['csrf_token'], generate_csrf())
+    response = app.response_class(body, mimetype='text/html')
+    add_page_cache_headers(response, body, None if page['csrf_token'] else page['rendered_on'])
+    return response.make_conditional(request)
+
+
+# form field holding the account each rate limited route is used for
+RATE_LIMITED_ACCOUNT_FIELDS = {'login': 'email_address', 'register': 'email', 'contact': 'email'}
+
+
+@app.before_request
+def limit_request_rate():
+    """
+    **Turns away clients posting to the slow routes too often.**
+
+    Registered before every other request handler, so a request that is turned
+    away never hashes a password, sends an email or touches the database. The
+    limits are set by RATE_LIMITS, for the IP address and for the account named
+    in the form, see :mod:`rate_limit`.
+
+    :return: a 429 response if the client has to wait, otherwise nothing
+    """
+    limit = app.config['RATE_LIMITS'].get(request.endpoint)
+    if limit is None or request.method != 'POST':
+        return
+    keys = ['ip:' + (request.remote_addr or '')]
+    account = request.form.get(RATE_LIMITED_ACCOUNT_FIELDS.get(request.endpoint, ''), '').strip().lower()
+    if account:
+        keys.append('account:' + account)
+    retry_after = rate_limit.limiter.hit(request.endpoint, keys, limit)
+    if retry_after:
+        metrics.registry.increment('rate_limit.rejected.' + request.endpoint)
+        seconds = int(retry_after) + 1
+        response = app.response_class(
+            "Too many attempts, please try again in {} seconds".format(seconds),
+            status=429,
+            mimetype='text/plain'
+        )
+        response.headers['Retry-After'] = str(seconds)
+        return response
+
+
+@app.before_request
+def serve_cached_page():
+    """
+    **Serves pages to visitors who aren't logged in from memory.**
+
+    Registered before :func:`~before_request` so a cached page is sent without
+    any database work. Pages that aren't cached yet are rendered as normal and
+    stored by :func:`~store_cached_page`.
+    """
+    g.page_cache_key = page_cache_key()
+    if g.page_cache_key is None:
+        return
+    stamps = cached_page_stamps(request.endpoint)
+    page = cache.pages.get(g.page_cache_key, stamps)
+    if page is not None:
+        g.page_cache_key = None
+        return cached_page_response(page)
+    g.page_cache_versions = [stamp.version for stamp in stamps]
+
+
+@app.after_request
+def store_cached_page(response):
+    """
+    **Stores pages rendered for visitors who aren't logged in.**
+
+    :param response: the response about to be sent
+    :return: the response, with caching headers if the page was stored
+    """
+    key = g.get('page_cache_key')
+    if key is None or response.status_code != 200 or response.mimetype != 'text/html':
+        return response
+    page = {
+        'body': response.get_data(as_text=True),
+        'csrf_token': g.get('csrf_token'),
+        'rendered_on': datetime.datetime.utcnow().replace(microsecond=0)
+    }
+    cache.pages.set(key, g.page_cache_versions, page)
+    add_page_cache_headers(response, page['body'], None if page['csrf_token'] else page['rendered_on'])
+    return response
+
+
+# endpoints that don't need the database connection, the user or their basket,
+# so before_request skips its work for them
+STATELESS_ENDPOINTS = {'static', 'catalog_api', 'catalog_product_api', 'product_names_api'}
+
+
+@app.before_request
+def before_request():
+    """
+    **Handles all actions before request.**
+
+    This is a built in Flask function that fires before each server request.
+    I use this to do a number of things -
+
+    1. Establishes a connection to the database.
+    2. Assigns the current user to a global variable
+    3. Finds the current users open order and assigns to a global variable
+    4. Find the current users basket amount and assigns to a global variable
+    5. Checks the status of all orders under the current user for tracking.
+
+    None of this is done for the endpoints in STATELESS_ENDPOINTS.
+
+    Every request gets an empty :data:`~models.identity_map`, so a row is only
+    loaded once however many times the request looks it up.
+    """
+    models.identity_map.begin()
+
+    if request.endpoint in STATELESS_ENDPOINTS:
+        g.current_order = None
+        g.current_basket = None
+        return
+
+    g.db = models.db
+    g.db.connect()
+    g.user = current_user
+
+    g.current_order = models.Order.find_current_order(current_user)
+    g.current_basket = models.Order.get_current_basket(g.current_order, current_user)
+    if not current_user.is_authenticated:
+        # visitors that aren't logged in may have a basket in their session
+        g.current_basket = session_basket_count()
+    try:
+        g.default_address = models.AddressDetails.get_default_address(current_user.id)
+    except AttributeError:
+        g.default_address = None
+
+    try:
+        models.Order.check_order_status(current_user.id)
+    except AttributeError:
+        pass
+
+
+@app.after_request
+def after_request(response):
+    """
+    **Handles all actions after server request.**
+
+    This is a built in Flask function that fires after each server request.
+    I use it to close the database connection, then it returns the response from the browser.
+
+    :param response: browser response
+    :return: any response from the browser
+    """
+    saved = models.identity_map.end()
+    if saved:
+        app.logger.debug("%s: %d lookups answered by the identity map", request.path, saved)
+    # stateless endpoints only connect if they had to query the database
+    if not models.db.is_closed():
+        models.db.close()
+    return response
+
+
+# app.route is the path after the domain in the URL
+# methods is if data will be POST, GOT, or both
+@app.route('/login', methods=('GET', 'POST'))
+def login():
+    """
+    **Login route.**
+
+    Handles POST data from the login form then validates credentials against hashed credentials
+    in database. If login is correct then it calls Flasks :func:`~login_user` method which creates an authentication cookie.
+    If not it gives an error.
+
+    :return: A html template containing the login form
+    """
+
+    # instance of LoginForm in forms.py
+    form = forms.LoginForm()
+    # if the form is submitted without errors
+    if form.validate_on_submit():
+        try:
+            # query the db to find a user email address equal to the one given
+            user = models.User.get(models.User.email_address == form.email_address.data)
+        except models.DoesNotExist:
+            # errors if not found
+            flash("Email or password incorrect", "error")
+        else:
+            # check password hash is a method from the bcrypt library imported
+            # it compares the password given to the encrypted password in the db
+            # and returns true or false
+            if check_password_hash(user.password, form.password.data):
+                login_user(user)
+                flash("Log in successful", "success")
+                # anything added to the basket before logging in is moved into their order
+                if merge_session_basket(user):
+                    return redirect(url_for('basket', user_id=user.id))
+                return redirect(url_for('index'))
+            else:
+                # flash messaging appears at the top of the screen
+                # the category given second is used to style the message
+                flash("Email or password incorrect", "error")
+    # render_template returns one of the page templates
+    return render_template('login.html', form=form)
+
+
+@app.route('/register', methods=('GET', 'POST'))
+def register():
+    """
+    **Registration route.**
+
+    Takes POST data from html form and calls :func:`~models.User.create_user`
+    which creates a user in the database, with the default user role of "customer". It then calls Flasks :func:`~login_user` method
+    and redirects the user home.
+
+    :return: html template containing registration form
+    """
+
+    form = forms.RegisterForm()
+    if form.validate_on_submit():
+        # method from the User model that creates user in db
+        models.User.create_user(
+            first_name=form.first_name.data.title(),
+            last_name=form.last_name.data.title(),
+            email_address=form.email.data,
+            password=form.password.data,
+            user_role="customer"
+        )
+        flash("Account Created", "success")
+        user = models.User.get(models.User.email_address == form.email.data)
+        login_user(user)
+        if merge_session_basket(user):
+            return redirect(url_for('basket', user_id=user.id))
+        return redirect(url_for('index'))
+    return render_template('register.html', form=form)
+
+
+@app.route('/logout')
+@login_required
+def logout():
+    """
+    **Logout route.**
+
+    *This route requires authentication*
+
+    Calls Flasks :func:`~flask.logout_user` method which removes authentication cookies.
+    Then redirects user to the login page.
+    :return: a redirect for the login page
+    """
+
+    logout_user()
+    flash("Logged out", "success")
+    return redirect(url_for('login'))
+
+
+@app.route('/create_user', methods=('GET', 'POST'))
+# redirects to login if the user isn't authenticated
+@login_required
+def create_user():
+    """
+    **Create user route.**
+
+    *Route can only be accessed if user role is "admin"*
+
+    Takes in POST data from html form and calls :func:`~models.User.create_user`.
+    Unlike the :func:`~register` route it takes in a user role and assigns it to the created user.
+
+    :return: html template with create user form
+    """
+
+    form = forms.CreateUser()
+    # if the user isn't an admin
+    if current_user.user_role != "admin":
+        # return a 404 error
+        abort(404)
+    else:
+        if form.validate_on_submit():
+            if form.user_role.data == "blank":
+                flash("Must select user role", "error")
+            else:
+                models.User.create_user(
+                    first_name=form.first_name.data.title(),
+                    last_name=form.last_name.data.title(),
+                    email_address=form.email.data,
+                    password=form.password.data,
+                    user_role=form.user_role.data
+                )
+                flash("User created", "success")
+                return redirect(url_for('create_user'))
+        return render_template('create_user.html', form=form, current_basket=g.current_basket)
+
+
+@app.route('/account/<int:user_id>')
+# redirects user to login page if they're not logged in
+@login_required
+def account(user_id):
+    """
+    **Account route**
+
+    *This route requires authentication*
+
+    Takes in a user id and returns that users account page.
+
+    :param user_id: current users id (primary key)
+    :return: html template for account page
+    """
+    if current_user.id != user_id:
+        # tests if a user is trying to access another accounts details
+        # if they are it returns a 404 error
+        abort(404)
+    else:
+        # renders the template
+        return render_template('account.html', current_basket=g.current_basket)
+
+
+@app.route('/orders/<int:user_id>')
+@login_required
+def orders(user_id):
+    """
+    **Orders route**
+
+    *This route requires authentication*
+
+    Pulls the current users placed, dispatched, complete, and canelled orders
+    and assigns them to variables. It then returns a html template and passes
+    the lists of orders in.
+
+    :param user_id: current users id (primary key)
+    :return: html template displaying passed in user orders
+    """
+    # checks the user is accessing their own orders page
+    if current_user.id != user_id:
+        abort(404)
+    else:
+
+        # gets all placed and dispatched orders belonging to the current user
+        # orders them by order_placed_on and assigns to current_orders
+        current_orders = models.Order.order_history(current_user.id, ["placed", "dispatched"])
+
+        # gets all complete orders belonging to the current user, including
+        # archived ones, orders them by order_placed_on and assigns to complete_orders
+        complete_orders = models.Order.order_history(current_user.id, ["complete"])
+
+        # gets all cancelled orders belonging to the current user, including
+        # archived ones, and assigns to cancelled_orders
+        cancelled_orders = models.Order.order_history(current_user.id, ["cancelled"])
+
+        # checks current order status
+        models.Order.check_order_status(current_user.id)
+        return render_template('orders.html', current_basket=g.current_basket,
+                               current_orders=current_orders, complete_orders=complete_orders,
+                               cancelled_orders=cancelled_orders)
+
+
+@app.route('/cancel_order/<int:order_id>')
+@login_required
+def cancel_order(order_id):
+    order = models.Order.get_by_id(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    elif order.order_status != "placed":
+        flash("Order has been dispatched and can not be cancelled")
+        return redirect(url_for('orders', user_id=current_user.id))
+    else:
+        models.Order.cancel_order(order_id)
+        flash("Order cancelled", "success")
+        return redirect(url_for('orders', user_id=current_user.id))
+
+
+@app.route('/continue_order/<int:order_id>')
+@login_required
+def continue_order(order_id):
+    order = models.Order.get_by_id(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    # only a cancelled order can be placed again, anything else is already a sale
+    if order.order_status != "cancelled" or not models.Order.place_order(order_id):
+        flash("Only a cancelled order can be re-placed", "error")
+        return redirect(url_for('orders', user_id=current_user.id))
+    flash("Re-Placed Order")
+    return redirect(url_for('orders', user_id=current_user.id))
+
+
+@app.route('/view_order_details/<int:order_id>')
+@login_required
+def view_order_details(order_id):
+    order = models.Order.find_order(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    address = models.AddressDetails.get_by_id(order.address_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    else:
+        return render_template("view_order_details.html", current_basket=g.current_basket,
+                               order=order, address=address)
+
+
+@app.route('/view_order_details/change_address/<int:user_id>/<int:order_id>')
+@login_required
+def change_order_address(user_id, order_id):
+    order = models.Order.get_by_id(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    if order.order_status != "placed":
+        flash("Order has been dispatched and can no longer be changed", "error")
+        return redirect(url_for('view_order_details', order_id=order_id))
+    address_list = models.AddressDetails \
+        .select() \
+        .where(models.AddressDetails.user_id == current_user.id) \
+        .order_by(models.AddressDetails.default.desc())
+    return render_template("change_order_address.html", current_basket=g.current_basket,
+                           address_list=address_list, order=order)
+
+
+@app.route('/view_order_details/change_address/add_address/<int:order_id>', methods=('POST', 'GET'))
+@login_required
+def change_order_add_address(order_id):
+    order = models.Order.get_by_id(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    form = forms.AddAddress()
+    if form.validate_on_submit():
+        models.AddressDetails.add_address(
+            user_id=current_user.id,
+            address_line_1=form.address_line_1.data,
+            address_line_2=form.address_line_2.data,
+            town=form.town.data,
+            city=form.city.data,
+            postcode=form.postcode.data,
+            order_id=order_id
+        )
+        return redirect(url_for('view_order_details', order_id=order_id))
+    return render_template('add_address.html', form=form, current_basket=g.current_basket)
+
+
+@app.route('/set_order_address/<int:order_id>/<int:address_id>')
+@login_required
+def set_order_address(order_id, address_id):
+    order = models.Order.get_by_id(order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    models.Order.add_address_to_order(order_id, address_id)
+    return redirect(url_for('view_order_details', order_id=order_id))
+
+
+@app.route('/remove_from_order/<int:line_id>/<int:quantity>')
+@login_required
+def remove_from_order(line_id, quantity):
+    line = models.OrderLine.get_by_id(line_id)
+    order = models.Order.get_by_id(line.order_id)
+    if order.user_id != current_user.id:
+        abort(404)
+    else:
+        # the stock put back is the lines quantity, so the one in the link isn't needed
+        if not models.OrderLine.return_order_line(line_id):
+            return redirect(url_for('cancel_order', order_id=order.id))
+        flash("Item removed", "success")
+        return redirect(url_for('view_order_details', order_id=order.id))
+
+
+@app.route('/addresses/<int:user_id>')
+# redirects user to login page if they're not logged in
+@login_required
+def addresses(user_id):
+    """This route returns the addresses for the user that requests it.
+
+    This route takes the user ID as a parameter as it needs it for the url
+    """
+    if current_user.id != user_id:
+        # tests if a user is trying to access another accounts details
+        # if they are it returns a 404 error
+        abort(404)
+    else:
+        # pulls all addresses of the current user out of the database and assigns them to address_list
+        # It orders them by the default attribute so the default address always appears first
+        address_list = models.AddressDetails\
+            .select()\
+            .where(models.AddressDetails.user_id == current_user.id)\
+            .order_by(models.AddressDetails.default.desc())
+        return render_template('addresses.html', current_basket=g.current_basket, address_list=address_list)
+
+
+@app.route('/add_address', methods=('POST', 'GET'))
+# redirects user to login page if they're not logged in
+@login_required
+def add_address():
+    """This route returns a template to allow a user to add a new address"""
+    # assigns the add address form to the form variable
+    form = forms.AddAddress()
+    # if the form is posted and valid
+    if form.validate_on_submit():
+        # add address to the database as the new default, and to the open order if there is one
+        models.AddressDetails.add_address(
+            user_id=current_user.id,
+            address_line_1=form.address_line_1.data,
+            address_line_2=form.address_line_2.data,
+            town=form.town.data,
+            city=form.city.data,
+            postcode=form.postcode.data,
+            default=True,
+            order_id=g.current_order.id if g.current_order is not None else None
+        )
+        flash("Address added", "success")
+        # checks for a session variable created if the user was redirected here during the checkout process
+        if session.get('checking out'):
+            # deletes the session variable
+            session.pop('checking out', None)
+            # return the user to the checkout
+            return redirect(url_for('checkout'))
+        else:
+            # otherwise it just returns them to the addresses page
+            return redirect(url_for('addresses', user_id=current_user.id))
+        # renders the add address template
+    return render_template('add_address.html', form=form, current_basket=g.current_basket)
+
+
+@app.route('/set_address_default/<int:address_id>')
+# redirects user to login page if they're not logged in
+@login_required
+def set_address_default(address_id):
+    """This route is used to change the default address
+
+    It is fired when the Set Default link is clicked on the address.
+    It takes the new address Id in as a parameter
+    """
+    # uses my change_default method under AddressDetails to change the default to the one passed in
+    models.AddressDetails.change_default(address_id, current_user.id)
+    # success message
+    flash("New default set", "success")
+
+    # redirects user back to addresses
+    return redirect(url_for('addresses', user_id=current_user.id))
+
+
+@app.route('/edit_address/<int:address_id>/<int:user_id>', methods=('POST', 'GET'))
+# redirects user to login page if they're not logged in
+@login_required
+def edit_address(address_id, user_id):
+    """This route returns a template to allow a user to edit an address"""
+    form = forms.AddAddress()
+    # gets address from db and assigns it to address
+    address = models.AddressDetails.get_by_id(address_id)
+    # creates empty list called address_items
+    address_items = []
+    # if the address bering edited does not belong to the current user
+    if user_id != current_user.id:
+        # give a 404 error
+        abort(404)
+    else:
+        # if the form is submitted and is valid
+        if form.validate_on_submit():
+            # call my edit_address method and pass in the form details
+            models.AddressDetails.edit_address(
+                address_id=address_id,
+                address_line_1=form.address_line_1.data,
+                address_line_2=form.address_line_2.data,
+                town=form.town.data,
+                city=form.city.data,
+                postcode=form.postcode.data
+            )
+            # success message
+            flash("Address updated", "success")
+            # redirect user to addresses
+            return redirect(url_for('addresses', user_id=current_user.id))
+
+        # when it gets the address it returns it as a dictionary, which has key (column name) and value(the data)
+        # this loops through the dictionary assigning the key to key, and the value to value
+        for key, value in address.__data__.items():
+            # if the key isn't id, user_id, and default (we don't need these)
+            if key != 'id' and key != 'user_id' and key != 'default':
+                # add the value (cell data) to the address_items list
+                address_items.append(value)
+    # render the template passing in the address_items so they can pre-populate the form
+    return render_template('edit_address.html', address_items=address_items, form=form, current_basket=g.current_basket)
+
+
+@app.route('/delete_address/<int:address_id>/<int:user_id>')
+# redirects user to login page if they're not logged in
+@login_required
+def delete_address(address_id, user_id):
+    """This route removes an address
+
+    An address id is passed in from the link, it then calls methods
+    in the model to remove the address
+    """
+    # if the address doesn't belong to the current user
+    if user_id != current_user.id:
+        # give 404 error
+        abort(404)
+    else:
+        # calls delete_address method and passes in the address id, if it was the
+        # default the users newest address becomes the default
+        models.AddressDetails.delete_address(address_id, current_user.id)
+        # success message
+        flash("Address Removed", "success")
+        # redirects the user to addresses
+        return redirect(url_for('addresses', user_id=current_user.id))
+
+
+@app.route('/login_details/<int:user_id>')
+@login_required
+def login_details(user_id):
+    if user_id != current_user.id:
+        abort(404)
+    else:
+        return render_template("login_details.html", current_basket=g.current_basket, user=current_user)
+
+
+@app.route('/edit_login_details/<int:user_id>', methods=('GET', 'POST'))
+def edit_login_details(user_id):
+    if user_id != current_user.id:
+        abort(404)
+    else:
+        form = forms.EditLoginDetails()
+        if form.validate_on_submit():
+            try:
+                models.User.edit_details(
+                    user_id=current_user.id,
+                    first_name=form.first_name.data,
+                    last_name=form.last_name.data,
+                    email_address=form.email_address.data
+                )
+                return redirect(url_for('login_details', user_id=current_user.id))
+            except ValueError as e:
+                e = str(e)
+                flash(e, "error")
+        detail_list = []
+        for key, value in current_user.__data__.items():
+            if key == "first_name" or key == "last_name" or key == "email_address":
+                detail_list.append(value)
+        return render_template("edit_login_details.html",
+                               current_basket=g.current_basket, detail_list=detail_list, form=form)
+
+
+@app.route('/reset_password/<int:user_id>', methods=('GET', 'POST'))
+def reset_password(user_id):
+    if user_id != current_user.id:
+        abort(404)
+    else:
+        form = forms.ResetPassword()
+        if form.validate_on_submit():
+            if not check_password_hash(current_user.password, form.current_password.data):
+                flash("Current Password Incorrect", "error")
+            else:
+                models.User.reset_password(current_user.id, form.new_password.data)
+                flash("Password Reset", "success")
+                return redirect(url_for('login_details', user_id=current_user.id))
+        return render_template("reset_password.html", current_basket=g.current_basket, form=form)
+
+
+@app.route('/create_product', methods=('GET', 'POST'))
+@login_required
+def create_product():
+    """Route that returns the page for administrators to create products.
+
+    On this route it takes input from the create product form and
+    uses a method inside the Product class to create a product
+    in the database.
+    """
+
+    form = forms.CreateProduct()
+
+    # if the user is a customer, give them a 404 page
+    if current_user.user_role == "customer":
+        abort(404)
+    else:
+        # if the form is validated
+        if form.validate_on_submit():
+            # create_product also sets up the products stock levels
+            new_product = models.Product.create_product(
+                product_category=form.product_category.data,
+                product_name=form.product_name.data,
+                product_price=money.to_pence(form.product_price.data),
+                product_description=form.product_description.data,
+                one_size_stock=form.one_size_stock.data,
+                small_stock=form.small_stock.data,
+                medium_stock=form.medium_stock.data,
+                large_stock=form.large_stock.data
+            )
+            file = request.files['image']
+            name = request.files['image'].filename
+            parts = name.split('.')
+            ext = parts[1]
+            file_name = str(new_product.id) + "." + ext
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
+            file.save(file_path)
+            # add_image also clears the cached product lists
+            models.Product.add_image(new_product.id, file_path)
+            flash("Product added", "success")
+            return redirect(url_for('create_product'))
+        # returns the create_product template
+        return render_template('create_product.html', form=form, current_basket=g.current_basket)
+
+
+@app.route('/products', methods=('POST', 'GET'))
+def products():
+    sorting_form = forms.OrderProducts()
+    sort_by = ''
+    if sorting_form.validate_on_submit():
+        sort_by = sorting_form.order_by.data
+    # the sorted lists are kept in memory until a product or its stock changes
+    product_list = cache.catalog.products(sort_by)
+    search = request.args.get('search', '')
+    if search:
+        # the search box finds products by the start of their name
+        found = {product_id for name, product_id in cache.product_names.search(search)}
+        product_list = [product for product in product_list if product.id in found]
+    return render_template('products.html', products=product_list,
+                           current_basket=g.current_basket, sorting_form=sorting_form)
+
+
+@app.route('/remove_product/<int:product_id>')
+@login_required
+def remove_product(product_id):
+    if current_user.user_role == "customer":
+        abort(404)
+    else:
+        product_list = models.Product.select()
+        models.Product.remove_product(product_id)
+        cache.catalog.invalidate()
+        cache.product_names.remove(product_id)
+        flash("Product deleted", "success")
+        return redirect(url_for('products', products=product_list, current_basket=g.current_basket))
+
+
+def change_basket(operations):
+    """
+    **Applies basket operations for the current user.**
+
+    Used by the basket API and the basket forms, see
+    :func:`~models.Order.apply_basket_operations`.
+
+    :param operations: list of operation dictionaries
+    :return: the new state of the basket
+    """
+    state = models.Order.apply_basket_operations(
+        current_user,
+        g.default_address.id if g.default_address is not None else None,
+        operations
+    )
+    g.current_order = models.Order.find_current_order(current_user)
+    return state
+
+
+@app.route('/add_to_order/<int:product_id>/<product_category>', methods=('POST', 'GET'))
+def add_to_order(product_id, product_category):
+    if not current_user.is_authenticated:
+        if not app.config['SESSION_BASKET']:
+            return login_manager.unauthorized()
+        # visitors that aren't logged in get a basket in their session instead of an order
+        if request.method == 'POST':
+            add_to_session_basket(product_id, product_category, int(request.form.get('quantity')),
+                                  request.form.get('size'))
+        return redirect(url_for('products'))
+    if request.method == 'POST':
+        size = request.form.get('size') if product_category == "tshirt" else "one_size"
+        try:
+            state = change_basket([{
+                'op': 'add',
+                'product_id': product_id,
+                'size': size,
+                'quantity': int(request.form.get('quantity'))
+            }])
+        except ValueError as e:
+            flash(str(e), "error")
+        else:
+            if state['errors']:
+                flash("Please enter a quantity less than the stock", "error")
+            else:
+                flash("Added to basket", "success")
+    return redirect(url_for('products'))
+
+
+@app.route('/api/basket', methods=('GET', 'POST'))
+@login_required
+def basket_api():
+    """
+    **Basket API.**
+
+    *This route requires authentication*
+
+    GET returns the current users basket as JSON. POST takes a JSON body of
+    ``{"operations": [...]}``, where each operation looks like
+    ``{"op": "add", "product_id": 1, "size": "small", "quantity": 2}``
+    ("add", "remove" or "set"), applies them all in one transaction and
+    returns the new basket.
+
+    :return: the basket as JSON
+    """
+    if request.method == 'GET':
+        if g.current_order is None:
+            return jsonify(order_id=None, lines=[], item_count=0, order_total="0.00", errors=[])
+        return jsonify(models.Order.basket_state(g.current_order.id))
+
+    # only JSON bodies are accepted, which browsers won't send cross-site without permission
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('operations'), list):
+        return jsonify(error="Expected a JSON body with a list of operations"), 400
+    try:
+        state = change_basket(body['operations'])
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(state)
+
+
+# columns sent by the catalog API, in the order they appear in each product
+CATALOG_FIELDS = ('id', 'product_category', 'product_name', 'product_price', 'product_description',
+                  'product_image_path', 'one_size_stock', 'small_stock', 'medium_stock', 'large_stock')
+
+# prices are kept in pence, the API sends them in pounds as it always has
+CATALOG_PRICE_COLUMN = CATALOG_FIELDS.index('product_price')
+
+
+def catalog_row(row):
+    """
+    **Turns a product row from the database into the row the catalog API sends.**
+
+    :param row: tuple of the CATALOG_FIELDS
+    :return: the tuple with the price in pounds
+    """
+    return row[:CATALOG_PRICE_COLUMN] + (money.format_pence(row[CATALOG_PRICE_COLUMN]),) + \
+        row[CATALOG_PRICE_COLUMN + 1:]
+
+
+# sort options accepted by the catalog API
+CATALOG_SORTS = {
+    'name': lambda: models.Product.product_name,
+    '-name': lambda: models.Product.product_name.desc(),
+    'price': lambda: models.Product.product_price,
+    '-price': lambda: models.Product.product_price.desc(),
+}
+
+
+def cached_catalog_response(key, build):
+    """
+    **Sends a catalog API response with a strong ETag, using the cached body if possible.**
+
+    The ETag is made from the catalog version, which is read from a stamp file,
+    so a request with a matching ``If-None-Match`` gets a 304 without the
+    database being touched. Otherwise the body comes from memory, or
+    ``build`` is called to make it.
+
+    :param key: string identifying the response, e.g. the query string
+    :param build: function returning (status code, data to send as JSON)
+    :return: the response
+    """
+    version = cache.catalog.version
+    etag = '{:x}-{}'.format(version, hashlib.sha1(key.encode()).hexdigest()[:16])
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        cached = cache.api_responses.get((version, key))
+        if cached is None:
+            status, data = build()
+            cached = (status, json.dumps(data, separators=(',', ':')))
+            cache.api_responses.set((version, key), cached)
+        status, body = cached
+        response = app.response_class(body, status=status, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/products')
+def catalog_api():
+    """
+    **Catalog API.**
+
+    Lists every product as JSON. The rows are sent as lists in the order given
+    by ``fields`` to keep the response small.
+    ``?category=`` filters to one category and ``?sort=`` takes name, -name,
+    price or -price.
+
+    :return: JSON with "fields" and "products"
+    """
+    category = request.args.get('category')
+    sort = request.args.get('sort', 'name')
+    if category is not None and category not in models.PRODUCT_CATEGORIES:
+        return jsonify(error="Category must be one of " + ", ".join(models.PRODUCT_CATEGORIES)), 400
+    if sort not in CATALOG_SORTS:
+        return jsonify(error="Sort must be one of " + ", ".join(CATALOG_SORTS)), 400
+
+    def build():
+        query = models.Product.select(*[getattr(models.Product, field) for field in CATALOG_FIELDS])
+        if category is not None:
+            query = query.where(models.Product.product_category == category)
+        rows = query.order_by(CATALOG_SORTS[sort]()).tuples()
+        return 200, {'fields': CATALOG_FIELDS, 'products': [catalog_row(row) for row in rows]}
+
+    return cached_catalog_response('list:{}:{}'.format(category, sort), build)
+
+
+@app.route('/api/products/<int:product_id>')
+def catalog_product_api(product_id):
+    """
+    **Catalog API for one product.**
+
+    :param product_id: product id (primary key)
+    :return: JSON object of the products fields
+    """
+    def build():
+        row = models.Product.select(*[getattr(models.Product, field) for field in CATALOG_FIELDS])\
+            .where(models.Product.id == product_id)\
+            .tuples()\
+            .first()
+        if row is None:
+            return 404, {'error': "Product not found"}
+        return 200, dict(zip(CATALOG_FIELDS, catalog_row(row)))
+
+    return cached_catalog_response('product:{}'.format(product_id), build)
+
+
+@app.route('/api/products/names')
+def product_names_api():
+    """
+    **Suggestions for the search box.**
+
+    Returns the names of the products that start with ``?prefix=``, ignoring
+    case, in name order. They come from :data:`cache.product_names`, so
+    nothing is asked of the database. ``?limit=`` asks for fewer than
+    AUTOCOMPLETE_LIMIT names.
+
+    :return: JSON with "names"
+    """
+    limit = min(request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int),
+                app.config['AUTOCOMPLETE_LIMIT'])
+    names = [name for name, product_id in
+             cache.product_names.search(request.args.get('prefix', ''), max(limit, 0))]
+    return jsonify(names=names)
+
+
+@app.route('/basket/<int:user_id>')
+@login_required
+def basket(user_id):
+    if current_user.id != user_id:
+        abort(404)
+    else:
+        suggestions = []
+        if g.current_order is not None and g.current_order.line_count and app.config['BASKET_SUGGESTIONS']:
+            suggestions = models.CoPurchase.suggestions(g.current_order.id, app.config['BASKET_SUGGESTIONS'])
+        return render_template('basket.html', current_basket=g.current_basket, current_order=g.current_order,
+                               suggestions=suggestions)
+
+
+@app.route('/remove_from_basket/<int:line_id>/<int:quantity>')
+@login_required
+def remove_from_basket(line_id, quantity):
+    line = models.OrderLine.get_by_id(line_id)
+    if g.current_order is None or line.order_id != g.current_order.id:
+        abort(404)
+    else:
+        # the stock put back is the lines quantity, so the one in the link isn't needed
+        change_basket([{'op': 'remove', 'product_id': line.product_id, 'size': line.size}])
+        flash("Item removed", "success")
+        return redirect(url_for('basket', user_id=current_user.id))
+
+
+@app.route('/edit_quantity/<int:line_id>', methods=('GET', 'POST'))
+@login_required
+def edit_quantity(line_id):
+    if request.method == "POST":
+        order_line = models.OrderLine.get_by_id(line_id)
+        if g.current_order is None or order_line.order_id != g.current_order.id:
+            abort(404)
+        new_quantity = int(request.form.get('quantity'))
+        if new_quantity == order_line.quantity:
+            flash("Quantity not changed", "error")
+        else:
+            state = change_basket([{
+                'op': 'set',
+                'product_id': order_line.product_id,
+                'size': order_line.size,
+                'quantity': new_quantity
+            }])
+            if state['errors']:
+                flash("Please enter a quantity less than the stock", "error")
+    return redirect(url_for('basket', user_id=current_user.id))
+
+
+@app.route('/change_shipping', methods=['POST'])
+@login_required
+def change_shipping():
+    shipping_id = int(request.form.get('shipping'))
+    models.Order.change_shipping(shipping_id, g.current_order.id)
+    return redirect(url_for('checkout'))
+
+
+@app.route('/checkout', methods=('GET', 'POST'))
+@login_required
+def checkout():
+    if g.current_order.line_count == 0:
+        flash("No items to checkout", "error")
+        return redirect(url_for('products'))
+    elif g.default_address is not None:
+        # gives the customer as long again to pay before the stock is released
+        models.OrderLine.renew_reservations(g.current_order.id)
+        return render_template("checkout.html", current_basket=g.current_basket,
+                               current_order=g.current_order, default_address=g.default_address,
+                               stripe_pub_key=app.config['STRIPE_PUB_KEY'])
+    else:
+        flash("Please add delivery address", "error")
+        session["checking out"] = True
+        return redirect(url_for("add_address"))
+
+
+@app.route('/pay', methods=['GET', 'POST'])
+@login_required
+def pay():
+    """
+    **Payment route.**
+
+    *This route requires authentication*
+
+    Charges the card from Stripe Checkout for the current basket and places the
+    order, see :func:`~payments.pay_for_order`. With ``PAYMENT_CONFIRMATION``
+    set to "webhook" the order is placed when Stripe's event for the charge is
+    processed, see :func:`~stripe_webhook`.
+
+    :return: redirects home once the order is placed, or back to the basket or
+             checkout with the reason it couldn't be
+    """
+    if g.current_order is None:
+        return redirect(url_for('products'))
+    wait_for_event = app.config['PAYMENT_CONFIRMATION'] == 'webhook'
+    try:
+        order = payments.pay_for_order(g.current_order.id, current_user.email_address,
+                                       request.form.get('stripeToken'), get_stripe(), wait_for_event)
+    except payments.BasketChanged as e:
+        flash(str(e), "error")
+        return redirect(url_for('basket', user_id=current_user.id))
+    except payments.RefundFailed as e:
+        app.logger.error("Order %s was charged %s but not placed or refunded", g.current_order.id, e.charge_id)
+        flash(str(e), "error")
+        return redirect(url_for('basket', user_id=current_user.id))
+    except payments.PaymentPending as e:
+        app.logger.warning("Order %s timed out while being charged", g.current_order.id)
+        flash(str(e), "error")
+        return redirect(url_for('index'))
+    except payments.CheckoutError as e:
+        flash(str(e), "error")
+        return redirect(url_for('checkout'))
+
+    send_email(
+        "Order Confirmation",
+        'contact@nativesins.com',
+        current_user.email_address,
+        render_template("order_confirmation.html"),
+        render_template("order_confirmation.html"))
+
+    if order is None:
+        flash("Payment received, your order will be confirmed shortly", "success")
+    else:
+        flash("Order Complete", "success")
+    return redirect(url_for('index'))
+
+
+@app.route('/stripe_webhook', methods=['POST'])
+def stripe_webhook():
+    """
+    **Stripe webhook route.**
+
+    Checks the request was signed with ``STRIPE_WEBHOOK_SECRET`` and queues the
+    event in :class:`~models.PaymentEvent` for ``manage.py process-payment-events``,
+    so Stripe gets its answer without waiting for the order to be placed.
+
+    :return: 200 once the event is queued, 400 if the signature is wrong
+    """
+    payload = request.get_data()
+    try:
+        event = payments.read_webhook(payload, request.headers.get('Stripe-Signature', ''),
+                                      app.config['STRIPE_WEBHOOK_SECRET'])
+    except payments.SignatureError as e:
+        app.logger.warning("Rejected a webhook request: %s", e)
+        abort(400)
+    models.PaymentEvent.enqueue(event['id'], event['type'], payload.decode())
+    return jsonify(received=True)
+
+
+@app.route('/api/status')
+@login_required
+def status_api():
+    """
+    **Status API.**
+
+    *This route requires a staff account*
+
+    Shows whether the breakers for the outside services are letting calls
+    through, see :mod:`resilience`, the number of payment events waiting to be
+    processed, and every metric this process has recorded, including how long
+    the calls to each service took.
+
+    :return: the breakers, payment event backlog and metrics as JSON
+    """
+    if current_user.user_role == "customer":
+        abort(404)
+    return jsonify(services=resilience.status(), payment_events=models.PaymentEvent.backlog(),
+                   metrics=metrics.registry.snapshot())
+
+
+# number of stock levels shown on each page of the inventory
+INVENTORY_PAGE_SIZE = 50
+
+
+@app.route('/inventory')
+@app.route('/inventory/<int:page>')
+@login_required
+def inventory(page=1):
+    """
+    **Inventory route**
+
+    *This route requires a staff account*
+
+    Lists the stock of every product and size, the ones that most need restocking
+    first, with how many have sold in the last 30 days.
+
+    :param page: page number
+    :return: html template displaying the stock levels
+    """
+    if current_user.user_role == "customer":
+        abort(404)
+    levels = models.StockLevel.inventory_page(page, INVENTORY_PAGE_SIZE)
+    return render_template('inventory.html', current_basket=g.current_basket, levels=levels, page=page,
+                           more=len(levels) == INVENTORY_PAGE_SIZE, low_stock=models.StockLevel.low_stock_count(),
+                           form=forms.StockThreshold())
+
+
+@app.route('/inventory/threshold/<int:stock_level_id>', methods=['POST'])
+@login_required
+def set_stock_threshold(stock_level_id):
+    if current_user.user_role == "customer":
+        abort(404)
+    form = forms.StockThreshold()
+    if form.validate_on_submit():
+        models.StockLevel.set_threshold(stock_level_id, form.threshold.data)
+        flash("Threshold updated", "success")
+    else:
+        flash("Please enter a threshold of 0 or more", "error")
+    return redirect(url_for('inventory', page=request.form.get('page', 1, type=int)))
+
+
+@app.route('/bulk_update', methods=('GET', 'POST'))
+@login_required
+def bulk_update():
+    """
+    **Bulk update route**
+
+    *This route requires a staff account*
+
+    Takes a CSV of stock and price changes and applies them all in one go,
+    see :func:`~models.Product.bulk_update`, then shows what changed.
+
+    :return: html template with the upload form and the changes made
+    """
+    if current_user.user_role == "customer":
+        abort(404)
+    form = forms.BulkUpdate()
+    result = None
+    errors = []
+    if form.validate_on_submit():
+        try:
+            text = form.csv_file.data.read().decode('utf-8-sig')
+            result = models.Product.bulk_update(models.parse_bulk_update(text))
+        except UnicodeDecodeError:
+            errors = ["The file isn't a text CSV file"]
+        except ValueError as error:
+            # nothing has been changed, every problem found is listed
+            errors = error.args
+        else:
+            flash("{} change(s) made".format(len(result['changes'])), "success")
+    return render_template('bulk_update.html', form=form, result=result, errors=errors,
+                           current_basket=g.current_basket)
+
+
+@app.route('/reports', methods=['POST', 'GET'])
+@login_required
+def reports():
+    form = forms.CreateReport()
+    file_name = None
+    if current_user.user_role == "customer":
+        abort(404)
+    if form.validate_on_submit():
+        start_date = form.start_date.data
+        end_date = form.end_date.data
+        test = form.report_type.data
+        if form.report_type.data == "user":
+            file_name = models.User.generate_user_report(start_date, end_date)
+        elif form.report_type.data == "order":
+            file_name = models.Order.generate_order_report(start_date, end_date)
+        elif form.report_type.data == "sales":
+            # read from the rollup tables rather than the orders
+            file_name = models.ProductSales.generate_sales_report(start_date, end_date)
+
+        if file_name is None:
+            flash("No data found between those dates", "error")
+        else:
+            file_path = 'static\\tmp_reports\\' + file_name
+            return send_file(file_path, attachment_filename='report.csv', as_attachment=True)
+    return render_template('reports.html', form=form, current_basket=g.current_basket)
+
+
+@app.route('/about')
+def about():
+    return render_template('about.html', current_basket=g.current_basket)
+
+
+@app.route('/contact', methods=('GET', 'POST'))
+def contact():
+    form = forms.Contact()
+    if form.validate_on_submit():
+        name = form.name.data
+        email = form.email.data
+        message = form.message.data
+        # if the email couldn't be sent the error has been flashed and the form is shown again
+        if send_email(
+                "Contact Form",
+                email,
+                'contact@nativesins.com',
+                render_template("contact_email.html", name=name, message=message),
+                render_template("contact_email.html", name=name, message=message)):
+            flash('Email sent, we will reply as soon as possible', 'success')
+            return redirect(url_for('contact'))
+
+    return render_template('contact.html', current_basket=g.current_basket, form=form)
+
+
+@app.route('/')
+def index():
+    """Route that returns the index(home) page"""
+    return render_template('index.html', current_basket=g.current_basket, user=current_user)
+
+
+@app.errorhandler(404)
+def not_found(error):
+    """Route that returns a custom 404 page if the user encounters that error"""
+    return render_template('404.html', current_basket=g.current_basket, current_order=g.current_order)
+
+
+# if the app is being run directly, rather than imported
+if __name__ == '__main__':
+    # the tables, admin user and shipping options are created
+    # with "python manage.py init-db" and "python manage.py seed"
+    create_app()
+    app.run(host='localhost', debug=True, port=5000)
@@ -0,0 +1,422 @@
+"""
+    cache.py keeps copies of data that rarely changes in memory so pages
+    don't have to ask the database for it on every request.
+
+    Each process has its own copy. When something changes a stamp file is
+    touched, every process compares the stamp before using its copy so a change
+    made by one worker is seen by all of them.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import bisect
+import os
+import threading
+import time
+import types
+from collections import OrderedDict, namedtuple
+
+
+class VersionStamp(object):
+    """
+    **Version number shared between processes.**
+
+    The version is the modification time of a file, so reading it is a single
+    ``stat`` call and never touches the database.
+    """
+
+    def __init__(self, name, folder='cache_stamps'):
+        self.name = name
+        self.folder = folder
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name)
+
+    @property
+    def version(self):
+        """
+        **Current version.**
+
+        :return: the stamps modification time in nanoseconds, 0 if it has never been bumped
+        """
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        """
+        **Marks everything cached under this stamp as out of date.**
+
+        :return: the new version
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        # always move forward, even if two bumps land within the clock resolution
+        now = max(time.time_ns(), self.version + 1)
+        with open(self.path, 'a'):
+            os.utime(self.path, ns=(now, now))
+        return now
+
+
+class LRUCache(object):
+    """
+    **Fixed size cache that forgets the least recently used item first.**
+
+    Safe to share between the threads of one process.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class CatalogCache(object):
+    """
+    **Sorted lists of products.**
+
+    Holds the result of each of the product page sorts, the lists are thrown
+    away whenever a product, its price or its stock changes.
+    """
+
+    def __init__(self, maxsize=16, stamp_folder='cache_stamps'):
+        self.stamp = VersionStamp('catalog', stamp_folder)
+        self._lists = LRUCache(maxsize)
+        self._version = None
+
+    def configure(self, maxsize, stamp_folder):
+        self.stamp = VersionStamp('catalog', stamp_folder)
+        self._lists = LRUCache(maxsize)
+        self._version = None
+
+    @property
+    def version(self):
+        return self.stamp.version
+
+    def _check_version(self):
+        version = self.stamp.version
+        if version != self._version:
+            self._lists.clear()
+            self._version = version
+
+    def products(self, sort_by=''):
+        """
+        **Returns the products for one of the sort options on the products page.**
+
+        :param sort_by: a value from :class:`~forms.OrderProducts`
+        :return: list of products
+        """
+        self._check_version()
+        product_list = self._lists.get(sort_by)
+        if product_list is None:
+            product_list = list(_product_query(sort_by))
+            self._lists.set(sort_by, product_list)
+        return product_list
+
+    def invalidate(self):
+        """
+        **Throws away every cached list, in this process and the others.**
+        """
+        self.stamp.bump()
+        self._lists.clear()
+
+
+class PageCache(object):
+    """
+    **Whole pages rendered for visitors who aren't logged in.**
+
+    Each page remembers the versions of the stamps it was rendered against, and
+    is thrown away when any of them moves on.
+    """
+
+    def __init__(self, maxsize=128, stamp_folder='cache_stamps'):
+        self.configure(maxsize, stamp_folder)
+
+    def configure(self, maxsize, stamp_folder):
+        self.content = VersionStamp('content', stamp_folder)
+        self._pages = LRUCache(maxsize)
+
+    def get(self, key, stamps):
+        """
+        **Returns a cached page if it is still up to date.**
+
+        :param key: the pages key
+        :param stamps: the stamps the page depends on
+        :return: the dictionary passed to :func:`~set`, or None
+        """
+        page = self._pages.get(key)
+        if page is None or page['versions'] != [stamp.version for stamp in stamps]:
+            return None
+        return page
+
+    def set(self, key, versions, page):
+        """
+        **Stores a rendered page.**
+
+        :param key: the pages key
+        :param versions: versions of the stamps the page depends on, read before it was rendered
+        :param page: dictionary describing the page
+        """
+        page['versions'] = versions
+        self._pages.set(key, page)
+
+    def invalidate_content(self):
+        """
+        **Throws away every cached page, e.g. after the page templates change.**
+        """
+        self.content.bump()
+        self._pages.clear()
+
+
+# a shipping option as kept by ReferenceData, read only so it can be shared by every request
+ShippingRate = namedtuple('ShippingRate', ['id', 'name', 'cost'])
+
+
+class ReferenceData(object):
+    """
+    **Small tables that hardly ever change, like the shipping options.**
+
+    Everything is loaded in one go into a snapshot that is never changed, only
+    swapped for a new one, so requests read it without taking a lock or asking
+    the database. A change bumps the "reference" stamp and each process loads
+    a new snapshot the next time it is used.
+    """
+
+    def __init__(self, stamp_folder='cache_stamps'):
+        self.configure(stamp_folder)
+
+    def configure(self, stamp_folder):
+        self.stamp = VersionStamp('reference', stamp_folder)
+        self._snapshot = None
+
+    def load(self):
+        """
+        **Loads a new snapshot from the database.**
+
+        :return: the snapshot, a dictionary with the "version" it was loaded at
+                 and "shipping_options" keyed by id
+        """
+        import models
+
+        # read the version first, so a change made while loading is picked up next time
+        version = self.stamp.version
+        options = models.ShippingOption.select(models.ShippingOption.id, models.ShippingOption.name,
+                                               models.ShippingOption.cost).tuples()
+        self._snapshot = {
+            'version': version,
+            'shipping_options': types.MappingProxyType(
+                {option_id: ShippingRate(option_id, name, cost) for option_id, name, cost in options})
+        }
+        return self._snapshot
+
+    def snapshot(self):
+        """
+        **Returns the current snapshot, loading a new one if it is out of date.**
+
+        :return: see :func:`~load`
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot['version'] != self.stamp.version:
+            snapshot = self.load()
+        return snapshot
+
+    def shipping_options(self):
+        """
+        **Returns every shipping option.**
+
+        :return: read only dictionary of :class:`ShippingRate` keyed by id
+        """
+        return self.snapshot()['shipping_options']
+
+    def shipping_option(self, shipping_id):
+        """
+        **Returns one shipping option.**
+
+        :param shipping_id: shipping option id (primary key)
+        :return: the :class:`ShippingRate`, or None if there isn't one
+        """
+        return self.snapshot()['shipping_options'].get(shipping_id)
+
+    def invalidate(self):
+        """
+        **Makes every process load the reference data again.**
+        """
+        self.stamp.bump()
+        self._snapshot = None
+
+
+def name_key(text):
+    """
+    **Turns a product name, or the start of one, into the form it is searched by.**
+
+    :param text: the name
+    :return: the name in lower case with runs of spaces made single
+    """
+    return ' '.join(text.casefold().split())
+
+
+class ProductNameIndex(object):
+    """
+    **Product names sorted for finding the ones that start with what has been typed.**
+
+    The names are kept as a sorted tuple of ``(key, name, id)``, see
+    :func:`name_key`, so the names with a prefix are found with a binary
+    search and never ask the database. Like :class:`ReferenceData` the tuple
+    is never changed, only swapped for a new one. Creating or removing a
+    product patches it in this process and bumps the "product_names" stamp,
+    so the other processes load the names again.
+    """
+
+    def __init__(self, stamp_folder='cache_stamps'):
+        self._lock = threading.Lock()
+        self.configure(stamp_folder)
+
+    def configure(self, stamp_folder):
+        self.stamp = VersionStamp('product_names', stamp_folder)
+        self._snapshot = None
+
+    def load(self):
+        """
+        **Loads every product name from the database.**
+
+        :return: the snapshot, a dictionary with the "version" it was loaded at and the sorted "entries"
+        """
+        import models
+
+        # read the version first, so a change made while loading is picked up next time
+        version = self.stamp.version
+        names = models.Product.select(models.Product.id, models.Product.product_name).tuples()
+        self._snapshot = {
+            'version': version,
+            'entries': tuple(sorted((name_key(name), name, product_id) for product_id, name in names))
+        }
+        return self._snapshot
+
+    def snapshot(self):
+        """
+        **Returns the current snapshot, loading a new one if it is out of date.**
+
+        :return: see :func:`~load`
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot['version'] != self.stamp.version:
+            snapshot = self.load()
+        return snapshot
+
+    def search(self, prefix, limit=None):
+        """
+        **Finds the products whose names start with a prefix, ignoring case.**
+
+        :param prefix: what has been typed
+        :param limit: most products to return, None for all of them
+        :return: list of (name, product id) in name order
+        """
+        key = name_key(prefix)
+        if not key:
+            return []
+        entries = self.snapshot()['entries']
+        matches = []
+        for index in range(bisect.bisect_left(entries, (key,)), len(entries)):
+            entry_key, name, product_id = entries[index]
+            if not entry_key.startswith(key) or len(matches) == limit:
+                break
+            matches.append((name, product_id))
+        return matches
+
+    def _patch(self, change):
+        with self._lock:
+            snapshot = self._snapshot
+            # without an up to date snapshot there is nothing to patch, the
+            # names are loaded with the change in them when next used
+            stale = snapshot is None or snapshot['version'] != self.stamp.version
+            version = self.stamp.bump()
+            if stale:
+                self._snapshot = None
+            else:
+                self._snapshot = {'version': version, 'entries': tuple(change(list(snapshot['entries'])))}
+
+    def add(self, product_id, name):
+        """
+        **Adds a new product's name.**
+
+        :param product_id: the products id (primary key)
+        :param name: the products name
+        """
+        def change(entries):
+            bisect.insort(entries, (name_key(name), name, product_id))
+            return entries
+        self._patch(change)
+
+    def remove(self, product_id):
+        """
+        **Takes a removed product's name out.**
+
+        :param product_id: the products id (primary key)
+        """
+        self._patch(lambda entries: [entry for entry in entries if entry[2] != product_id])
+
+
+def _product_query(sort_by):
+    import models
+
+    query = models.Product.select()
+    if sort_by == "price_lth":
+        return query.order_by(models.Product.product_price)
+    elif sort_by == "price_htl":
+        return query.order_by(models.Product.product_price.desc())
+    elif sort_by in models.PRODUCT_CATEGORIES:
+        return query.where(models.Product.product_category == sort_by)
+    return query.order_by(models.Product.product_name)
+
+
+# catalog shared by the whole process
+catalog = CatalogCache()
+
+# pages for visitors that aren't logged in
+pages = PageCache()
+
+# JSON bodies sent by the catalog API, keyed by catalog version so old ones just age out
+api_responses = LRUCache(256)
+
+# shipping options and other reference data
+reference = ReferenceData()
+
+# product names for the search box
+product_names = ProductNameIndex()
+
+
+def configure(config):
+    """
+    **Sets the cache sizes from the app config.**
+
+    :param config: the Flask config
+    """
+    catalog.configure(config['CATALOG_CACHE_SIZE'], config['CACHE_STAMP_FOLDER'])
+    api_responses.maxsize = config['CATALOG_API_CACHE_SIZE']
+    pages.configure(config['PAGE_CACHE_SIZE'], config['CACHE_STAMP_FOLDER'])
+    reference.configure(config['CACHE_STAMP_FOLDER'])
+    product_names.configure(config['CACHE_STAMP_FOLDER'])
@@ -0,0 +1,149 @@
+"""
+    config.py holds the settings the app is created with.
+
+    :func:`~app.create_app` loads one of these classes, any keyword arguments
+    passed to it override the values here.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+
+class Config(object):
+    """
+    **Default settings.**
+
+    Used when running the app directly with ``python app.py``.
+    """
+    # Flask needs a secret key to create session objects, this one is randomly generated
+    # and is used to cryptographically sign user cookies to prevent them being modified
+    SECRET_KEY = ''
+
+    # path of the SQLite database file
+    DATABASE = 'nativesins.db'
+
+    # number of connections each process keeps open, None opens one per request
+    DATABASE_POOL_SIZE = None
+
+    # SQLite pragmas set on every new connection
+    DATABASE_PRAGMAS = {}
+
+    # how many times a write is tried while the database stays busy, and the longest
+    # wait in seconds before the second try, doubling each time, see models.write_transaction
+    DATABASE_WRITE_ATTEMPTS = 8
+    DATABASE_RETRY_DELAY = 0.02
+
+    # number of sorted product lists each process keeps in memory
+    CATALOG_CACHE_SIZE = 16
+
+    # number of catalog API responses each process keeps in memory
+    CATALOG_API_CACHE_SIZE = 256
+
+    # most product names the search box suggests for what has been typed
+    AUTOCOMPLETE_LIMIT = 8
+
+    # serves the home, about, contact and product pages from memory to visitors
+    # who aren't logged in, PAGE_CACHE_SIZE is the number of pages kept
+    PAGE_CACHE = True
+    PAGE_CACHE_SIZE = 128
+
+    # number of rendered template fragments, e.g. product cards, each process keeps
+    FRAGMENT_CACHE_SIZE = 1000
+
+    # folder the compiled templates are saved in so new workers don't compile them
+    # again, None turns this off
+    TEMPLATE_CACHE_FOLDER = 'template_bytecode'
+
+    # folder holding the files that tell every process when a cache is out of date
+    CACHE_STAMP_FOLDER = 'cache_stamps'
+
+    # form posts each IP address, and each account the form names, can make to the
+    # routes that hash passwords or send email, as (requests, seconds)
+    RATE_LIMITS = {
+        'login': (10, 60),
+        'register': (5, 600),
+        'contact': (3, 600),
+    }
+
+    # "memory" counts requests in each process, "sqlite" shares the counts between
+    # processes through the RATE_LIMIT_DATABASE file
+    RATE_LIMIT_BACKEND = 'memory'
+    RATE_LIMIT_DATABASE = 'rate_limits.db'
+
+    # lets visitors fill a basket kept in their session cookie before logging in,
+    # it is only written to the database when they log in
+    SESSION_BASKET = True
+
+    # products bought together with the ones in a basket shown under it,
+    # 0 turns the suggestions off
+    BASKET_SUGGESTIONS = 4
+
+    # minutes an open basket holds the stock in it after it was last changed,
+    # ``manage.py sweep-reservations`` puts the stock from older baskets back
+    RESERVATION_MINUTES = 60
+
+    # stock a size can fall to before the inventory page shows it as low,
+    # used for new products, each size's threshold can be changed on the page
+    LOW_STOCK_THRESHOLD = 5
+
+    # days after being completed or cancelled that ``manage.py archive-orders``
+    # moves an order into the archive tables
+    ARCHIVE_AFTER_DAYS = 180
+
+    # loads the catalog, templates and shipping options when the app is created
+    PREWARM = False
+
+    # file path for the product images
+    UPLOAD_FOLDER = 'static\\img\\product_img'
+
+    RECAPTCHA_PUBLIC_KEY = ''
+    RECAPTCHA_PRIVATE_KEY = ''
+
+    STRIPE_PUB_KEY = ''
+    STRIPE_SECRET_KEY = ''
+    # None uses Stripe's servers, 'http://localhost:12111' uses the fake in fakes.py
+    STRIPE_API_BASE = None
+
+    # "sync" places an order in /pay once the card is charged, "webhook" leaves it to
+    # Stripe's charge.succeeded event, which /stripe_webhook queues and
+    # ``manage.py process-payment-events`` applies, so /pay doesn't wait for it
+    PAYMENT_CONFIRMATION = 'sync'
+
+    # secret Stripe signs the webhook requests with, see payments.read_webhook
+    STRIPE_WEBHOOK_SECRET = ''
+
+    # most queued payment events the consumer applies in one transaction
+    PAYMENT_EVENT_BATCH_SIZE = 100
+
+    # minutes a basket can be being paid for before ``manage.py sweep-reservations``
+    # asks Stripe what happened to its charge, e.g. after the charge timed out
+    PAYMENT_CHECK_MINUTES = 10
+
+    # SMTP settings for outgoing mail
+    MAIL_SERVER = ''
+    MAIL_PORT = 587
+    MAIL_USE_TLS = True
+    MAIL_USERNAME = ''
+    MAIL_PASSWORD = ''
+
+    # seconds each outside service has to answer, and the failures in a row that
+    # stop it being called for reset_seconds, see resilience.py
+    SERVICES = {
+        'stripe': {'timeout': 20, 'failures': 5, 'reset_seconds': 30},
+        'smtp': {'timeout': 10, 'failures': 3, 'reset_seconds': 60},
+    }
+
+
+class ProductionConfig(Config):
+    """
+    **Settings for running behind a preforking WSGI server.**
+
+    Write ahead logging lets the worker processes read while another one writes,
+    the workers share their rate limits, and everything is pre-warmed before the
+    workers are forked.
+    """
+    DATABASE_POOL_SIZE = 8
+    DATABASE_PRAGMAS = {'journal_mode': 'wal'}
+    RATE_LIMIT_BACKEND = 'sqlite'
+    CATALOG_CACHE_SIZE = 64
+    PREWARM = True
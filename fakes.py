@@ -0,0 +1,306 @@
+"""
+    fakes.py has stand-ins for the outside services, run on this machine, for
+    trying out how the shop copes when they are slow or failing.
+
+    Each fake can be told to wait before answering and to fail some of the
+    requests it gets::
+
+        smtp = fakes.FakeSMTPServer(port=1025, delay=2, fail_rate=0.5).start()
+        ...
+        smtp.stop()
+
+    Point the shop at them with ``MAIL_SERVER = 'localhost'``, ``MAIL_PORT = 1025``,
+    ``MAIL_USE_TLS = False`` and ``STRIPE_API_BASE = 'http://localhost:12111'``,
+    or run them with ``python manage.py fake-services``. The fake Stripe can
+    also send signed events for its charges to the shop's webhook.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import hashlib
+import hmac
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+
+class FakeService(object):
+    """
+    **Runs a server on a thread of its own, adding delays and failures.**
+    """
+
+    def __init__(self, port, delay=0.0, fail_rate=0.0):
+        """
+        :param port: port to listen on, 0 picks a free one
+        :param delay: seconds to wait before answering each request
+        :param fail_rate: share of the requests to fail, from 0 to 1
+        """
+        self.delay = delay
+        self.fail_rate = fail_rate
+        # every request answered, newest last
+        self.received = []
+        self.server = self.create_server(port)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def create_server(self, port):
+        raise NotImplementedError
+
+    def should_fail(self):
+        """
+        **Waits for the delay, then decides whether this request fails.**
+
+        :return: True if the request should fail
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        return random.random() < self.fail_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    **Speaks just enough SMTP for smtplib to send a message.**
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        fake = self.server.fake
+        if fake.should_fail():
+            self.reply("421 Service not available")
+            return
+        self.reply("220 localhost fake SMTP")
+        message = {'from': None, 'to': [], 'data': []}
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').rstrip("\r\n")
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                message['from'] = line[10:]
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                message['to'].append(line[8:])
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for data in self.rfile:
+                    if data.rstrip(b"\r\n") == b".":
+                        break
+                    message['data'].append(data.decode('utf-8', 'replace'))
+                fake.received.append(message)
+                message = {'from': None, 'to': [], 'data': []}
+                self.reply("250 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # RSET, NOOP and anything else
+                self.reply("250 OK")
+
+
+class FakeSMTPServer(FakeService):
+    """
+    **SMTP server that keeps the messages it is sent in** ``received``.
+
+    A failed connection is turned away with a 421.
+    """
+
+    def create_server(self, port):
+        return ThreadingTCPServer(('localhost', port), SMTPHandler)
+
+
+class StripeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    **Answers the Stripe API calls the shop makes.**
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        try:
+            self.wfile.write(content)
+        except ConnectionError:
+            # the client gave up waiting
+            pass
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {key: values[0] for key, values in
+                urllib.parse.parse_qs(self.rfile.read(length).decode()).items()}
+        fake.received.append((self.path, form))
+        if fake.should_fail():
+            self.send_json(500, {'error': {'type': 'api_error', 'message': "Fake failure"}})
+            return
+        handler = fake.routes.get(self.path)
+        if handler is None:
+            self.send_json(404, {'error': {'type': 'invalid_request_error',
+                                           'message': "Unrecognized request URL"}})
+            return
+        key = self.headers.get('Idempotency-Key')
+        if key is None:
+            self.send_json(*handler(form))
+            return
+        # like Stripe, a key sent again gets the first answer, unless the
+        # parameters are different
+        with fake.lock:
+            if key not in fake.idempotent:
+                fake.idempotent[key] = (self.path, form, handler(form))
+            path, first_form, answer = fake.idempotent[key]
+        if (path, first_form) != (self.path, form):
+            self.send_json(400, {'error': {'type': 'idempotency_error',
+                                           'message': "Keys for idempotent requests can only be used "
+                                                      "with the same parameters they were first used with."}})
+            return
+        self.send_json(*answer)
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urllib.parse.urlparse(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        fake.received.append((url.path, query))
+        if fake.should_fail():
+            self.send_json(500, {'error': {'type': 'api_error', 'message': "Fake failure"}})
+            return
+        if url.path == '/v1/charges':
+            charges = [charge for charge in reversed(list(fake.charges.values()))
+                       if query.get('customer') in (None, charge['customer'])]
+            self.send_json(200, {'object': 'list', 'url': '/v1/charges', 'has_more': False,
+                                 'data': charges[:int(query.get('limit', 10))]})
+        elif url.path.startswith('/v1/charges/') and url.path[12:] in fake.charges:
+            self.send_json(200, fake.charges[url.path[12:]])
+        else:
+            self.send_json(404, {'error': {'type': 'invalid_request_error',
+                                           'message': "No such object"}})
+
+
+class FakeStripeServer(FakeService):
+    """
+    **Stripe API that creates customers and charges without asking a bank.**
+
+    Paying with the source "tok_chargeDeclined" gets the card declined, like
+    Stripe's own test token.
+
+    Given a ``webhook_url``, each charge is followed by a charge.succeeded or
+    charge.failed event, posted from another thread after ``event_delay``
+    seconds and signed with ``webhook_secret`` the way Stripe signs them.
+    """
+
+    def __init__(self, port, delay=0.0, fail_rate=0.0, webhook_url=None, webhook_secret='', event_delay=0.0):
+        super(FakeStripeServer, self).__init__(port, delay, fail_rate)
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.event_delay = event_delay
+        # every event sent, with the status the webhook answered, newest last
+        self.events = []
+        self.customers = {}
+        # every charge made, declined ones too, by id
+        self.charges = {}
+        # answers kept for each idempotency key
+        self.idempotent = {}
+        self.lock = threading.Lock()
+        self.routes = {
+            '/v1/customers': self.create_customer,
+            '/v1/charges': self.create_charge,
+            '/v1/refunds': self.create_refund,
+        }
+
+    def create_server(self, port):
+        return ThreadingHTTPServer(('localhost', port), StripeHandler)
+
+    def create_customer(self, form):
+        customer = {'id': 'cus_' + uuid.uuid4().hex[:14], 'object': 'customer',
+                    'email': form.get('email'), 'default_source': form.get('source')}
+        self.customers[customer['id']] = customer
+        return 200, customer
+
+    def create_charge(self, form):
+        customer = self.customers.get(form.get('customer'), {})
+        declined = (form.get('source') or customer.get('default_source')) == 'tok_chargeDeclined'
+        charge = {'id': 'ch_' + uuid.uuid4().hex[:14], 'object': 'charge', 'paid': not declined,
+                  'status': 'failed' if declined else 'succeeded', 'amount': int(form.get('amount', 0)),
+                  'currency': form.get('currency'), 'customer': form.get('customer'),
+                  'metadata': {key[9:-1]: value for key, value in form.items() if key.startswith('metadata[')},
+                  'refunded': False}
+        self.charges[charge['id']] = charge
+        self.send_event('charge.failed' if declined else 'charge.succeeded', charge)
+        if declined:
+            return 402, {'error': {'type': 'card_error', 'code': 'card_declined', 'charge': charge['id'],
+                                   'message': "Your card was declined."}}
+        return 200, charge
+
+    def send_event(self, event_type, data):
+        """
+        **Posts a signed event to the webhook from another thread.**
+
+        :param event_type: e.g. "charge.succeeded"
+        :param data: the object the event is about
+        """
+        if not self.webhook_url:
+            return
+        event = {'id': 'evt_' + uuid.uuid4().hex[:14], 'object': 'event', 'type': event_type,
+                 'created': int(time.time()), 'data': {'object': data}}
+        threading.Thread(target=self.post_event, args=(event,), daemon=True).start()
+
+    def post_event(self, event):
+        time.sleep(self.event_delay)
+        payload = json.dumps(event).encode()
+        timestamp = str(int(time.time()))
+        signature = hmac.new(self.webhook_secret.encode(), timestamp.encode() + b"." + payload,
+                             hashlib.sha256).hexdigest()
+        request = urllib.request.Request(self.webhook_url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': 't={},v1={}'.format(timestamp, signature)
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        except OSError:
+            status = None
+        self.events.append((event, status))
+
+    def create_refund(self, form):
+        if form.get('charge') in self.charges:
+            self.charges[form['charge']]['refunded'] = True
+        return 200, {'id': 're_' + uuid.uuid4().hex[:14], 'object': 'refund', 'status': 'succeeded',
+                     'charge': form.get('charge')}
@@ -0,0 +1,30 @@
+"""
+    lazy.py lets modules be imported without running them until they are used.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    **Imports a module the first time one of its attributes is used.**
+
+    The module is registered straight away so later ``import`` statements get
+    the same object, but its code only runs on first attribute access.
+
+    :param name: the module name, e.g. ``'forms'``
+    :return: the module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
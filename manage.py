@@ -0,0 +1,569 @@
+"""
+    manage.py holds the one-off commands for looking after the shop, run from
+    the project folder, e.g.::
+
+        python manage.py init-db
+        python manage.py seed
+        python manage.py sweep-reservations --every 60
+        python manage.py process-payment-events --every 1
+        python manage.py bench-import --runs 20
+        python manage.py bench-checkout --buyers 60 --processes
+        python manage.py check-payments
+        python manage.py fake-services --delay 5
+
+    Commands use the settings in config.py, ``--config`` picks the class.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cache
+import config
+import fakes
+import metrics
+import models
+import payments
+
+# every command, filled in by the command decorator
+COMMANDS = {}
+
+
+def argument(*names, **options):
+    """
+    **Describes a command line option, takes the same arguments as ``add_argument``.**
+    """
+    return names, options
+
+
+def command(name, help_text, *arguments):
+    """
+    **Registers a function as a command.**
+
+    :param name: name typed on the command line
+    :param help_text: description shown by ``--help``
+    :param arguments: options made with :func:`~argument`
+    """
+    def register(function):
+        COMMANDS[name] = (function, help_text, arguments)
+        return function
+    return register
+
+
+def connect(settings):
+    """
+    **Points the models at the database named in the settings.**
+
+    :param settings: settings class from config.py
+    """
+    models.configure_database(
+        settings.DATABASE,
+        pool_size=settings.DATABASE_POOL_SIZE,
+        pragmas=settings.DATABASE_PRAGMAS
+    )
+
+
+def settings_dict(settings):
+    """
+    **Turns a settings class into a dictionary like the Flask config.**
+
+    :param settings: settings class from config.py
+    :return: dictionary of the upper case settings
+    """
+    return {name: getattr(settings, name) for name in dir(settings) if name.isupper()}
+
+
+@command('init-db', 'create any missing tables, columns and indexes')
+def init_db(settings, args):
+    connect(settings)
+    added = models.initialize()
+    for column in added:
+        print("Added column " + column)
+    print("Tables created")
+    if 'order.item_count' in added:
+        print("Run check-basket-counts --repair to fill in the new order counts")
+
+
+@command('seed', 'create the admin user and shipping options if they are missing')
+def seed(settings, args):
+    connect(settings)
+    models.seed_defaults()
+    print("Defaults created")
+
+
+@command('backfill-rollups', 'rebuild the sales rollup tables from the order history')
+def backfill_rollups(settings, args):
+    connect(settings)
+    models.initialize()
+    models.rebuild_rollups()
+    print("Rollups rebuilt")
+
+
+@command('backfill-co-purchases', 'rebuild the products bought together from the order history')
+def backfill_co_purchases(settings, args):
+    connect(settings)
+    models.initialize()
+    models.CoPurchase.rebuild()
+    print("Co-purchases rebuilt")
+
+
+@command('clear-page-cache', 'make every worker re-render its cached pages, e.g. after a template changes')
+def clear_page_cache(settings, args):
+    cache.configure(settings_dict(settings))
+    cache.pages.invalidate_content()
+    print("Page cache cleared")
+
+
+@command('sweep-reservations', 'finish stuck payments and put the stock held by abandoned baskets back on sale',
+         argument('--every', type=float, default=None,
+                  help="keep running, sweeping every this many seconds"),
+         argument('--batch-size', type=int, default=500))
+def sweep_reservations(settings, args):
+    # stuck payments are looked up through Stripe with the app's settings and breakers
+    import app
+    app.create_app(settings)
+    stripe = app.get_stripe()
+    while True:
+        start = time.perf_counter()
+        started_before = datetime.datetime.now() - datetime.timedelta(minutes=settings.PAYMENT_CHECK_MINUTES)
+        outcomes = payments.check_pending_payments(stripe, started_before)
+        for charge_id in outcomes.pop('unrefunded'):
+            print("Charge {} couldn't be refunded, it needs refunding by hand".format(charge_id))
+        if any(outcomes.values()):
+            print("Stuck payments: " + ", ".join("{} {}".format(count, outcome)
+                                                 for outcome, count in sorted(outcomes.items())))
+        lines, units = models.OrderLine.release_expired(batch_size=args.batch_size)
+        print("{}: removed {} lines, {} units back in stock in {:.1f}ms".format(
+            datetime.datetime.now().strftime('%d/%m/%y %H:%M:%S'), lines, units,
+            (time.perf_counter() - start) * 1000))
+        # running totals since the command started
+        print(json.dumps(metrics.registry.snapshot(), sort_keys=True))
+        if args.every is None:
+            break
+        time.sleep(args.every)
+
+
+@command('process-payment-events', 'place the orders paid for by the events queued by the Stripe webhook',
+         argument('--every', type=float, default=None,
+                  help="keep running, checking the queue every this many seconds"),
+         argument('--batch-size', type=int, default=None,
+                  help="events applied in one transaction, defaults to PAYMENT_EVENT_BATCH_SIZE"))
+def process_payment_events(settings, args):
+    # refunds go through Stripe with the app's settings and breakers
+    import app
+    app.create_app(settings)
+    stripe = app.get_stripe()
+    batch_size = args.batch_size or settings.PAYMENT_EVENT_BATCH_SIZE
+    while True:
+        start = time.perf_counter()
+        taken = payments.process_payment_events(stripe, batch_size)
+        models.db.close()
+        if taken:
+            print("{}: processed {} events in {:.1f}ms".format(
+                datetime.datetime.now().strftime('%d/%m/%y %H:%M:%S'), taken,
+                (time.perf_counter() - start) * 1000))
+        if taken == batch_size:
+            # there may be more waiting
+            continue
+        if args.every is None:
+            break
+        time.sleep(args.every)
+    print(json.dumps(metrics.registry.snapshot(), sort_keys=True))
+
+
+@command('archive-orders', 'move old completed and cancelled orders into the archive tables',
+         argument('--days', type=int, default=None,
+                  help="archive orders closed more than this many days ago, defaults to ARCHIVE_AFTER_DAYS"),
+         argument('--batch-size', type=int, default=500))
+def archive_orders(settings, args):
+    connect(settings)
+    days = args.days if args.days is not None else settings.ARCHIVE_AFTER_DAYS
+    older_than = datetime.datetime.now() - datetime.timedelta(days=days)
+    moved = models.ArchivedOrder.archive_orders(older_than, batch_size=args.batch_size)
+    print("Archived {} orders closed before {}".format(moved, older_than.strftime('%d/%m/%y')))
+
+
+@command('check-basket-counts', 'find orders whose item and line counts have drifted from their lines',
+         argument('--repair', action='store_true', help="recount the orders that are wrong"))
+def check_basket_counts(settings, args):
+    connect(settings)
+    drift = models.Order.find_count_drift()
+    for order_id, item_count, line_count, items, lines in drift:
+        print("Order {}: {} items in {} lines, counted {} items in {} lines".format(
+            order_id, item_count, line_count, items, lines))
+    print("{} order(s) wrong".format(len(drift)))
+    if drift and args.repair:
+        with models.db.atomic():
+            models.Order.update_order_totals([row[0] for row in drift])
+        print("Repaired")
+    elif drift:
+        return 1
+
+
+def time_import(module):
+    """
+    **Times a fresh interpreter importing a module.**
+
+    :param module: name of the module to import
+    :return: seconds taken, not counting the interpreter starting up
+    """
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import ' + module])
+    with_import = time.perf_counter() - start
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'pass'])
+    return with_import - (time.perf_counter() - start)
+
+
+def slowest_imports(module, count):
+    """
+    **Lists the modules that took longest to import, using ``-X importtime``.**
+
+    :param module: name of the module to import
+    :param count: how many to return
+    :return: list of (microseconds, module name), slowest first
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:count]
+
+
+@command('bench-import', 'measure how long a cold start takes to import the app',
+         argument('--module', default='app'),
+         argument('--runs', type=int, default=10),
+         argument('--max-ms', type=float, default=None,
+                  help="exit with an error if the median is slower than this"))
+def bench_import(settings, args):
+    timings = [time_import(args.module) for run in range(args.runs)]
+    median = statistics.median(timings) * 1000
+    print("import {}: median {:.1f}ms, best {:.1f}ms over {} runs".format(
+        args.module, median, min(timings) * 1000, args.runs))
+    for microseconds, name in slowest_imports(args.module, 10):
+        print("  {:>8.1f}ms  {}".format(microseconds / 1000, name))
+    if args.max_ms is not None and median > args.max_ms:
+        print("Import took longer than {}ms".format(args.max_ms))
+        return 1
+
+
+def bench_connect(path, settings):
+    """
+    **Points a benchmark worker process at the benchmark database.**
+
+    :param path: path of the benchmark database
+    :param settings: dictionary of the settings, see :func:`~settings_dict`
+    """
+    models.configure_database(path, pragmas=settings['DATABASE_PRAGMAS'])
+    cache.configure(settings)
+    models.write_attempts = settings['DATABASE_WRITE_ATTEMPTS']
+    models.write_retry_delay = settings['DATABASE_RETRY_DELAY']
+
+
+def bench_buyer(job):
+    """
+    **Buys the benchmark product a few times, the way the shop does at checkout.**
+
+    Each purchase adds to the basket and places the order, two write transactions.
+
+    :param job: tuple of (user id, product id, purchases, largest quantity)
+    :return: dictionary with the orders placed, units bought, purchases turned
+             away for lack of stock, purchases that failed, and the retries made
+             in this process while it ran
+    """
+    user_id, product_id, purchases, max_quantity = job
+    retries = metrics.registry.snapshot()['counters'].get('db.write_retries', 0)
+    result = {'orders': 0, 'units': 0, 'sold_out': 0, 'failed': 0}
+    models.db.connect()
+    try:
+        user = models.User.get(models.User.id == user_id)
+        for purchase in range(purchases):
+            quantity = random.randint(1, max_quantity)
+            try:
+                state = models.Order.apply_basket_operations(user, None, [
+                    {'op': 'add', 'product_id': product_id, 'size': 'one_size', 'quantity': quantity}
+                ])
+                if state['errors']:
+                    result['sold_out'] += 1
+                    continue
+                models.Order.place_order(state['order_id'])
+            except models.OperationalError:
+                result['failed'] += 1
+                continue
+            result['orders'] += 1
+            result['units'] += quantity
+    finally:
+        models.db.close()
+    result['retries'] = metrics.registry.snapshot()['counters'].get('db.write_retries', 0) - retries
+    return result
+
+
+@command('bench-checkout', 'check that buyers racing for the same stock never oversell it',
+         argument('--buyers', type=int, default=60),
+         argument('--purchases', type=int, default=5, help="purchases each buyer tries to make"),
+         argument('--stock', type=int, default=300),
+         argument('--max-quantity', type=int, default=3),
+         argument('--processes', action='store_true',
+                  help="run each buyer in a process of its own instead of a thread"))
+def bench_checkout(settings, args):
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'bench.db')
+    options = settings_dict(settings)
+    # keeps the benchmark from clearing the shop's cached pages
+    options['CACHE_STAMP_FOLDER'] = os.path.join(folder, 'cache_stamps')
+    try:
+        bench_connect(path, options)
+        models.initialize()
+        models.db.connect()
+        models.seed_defaults()
+        models.User.insert_many([{
+            'first_name': "Buyer",
+            'last_name': str(number),
+            'email_address': "buyer{}@example.com".format(number),
+            'password': ""
+        } for number in range(args.buyers)]).execute()
+        product = models.Product.create_product("hat", "Bench", 1000, "", args.stock, 0, 0, 0)
+        jobs = [(user_id, product.id, args.purchases, args.max_quantity) for user_id, in
+                models.User.select(models.User.id).where(models.User.first_name == "Buyer").tuples()]
+        models.db.close()
+
+        retries = metrics.registry.snapshot()['counters'].get('db.write_retries', 0)
+        start = time.perf_counter()
+        if args.processes:
+            with multiprocessing.Pool(args.buyers, bench_connect, (path, options)) as pool:
+                results = pool.map(bench_buyer, jobs, chunksize=1)
+        else:
+            results = [None] * len(jobs)
+
+            def run(number):
+                results[number] = bench_buyer(jobs[number])
+            threads = [threading.Thread(target=run, args=(number,)) for number in range(len(jobs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+        if args.processes:
+            retries = sum(result['retries'] for result in results)
+        else:
+            # the threads share the counters, so each result has the others' retries too
+            retries = metrics.registry.snapshot()['counters'].get('db.write_retries', 0) - retries
+
+        models.db.connect()
+        left = models.Product.get(models.Product.id == product.id).one_size_stock
+        level = models.StockLevel.get(models.StockLevel.product == product.id).stock
+        # a purchase that failed after adding to the basket leaves its stock held there
+        taken = dict(models.OrderLine.select(models.Order.order_status, models.fn.SUM(models.OrderLine.quantity))
+                     .join(models.Order)
+                     .where(models.OrderLine.product == product.id)
+                     .group_by(models.Order.order_status)
+                     .tuples())
+        models.db.close()
+    finally:
+        if not models.db.is_closed():
+            models.db.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    totals = {name: sum(result[name] for result in results) for name in ('orders', 'units', 'sold_out', 'failed')}
+    sold, held = taken.get("placed", 0), taken.get("open", 0)
+    print("{} buyers in {}: {} orders in {:.2f}s, {:.1f} orders/s".format(
+        args.buyers, "processes" if args.processes else "threads", totals['orders'], elapsed,
+        totals['orders'] / elapsed))
+    print("{} of {} units sold, {} held in baskets, {} left".format(sold, args.stock, held, left))
+    print("{} purchases turned away, {} retries, {} failed".format(totals['sold_out'], retries, totals['failed']))
+    if left < 0 or sold + held + left != args.stock or level != left or sold != totals['units']:
+        print("Stock doesn't add up, {} units in the stock levels".format(level))
+        return 1
+
+
+def wait_for_events(stripe_server, count, timeout=10.0):
+    """
+    **Waits for the fake Stripe to have sent a number of events.**
+
+    :param stripe_server: the :class:`~fakes.FakeStripeServer`
+    :param count: events wanted
+    :param timeout: most seconds to wait
+    :return: True if they were sent in time
+    """
+    deadline = time.time() + timeout
+    while len(stripe_server.events) < count:
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@command('check-payments', 'check that charge events sent to the webhook place each order once, using the fake Stripe')
+def check_payments(settings, args):
+    # the events go through the apps own webhook route, served on a thread
+    from werkzeug.serving import make_server
+    import app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    folder = tempfile.mkdtemp()
+    secret = 'whsec_check'
+    stripe_server = fakes.FakeStripeServer(0, webhook_secret=secret).start()
+    web_server = None
+    problems = []
+
+    def expect(description, passed):
+        print("{} {}".format("ok  " if passed else "FAIL", description))
+        if not passed:
+            problems.append(description)
+
+    try:
+        shop = app.create_app(
+            settings,
+            DATABASE=os.path.join(folder, 'check.db'),
+            DATABASE_POOL_SIZE=None,
+            # keeps the check from clearing the shop's cached pages
+            CACHE_STAMP_FOLDER=os.path.join(folder, 'cache_stamps'),
+            TEMPLATE_CACHE_FOLDER=os.path.join(folder, 'template_bytecode'),
+            PREWARM=False,
+            STRIPE_API_BASE='http://localhost:{}'.format(stripe_server.port),
+            STRIPE_SECRET_KEY='sk_test_check',
+            STRIPE_WEBHOOK_SECRET=secret
+        )
+        models.initialize()
+        models.seed_defaults()
+        user = models.User.create(first_name="Check", last_name="Payments",
+                                  email_address="check@example.com", password="")
+        product = models.Product.create_product("hat", "Check", 1000, "", 10, 0, 0, 0)
+        models.db.close()
+        web_server = make_server('localhost', 0, shop, threaded=True)
+        threading.Thread(target=web_server.serve_forever, daemon=True).start()
+        stripe_server.webhook_url = 'http://localhost:{}/stripe_webhook'.format(web_server.server_port)
+        stripe = app.get_stripe()
+
+        def add_to_basket(quantity):
+            return models.Order.apply_basket_operations(user, None, [
+                {'op': 'add', 'product_id': product.id, 'size': 'one_size', 'quantity': quantity}
+            ])['order_id']
+
+        def pay(order_id):
+            try:
+                payments.pay_for_order(order_id, user.email_address, 'tok_visa', stripe, wait_for_event=True)
+            except payments.CheckoutError as error:
+                expect("paying for the basket: {}".format(error), False)
+
+        def last_charge():
+            return stripe_server.charges[stripe_server.events[-1][0]['data']['object']['id']]
+
+        # the event places the order, and the same event sent again changes nothing
+        order_id = add_to_basket(2)
+        pay(order_id)
+        expect("the charge's event reached the webhook", wait_for_events(stripe_server, 1))
+        payments.process_payment_events(stripe)
+        expect("the event placed the order", models.Order.get_by_id(order_id).order_status == "placed")
+        event, status = stripe_server.events[0]
+        stripe_server.post_event(event)
+        stripe_server.post_event(dict(event, id=event['id'] + '_resent'))
+        expect("the webhook accepted the repeated events",
+               [status for event, status in stripe_server.events[1:]] == [200, 200])
+        expect("only the repeat with a new id was queued", payments.process_payment_events(stripe) == 1)
+        charge = stripe_server.charges[event['data']['object']['id']]
+        expect("the repeats didn't refund the charge", not charge['refunded'])
+        expect("the order was only counted once", models.OrderStatusCount.get(
+            models.OrderStatusCount.order_status == "placed").orders == 1)
+
+        # a basket changed after it was charged gets a refund and can be paid for again
+        order_id = add_to_basket(1)
+        pay(order_id)
+        add_to_basket(1)
+        expect("the changed basket's event reached the webhook", wait_for_events(stripe_server, 4))
+        payments.process_payment_events(stripe)
+        order = models.Order.get_by_id(order_id)
+        expect("the charge for the changed basket was refunded", last_charge()['refunded'])
+        expect("the changed basket can be paid for again", order.order_status == "open" and
+               order.payment_reference is None and order.payment_started_on is None)
+
+        # a charge whose event is lost is found by the sweeper
+        stripe_server.webhook_url = None
+        pay(order_id)
+        outcomes = payments.check_pending_payments(stripe, datetime.datetime.now() + datetime.timedelta(minutes=1))
+        expect("the sweeper placed the order whose event was lost",
+               outcomes['placed'] == 1 and models.Order.get_by_id(order_id).order_status == "placed")
+
+        sold = models.OrderLine.select(models.fn.SUM(models.OrderLine.quantity))\
+            .join(models.Order)\
+            .where(models.Order.order_status == "placed")\
+            .scalar()
+        left = models.Product.get_by_id(product.id).one_size_stock
+        expect("the stock adds up, {} sold and {} left".format(sold, left), sold == 4 and left == 6)
+    finally:
+        if web_server is not None:
+            web_server.shutdown()
+        stripe_server.stop()
+        if not models.db.is_closed():
+            models.db.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if problems:
+        print("{} check(s) failed".format(len(problems)))
+        return 1
+    print("Payments checked")
+
+
+@command('fake-services', 'run stand-ins for Stripe and the SMTP server until stopped with Ctrl+C',
+         argument('--stripe-port', type=int, default=12111),
+         argument('--smtp-port', type=int, default=1025),
+         argument('--delay', type=float, default=0.0, help="seconds to wait before answering"),
+         argument('--fail-rate', type=float, default=0.0, help="share of requests to fail, from 0 to 1"),
+         argument('--webhook-url', default=None,
+                  help="where to send charge events, e.g. http://localhost:5000/stripe_webhook"))
+def fake_services(settings, args):
+    stripe = fakes.FakeStripeServer(args.stripe_port, args.delay, args.fail_rate,
+                                    webhook_url=args.webhook_url,
+                                    webhook_secret=settings.STRIPE_WEBHOOK_SECRET).start()
+    smtp = fakes.FakeSMTPServer(args.smtp_port, args.delay, args.fail_rate).start()
+    print("Set STRIPE_API_BASE = 'http://localhost:{}'".format(stripe.port))
+    print("Set MAIL_SERVER = 'localhost', MAIL_PORT = {}, MAIL_USE_TLS = False".format(smtp.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stripe.stop()
+        smtp.stop()
+    print("{} Stripe requests, {} emails".format(len(stripe.received), len(smtp.received)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Native Sins management commands")
+    parser.add_argument('--config', default='Config', help="settings class in config.py")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    for name, (function, help_text, arguments) in sorted(COMMANDS.items()):
+        subparser = subparsers.add_parser(name, help=help_text)
+        for names, options in arguments:
+            subparser.add_argument(*names, **options)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = getattr(config, args.config)
+    function, help_text, arguments = COMMANDS[args.command]
+    return function(settings, args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
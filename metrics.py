@@ -0,0 +1,88 @@
+"""
+    metrics.py keeps counters and timings for the current process, e.g. how much
+    stock the reservation sweeper has put back and how long it took.
+
+    Names are dotted strings grouped by what they measure::
+
+        metrics.registry.increment('reservations.reclaimed_units', 3)
+        with metrics.registry.timer('reservations.sweep_seconds'):
+            ...
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import contextlib
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    **Counters and timings, safe to update from several threads.**
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        """
+        **Adds to a counter.**
+
+        :param name: name of the counter
+        :param amount: amount to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """
+        **Records how long something took.**
+
+        :param name: name of the timing
+        :param seconds: time taken
+        """
+        with self._lock:
+            count, total, slowest = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (count + 1, total + seconds, max(slowest, seconds))
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        **Records how long the code in a with block takes.**
+
+        :param name: name of the timing
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        **Returns every metric as plain data, ready to be sent as JSON.**
+
+        :return: dictionary of counters and timings, each timing has its count,
+                 total, mean and max in seconds
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: {
+                'count': count,
+                'total': round(total, 6),
+                'mean': round(total / count, 6),
+                'max': round(slowest, 6)
+            } for name, (count, total, slowest) in self._timings.items()}
+        return {'counters': counters, 'timings': timings}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+# metrics for this process
+registry = Metrics()
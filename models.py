@@ -1,467 +1,2348 @@
-import datetime
-from peewee import *
-from flask_login import UserMixin
-from flask_bcrypt import generate_password_hash
-import csv
-import uuid
-
-db = SqliteDatabase('nativesins.db')
-
-
-class BaseModel(Model):
-    class Meta:
-        database = db
-
-
-class User(UserMixin, BaseModel):
-    """
-    **User class.**
-
-    Used as a model for the database, containing methods to be performed on user objects.
-    """
-    id = PrimaryKeyField()
-    first_name = CharField()
-    last_name = CharField()
-    email_address = CharField(unique=True)
-    password = CharField(max_length=100)
-    user_role = CharField(default='customer')
-    date_created = DateTimeField(default=datetime.datetime.now)
-
-    @classmethod
-    def create_user(cls, first_name, last_name, email_address, password, user_role):
-        """
-        **Creates user.**
-
-        Takes in parameters and uses them to create a row in the user table of the database.
-        It takes in a plain text password but hashes it before inputting to the database.
-
-        :param first_name: users first name
-        :param last_name: user last name
-        :param email_address: users email address
-        :param password: users password (plain text)
-        :param user_role: the role of the user (determines permissions)
-        :return:
-        """
-        try:
-            cls.create(
-                first_name=first_name,
-                last_name=last_name,
-                email_address=email_address,
-                password=generate_password_hash(password),
-                user_role=user_role
-            )
-        except IntegrityError:
-            raise ValueError("User already exists")
-
-    @classmethod
-    def edit_details(cls, user_id, first_name, last_name, email_address):
-        try:
-            query = cls.update(
-                first_name=first_name,
-                last_name=last_name,
-                email_address=email_address
-            ).where(cls.id == user_id)
-            query.execute()
-        except IntegrityError:
-            raise ValueError("User with that email address already exists")
-
-    @classmethod
-    def reset_password(cls, user_id, password):
-        query = cls.update(
-            password=generate_password_hash(password)
-        ).where(cls.id == user_id)
-        query.execute()
-
-    @classmethod
-    def generate_user_report(cls, start_date, end_date):
-        start_date = datetime.datetime.combine(start_date, datetime.time())
-        end_date = datetime.datetime.combine(end_date, datetime.time())
-        users = cls.select().where(cls.date_created >= start_date, cls.date_created <= end_date)
-        if not users.exists():
-            return None
-        else:
-            fieldnames = []
-            file_name = uuid.uuid4().hex + '.csv'
-            for key in users[0].__data__:
-                if key != 'password':
-                    fieldnames.append(key)
-            with open('static\\tmp_reports\\' + file_name, 'w+', newline='') as report:
-                writer = csv.DictWriter(report, fieldnames=fieldnames)
-                writer.writeheader()
-                for user in users:
-                    user_dict = dict(user.__data__.items())
-                    user_dict.pop('password', None)
-                    user_dict.update({'date_created':user.date_created.strftime('%d/%m/%y %H:%M:%S')})
-                    writer.writerow(user_dict)
-            return file_name
-
-
-class AddressDetails(BaseModel):
-    id = PrimaryKeyField()
-    user_id = ForeignKeyField(User, related_name='address')
-    address_line_1 = CharField()
-    address_line_2 = CharField()
-    town = CharField()
-    city = CharField()
-    postcode = CharField()
-    default = BooleanField(default=False)
-
-    @classmethod
-    def add_address(cls, user_id, address_line_1, address_line_2, town, city, postcode):
-        cls.create(
-            user_id=user_id,
-            address_line_1=address_line_1,
-            address_line_2=address_line_2,
-            town=town,
-            city=city,
-            postcode=postcode
-        )
-        return cls.id
-
-    @classmethod
-    def edit_address(cls, address_id, address_line_1, address_line_2, town, city, postcode):
-        query = cls.update(
-            address_line_1=address_line_1,
-            address_line_2=address_line_2,
-            town=town,
-            city=city,
-            postcode=postcode
-        ).where(cls.id == address_id)
-        query.execute()
-
-    @classmethod
-    def delete_address(cls, address_id):
-        address = cls.get(cls.id == address_id)
-        address.delete_instance()
-
-    @classmethod
-    def get_default_address(cls, user_id):
-        default_address = None
-        address_query = cls.select().where(cls.user_id == user_id)
-        if address_query.exists() and address_query is not None:
-            for address in address_query:
-                if address.default is True:
-                    default_address = address
-        return default_address
-
-    @classmethod
-    def change_default(cls, new_default_id, user_id):
-        old_default = cls.get_default_address(user_id)
-        new_default = cls.get(cls.id == new_default_id)
-        if old_default is None:
-            new_default.default = True
-            new_default.save()
-        else:
-            old_default.default = False
-            new_default.default = True
-            old_default.save()
-            new_default.save()
-
-
-class Product(BaseModel):
-    id = PrimaryKeyField()
-    product_category = CharField()
-    product_name = CharField()
-    product_price = DecimalField(default=0)
-    product_description = CharField()
-    product_image_path = CharField(null=True)
-    one_size_stock = IntegerField(default=0)
-    small_stock = IntegerField(default=0)
-    medium_stock = IntegerField(default=0)
-    large_stock = IntegerField(default=0)
-    date_created = DateTimeField(default=datetime.datetime.now)
-    # create attribute to contain uploaded image location
-
-    @classmethod
-    def create_product(cls, product_category, product_name, product_price, product_description, one_size_stock,
-                       small_stock, medium_stock, large_stock):
-        try:
-            cls.create(
-                product_category=product_category,
-                product_name=product_name,
-                product_price=product_price,
-                product_description=product_description,
-                one_size_stock=one_size_stock,
-                small_stock=small_stock,
-                medium_stock=medium_stock,
-                large_stock=large_stock
-            )
-        except IntegrityError:
-            raise ValueError("T-Shirt with this name exists")
-
-    @classmethod
-    def add_image(cls, id, product_image_path):
-        product = cls.get(cls.id == id)
-        product.product_image_path = product_image_path
-        product.save()
-
-    @classmethod
-    def increase_tshirt_stock(cls, product_id, quantity, size):
-        product = Product.get(Product.id == product_id)
-        if size == "small":
-            product.small_stock += quantity
-        elif size == "medium":
-            product.medium_stock += quantity
-        elif size == "large":
-            product.large_stock += quantity
-        product.save()
-
-    @classmethod
-    def reduce_tshirt_stock(cls, product_id, quantity, size):
-        product = Product.get(Product.id == product_id)
-        if size == "small":
-            product.small_stock -= quantity
-        elif size == "medium":
-            product.medium_stock -= quantity
-        elif size == "large":
-            product.large_stock -= quantity
-        product.save()
-
-    @classmethod
-    def increase_other_stock(cls, product_id, quantity):
-        product = Product.get(Product.id == product_id)
-        product.one_size_stock += quantity
-        product.save()
-
-    @classmethod
-    def reduce_other_stock(cls, product_id, quantity):
-        product = Product.get(Product.id == product_id)
-        product.one_size_stock -= quantity
-        product.save()
-
-    @classmethod
-    def tshirt__in_stock(cls, quantity, product_id, size):
-        product = Product.get(Product.id == product_id)
-        if size == "small":
-            if quantity > product.small_stock:
-                return False
-            else:
-                return True
-        elif size == "medium":
-                if quantity > product.medium_stock:
-                    return False
-                else:
-                    return True
-        elif size == "large":
-                if quantity > product.large_stock:
-                    return False
-                else:
-                    return True
-
-    @classmethod
-    def other_in_stock(cls, quantity, product_id):
-        product = Product.get(Product.id == product_id)
-        if quantity > product.one_size_stock:
-            return False
-        else:
-            return True
-
-
-class ShippingOption(BaseModel):
-    id = PrimaryKeyField()
-    name = CharField()
-    cost = DecimalField()
-
-    @classmethod
-    def create_shipping_option(cls, name, cost):
-        cls.create(
-            name=name,
-            cost=cost
-        )
-
-
-class Order(BaseModel):
-    id = PrimaryKeyField()
-    user = ForeignKeyField(User, related_name='orders')
-    address = ForeignKeyField(AddressDetails, related_name='address', null=True)
-    shipping = ForeignKeyField(ShippingOption, related_name='shipping', null=True, default=1)
-    order_status = CharField(default="open")
-    order_placed_on = DateTimeField(null=True)
-    order_dispatched_on = DateTimeField(null=True)
-    order_completed_on = DateTimeField(null=True)
-    order_cancelled_on = DateTimeField(null=True)
-    order_total = DecimalField(default=0)
-
-    @classmethod
-    def update_order_total(cls, order_id):
-        total = 0
-        order_lines = OrderLine.select().where(OrderLine.order == order_id)
-        for line in order_lines:
-            product = Product.get(Product.id == line.product_id)
-            price = product.product_price*line.quantity
-            total += price
-        order = Order.get(Order.id == order_id)
-        order.order_total = total
-        order.save()
-
-    @classmethod
-    def create_order(cls, user):
-        cls.create(user=user)
-
-    @classmethod
-    def create_order_with_address(cls, user, address):
-        cls.create(
-            user=user,
-            address=address
-        )
-
-    @classmethod
-    def add_address_to_order(cls, order_id, address):
-        order = cls.get(cls.id == order_id)
-        order.address = address
-        order.save()
-
-    @classmethod
-    def find_current_order(cls, user):
-        if user.is_authenticated:
-            orders = user.orders.select().where(cls.user == user.id)
-            for order in orders:
-                if order.order_status == "open":
-                    return order
-            else:
-                return None
-        else:
-            return None
-
-    @classmethod
-    def place_order(cls, order_id):
-        order = cls.get(cls.id == order_id)
-        order.order_status = "placed"
-        order.order_placed_on = datetime.datetime.now()
-        order.save()
-
-    @classmethod
-    def dispatch_order(cls, order_id):
-        order = cls.get(cls.id == order_id)
-        order.order_status = "dispatched"
-        order.order_dispatched_on = datetime.datetime.now()
-        order.save()
-
-    @classmethod
-    def complete_order(cls, order_id):
-        order = cls.get(cls.id == order_id)
-        order.order_status = "complete"
-        order.order_completed_on = datetime.datetime.now()
-        order.save()
-
-    @classmethod
-    def cancel_order(cls, order_id):
-        order = cls.get(cls.id == order_id)
-        order.order_status = "cancelled"
-        order.order_placed_on = None
-        order.order_cancelled_on = datetime.datetime.now()
-        order.save()
-
-    @classmethod
-    def get_current_basket(cls, order, user):
-        if user.is_authenticated and order is not None:
-            current_basket = 0
-            for line in order.order_lines:
-                current_basket += line.quantity
-            return current_basket
-        else:
-            return None
-
-    @classmethod
-    def check_order_status(cls, user_id):
-        orders = cls.select().where(cls.user == user_id)
-        for order in orders:
-            if order.order_status == "placed":
-                if order.order_placed_on + datetime.timedelta(minutes=15) < datetime.datetime.now():
-                    cls.dispatch_order(order.id)
-            if order.order_status == "dispatched":
-                if order.order_placed_on + datetime.timedelta(minutes=30) < datetime.datetime.now():
-                    cls.complete_order(order.id)
-
-    @classmethod
-    def change_shipping(cls, shipping_id, order_id):
-        order = cls.get(cls.id == order_id)
-        order.shipping_id = shipping_id
-        order.save()
-
-    @classmethod
-    def generate_order_report(cls, start_date, end_date):
-        start_date = datetime.datetime.combine(start_date, datetime.time())
-        end_date = datetime.datetime.combine(end_date, datetime.time())
-        orders = cls.select().where(cls.order_placed_on >= start_date, cls.order_placed_on <= end_date)
-        if not orders.exists():
-            return None
-        else:
-            fieldnames = []
-            file_name = uuid.uuid4().hex + '.csv'
-            for key in orders[0].__data__:
-                if key != 'order_cancelled_on':
-                    if key == 'address':
-                        fieldnames.extend(['shipping_address_line_1', 'shipping_address_line_2',
-                                           'shipping_address_city', 'shipping_address_postcode'])
-                    elif key == 'shipping':
-                        fieldnames.append('shipping_option')
-                    else:
-                        fieldnames.append(key)
-            with open('static\\tmp_reports\\' + file_name, 'w+', newline='') as report:
-                writer = csv.DictWriter(report, fieldnames=fieldnames)
-                writer.writeheader()
-                for order in orders:
-                    order_dict = dict(order.__data__.items())
-                    address = AddressDetails.get(AddressDetails.id == order.address)
-                    shipping = ShippingOption.get(ShippingOption.id == order.shipping)
-                    user = User.get(User.id == order.user)
-                    order_dict.pop('order_cancelled_on', None)
-                    order_dict.pop('address', None)
-                    order_dict.pop('shipping', None)
-                    order_dict.update({
-                        'user': user.email_address,
-                        'shipping_address_line_1': address.address_line_1,
-                        'shipping_address_line_2': address.address_line_2,
-                        'shipping_address_city': address.city,
-                        'shipping_address_postcode': address.postcode,
-                        'shipping_option': shipping.name
-                    })
-                    order_dict.update({'order_placed_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
-                    order_dict.update({'order_dispatched_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
-                    order_dict.update({'order_completed_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
-                    writer.writerow(order_dict)
-            return file_name
-
-
-class OrderLine(Model):
-    id = PrimaryKeyField()
-    product = ForeignKeyField(Product, related_name='order_line')
-    order = ForeignKeyField(Order, related_name='order_lines')
-    quantity = IntegerField(default=0)
-    size = CharField()
-
-    class Meta:
-        database = db
-
-    @classmethod
-    def create_order_line(cls, product, order, quantity, size):
-        cls.create(
-            product=product,
-            order=order,
-            quantity=quantity,
-            size=size
-        )
-
-    @classmethod
-    def remove_order_line(cls, order_line_id):
-        order_line = cls.get(id=order_line_id)
-        order_line.delete_instance()
-
-    @classmethod
-    def increase_line_quantity(cls, order_line_id, quantity_to_add):
-        new_quantity = cls.quantity + quantity_to_add
-        order_line = cls(id=order_line_id, quantity=new_quantity)
-        order_line.save()
-
-    @classmethod
-    def edit_line_quantity(cls, order_line_id, new_quantity):
-        order_line = cls(id=order_line_id, quantity=new_quantity)
-        order_line.save()
-
-
-def initialize():
-    db.connect()
-    db.create_tables([User, AddressDetails, ShippingOption, Product, Order, OrderLine], safe=True)
-    db.close()
-
+import datetime
+from peewee import *
+from flask_login import UserMixin
+from flask_bcrypt import generate_password_hash
+import csv
+import decimal
+import functools
+import io
+import random
+import threading
+import time
+import uuid
+
+import cache
+import metrics
+import money
+
+db = SqliteDatabase('nativesins.db')
+
+# stock a size can fall to before it shows as low on the inventory page,
+# set from LOW_STOCK_THRESHOLD by create_app, see StockLevel
+low_stock_threshold = 5
+
+# how long a basket holds the stock it has taken, set from RESERVATION_MINUTES
+# by create_app, see OrderLine.release_expired
+reservation_time = datetime.timedelta(minutes=60)
+
+# how many times a write is tried while another connection holds the database, and
+# the longest wait in seconds before the second try, set by create_app, see write_transaction
+write_attempts = 8
+write_retry_delay = 0.02
+
+# functions waiting for the write transaction running on each thread to commit, see after_commit
+_commit_callbacks = threading.local()
+
+
+class IdentityMap(object):
+    """
+    **Rows already loaded during the current request, keyed by model and primary key.**
+
+    A request often looks up the same row more than once, e.g. a route checks
+    who an order belongs to and then a model method loads the order again to
+    change it. While a request is running, :func:`~BaseModel.get_by_id` hands
+    back the instance it loaded the first time instead of asking the database.
+
+    Saving an instance puts it in the map, deleting it takes it out, and an
+    UPDATE or DELETE query run on a model forgets every row of that model, as
+    any of them could have changed. A write transaction forgets everything
+    when it begins, so the rows it changes are read again under the write
+    lock, and again if it fails. Each thread has its own map, which only
+    exists between :func:`~begin` and :func:`~end`, so commands and background
+    threads always read from the database.
+
+    Every lookup answered from the map adds one to the
+    ``identity_map.lookups_saved`` metric.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def _rows(self):
+        return getattr(self._local, 'rows', None)
+
+    def begin(self):
+        """
+        **Starts an empty map, called when a request starts.**
+        """
+        self._local.rows = {}
+        self._local.saved = 0
+
+    def end(self):
+        """
+        **Throws the map away, called when a request ends.**
+
+        :return: number of lookups answered from the map
+        """
+        saved = getattr(self._local, 'saved', 0)
+        self._local.rows = None
+        self._local.saved = 0
+        return saved
+
+    def get(self, model, primary_key):
+        """
+        **Returns a row if it has already been loaded.**
+
+        :param model: the model class
+        :param primary_key: the rows primary key
+        :return: the instance, or None
+        """
+        rows = self._rows
+        if rows is None:
+            return None
+        instance = rows.get((model, primary_key))
+        if instance is not None:
+            self._local.saved += 1
+            metrics.registry.increment('identity_map.lookups_saved')
+        return instance
+
+    def add(self, instance):
+        """
+        **Remembers a row that has been loaded or saved.**
+
+        :param instance: model instance with its primary key set
+        """
+        rows = self._rows
+        if rows is not None and instance is not None and instance._pk is not None:
+            rows[(type(instance), instance._pk)] = instance
+
+    def discard(self, model, primary_key=None):
+        """
+        **Forgets one row of a model, or every row of it.**
+
+        :param model: the model class
+        :param primary_key: the rows primary key, None for every row
+        """
+        rows = self._rows
+        if not rows:
+            return
+        if primary_key is not None:
+            rows.pop((model, primary_key), None)
+        else:
+            for key in [key for key in rows if key[0] is model]:
+                del rows[key]
+
+    def clear(self):
+        """
+        **Forgets every row, e.g. after a transaction is rolled back.**
+        """
+        if self._rows:
+            self._rows.clear()
+
+
+# rows loaded by the request running on each thread, begun and ended by the app
+identity_map = IdentityMap()
+
+
+class BaseModel(Model):
+    class Meta:
+        database = db
+
+    @classmethod
+    def get_by_id(cls, primary_key):
+        """
+        **Gets a row by its primary key, from** :data:`identity_map` **if this request already has it.**
+
+        :param primary_key: the rows primary key
+        :return: the instance
+        :raises DoesNotExist: if there is no such row
+        """
+        instance = identity_map.get(cls, primary_key)
+        if instance is None:
+            instance = cls.get(cls._meta.primary_key == primary_key)
+            identity_map.add(instance)
+        return instance
+
+    @classmethod
+    def update(cls, *args, **kwargs):
+        # any row of the model could be changed by the query
+        identity_map.discard(cls)
+        return super(BaseModel, cls).update(*args, **kwargs)
+
+    @classmethod
+    def delete(cls):
+        identity_map.discard(cls)
+        return super(BaseModel, cls).delete()
+
+    def save(self, *args, **kwargs):
+        saved = super(BaseModel, self).save(*args, **kwargs)
+        identity_map.add(self)
+        return saved
+
+    def delete_instance(self, *args, **kwargs):
+        deleted = super(BaseModel, self).delete_instance(*args, **kwargs)
+        identity_map.discard(type(self), self._pk)
+        return deleted
+
+
+def write_transaction(function):
+    """
+    **Runs a function in one ``BEGIN IMMEDIATE`` transaction, trying again while the database is busy.**
+
+    SQLite lets one connection write at a time. A normal transaction only asks
+    for the write lock at its first write, and if another connection has it by
+    then SQLite gives up straight away with "database is locked". Taking the
+    lock when the transaction begins means SQLite waits for it, for up to the
+    connection's busy timeout, and anything the function reads, like the stock
+    left, can't change before it writes. If the lock still can't be had, the
+    transaction is rolled back and tried again after a random wait that doubles
+    each time, so buyers that collided don't all come back at once.
+
+    The function may run more than once, so it should only change the database,
+    and leave anything else, like clearing a cache, to :func:`after_commit`.
+    Called inside another transaction it just runs as part of that one. The
+    rows in :data:`identity_map` were loaded before the lock was taken, so
+    they are forgotten when the transaction begins.
+
+    :param function: function to wrap
+    :return: the wrapped function
+    """
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        if db.in_transaction():
+            return function(*args, **kwargs)
+        attempt = 1
+        while True:
+            _commit_callbacks.pending = []
+            try:
+                with db.atomic('IMMEDIATE'):
+                    identity_map.clear()
+                    result = function(*args, **kwargs)
+            except Exception as error:
+                # rows saved by the function were rolled back, so the map can't be trusted
+                identity_map.clear()
+                _commit_callbacks.pending = None
+                if not isinstance(error, OperationalError) or 'locked' not in str(error):
+                    raise
+                if attempt >= write_attempts:
+                    metrics.registry.increment('db.write_failures')
+                    raise
+            else:
+                pending, _commit_callbacks.pending = _commit_callbacks.pending, None
+                for callback in pending:
+                    callback()
+                return result
+            metrics.registry.increment('db.write_retries')
+            time.sleep(random.uniform(0, write_retry_delay * 2 ** (attempt - 1)))
+            attempt += 1
+    return run
+
+
+def after_commit(callback):
+    """
+    **Runs a function once the write transaction running now has committed.**
+
+    A cache cleared before the commit can be filled again straight away by
+    another request, from rows that still hold the old values, and then keeps
+    them. Inside a :func:`write_transaction` the function is held back until
+    the commit, runs only once however often it was asked for, and doesn't run
+    at all if the transaction is rolled back. Anywhere else it runs now.
+
+    :param callback: function taking no arguments, e.g. ``cache.catalog.invalidate``
+    """
+    pending = getattr(_commit_callbacks, 'pending', None)
+    if pending is None:
+        callback()
+    elif callback not in pending:
+        pending.append(callback)
+
+
+class User(UserMixin, BaseModel):
+    """
+    **User class.**
+
+    Used as a model for the database, containing methods to be performed on user objects.
+    """
+    id = PrimaryKeyField()
+    first_name = CharField()
+    last_name = CharField()
+    email_address = CharField(unique=True)
+    password = CharField(max_length=100)
+    user_role = CharField(default='customer')
+    date_created = DateTimeField(default=datetime.datetime.now, index=True)
+
+    @classmethod
+    def create_user(cls, first_name, last_name, email_address, password, user_role):
+        """
+        **Creates user.**
+
+        Takes in parameters and uses them to create a row in the user table of the database.
+        It takes in a plain text password but hashes it before inputting to the database.
+
+        :param first_name: users first name
+        :param last_name: user last name
+        :param email_address: users email address
+        :param password: users password (plain text)
+        :param user_role: the role of the user (determines permissions)
+        :return:
+        """
+        try:
+            cls.create(
+                first_name=first_name,
+                last_name=last_name,
+                email_address=email_address,
+                password=generate_password_hash(password),
+                user_role=user_role
+            )
+        except IntegrityError:
+            raise ValueError("User already exists")
+
+    @classmethod
+    def edit_details(cls, user_id, first_name, last_name, email_address):
+        try:
+            query = cls.update(
+                first_name=first_name,
+                last_name=last_name,
+                email_address=email_address
+            ).where(cls.id == user_id)
+            query.execute()
+        except IntegrityError:
+            raise ValueError("User with that email address already exists")
+
+    @classmethod
+    def reset_password(cls, user_id, password):
+        query = cls.update(
+            password=generate_password_hash(password)
+        ).where(cls.id == user_id)
+        query.execute()
+
+    @classmethod
+    def generate_user_report(cls, start_date, end_date):
+        start_date = datetime.datetime.combine(start_date, datetime.time())
+        end_date = datetime.datetime.combine(end_date, datetime.time())
+        users = cls.select().where(cls.date_created >= start_date, cls.date_created <= end_date)
+        if not users.exists():
+            return None
+        else:
+            fieldnames = []
+            file_name = uuid.uuid4().hex + '.csv'
+            for key in users[0].__data__:
+                if key != 'password':
+                    fieldnames.append(key)
+            with open('static\\tmp_reports\\' + file_name, 'w+', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=fieldnames)
+                writer.writeheader()
+                for user in users:
+                    user_dict = dict(user.__data__.items())
+                    user_dict.pop('password', None)
+                    user_dict.update({'date_created':user.date_created.strftime('%d/%m/%y %H:%M:%S')})
+                    writer.writerow(user_dict)
+            return file_name
+
+
+class AddressDetails(BaseModel):
+    id = PrimaryKeyField()
+    user_id = ForeignKeyField(User, related_name='address')
+    address_line_1 = CharField()
+    address_line_2 = CharField()
+    town = CharField()
+    city = CharField()
+    postcode = CharField()
+    default = BooleanField(default=False)
+
+    @classmethod
+    @write_transaction
+    def add_address(cls, user_id, address_line_1, address_line_2, town, city, postcode,
+                    default=False, order_id=None):
+        """
+        **Adds an address for a user.**
+
+        :param user_id: the users id
+        :param default: makes the new address the users default
+        :param order_id: an order to deliver to the new address, if any
+        :return: the new addresses id
+        """
+        address = cls.create(
+            user_id=user_id,
+            address_line_1=address_line_1,
+            address_line_2=address_line_2,
+            town=town,
+            city=city,
+            postcode=postcode
+        )
+        if default:
+            cls.change_default(address.id, user_id)
+        if order_id is not None:
+            Order.add_address_to_order(order_id, address.id)
+        return address.id
+
+    @classmethod
+    @write_transaction
+    def edit_address(cls, address_id, address_line_1, address_line_2, town, city, postcode):
+        query = cls.update(
+            address_line_1=address_line_1,
+            address_line_2=address_line_2,
+            town=town,
+            city=city,
+            postcode=postcode
+        ).where(cls.id == address_id)
+        query.execute()
+
+    @classmethod
+    @write_transaction
+    def delete_address(cls, address_id, user_id):
+        """
+        **Deletes one of a users addresses.**
+
+        If it was the default, the users newest remaining address becomes the default.
+
+        :param address_id: address id (primary key)
+        :param user_id: the users id, addresses belonging to anyone else are left alone
+        """
+        with db.atomic():
+            deleted = cls.delete().where(cls.id == address_id, cls.user_id == user_id).execute()
+            if deleted and cls.get_default_address(user_id) is None:
+                newest = cls.select(cls.id)\
+                    .where(cls.user_id == user_id)\
+                    .order_by(cls.id.desc())\
+                    .first()
+                if newest is not None:
+                    cls.change_default(newest.id, user_id)
+
+    @classmethod
+    def get_default_address(cls, user_id):
+        # a point lookup in the partial unique index below
+        return cls.select().where(cls.user_id == user_id, cls.default == True).first()
+
+    @classmethod
+    @write_transaction
+    def change_default(cls, new_default_id, user_id):
+        """
+        **Makes one of a users addresses their default.**
+
+        The unique index only allows one default per user and SQLite checks it row
+        by row, so the old default is cleared before the new one is set, both in
+        one transaction so no request sees the user without a default.
+
+        :param new_default_id: address id (primary key)
+        :param user_id: the users id, addresses belonging to anyone else are left alone
+        """
+        with db.atomic():
+            if not cls.select().where(cls.id == new_default_id, cls.user_id == user_id).exists():
+                return
+            cls.update(default=False)\
+                .where(cls.user_id == user_id, cls.default == True, cls.id != new_default_id)\
+                .execute()
+            cls.update(default=True).where(cls.id == new_default_id).execute()
+
+    @classmethod
+    def remove_extra_defaults(cls):
+        """
+        **Leaves each user with at most one default address, their newest.**
+
+        Needed before the unique index can be created on a database where the
+        old code gave a user more than one default.
+        """
+        newest_defaults = cls.select(fn.MAX(cls.id)).where(cls.default == True).group_by(cls.user_id)
+        cls.update(default=False)\
+            .where(cls.default == True, cls.id.not_in(newest_defaults))\
+            .execute()
+
+
+# one default address per user, the lookup in get_default_address reads only this index
+AddressDetails.add_index(AddressDetails.user_id, unique=True, where=(AddressDetails.default == True),
+                         name='addressdetails_one_default')
+
+
+class Product(BaseModel):
+    id = PrimaryKeyField()
+    product_category = CharField(index=True)
+    product_name = CharField(index=True)
+    # in pence, like every amount of money in the database, see money.py
+    product_price = IntegerField(default=0, index=True)
+    product_description = CharField()
+    product_image_path = CharField(null=True)
+    one_size_stock = IntegerField(default=0)
+    small_stock = IntegerField(default=0)
+    medium_stock = IntegerField(default=0)
+    large_stock = IntegerField(default=0)
+    date_created = DateTimeField(default=datetime.datetime.now)
+    # create attribute to contain uploaded image location
+
+    @classmethod
+    def create_product(cls, product_category, product_name, product_price, product_description, one_size_stock,
+                       small_stock, medium_stock, large_stock):
+        try:
+            with db.atomic():
+                product = cls.create(
+                    product_category=product_category,
+                    product_name=product_name,
+                    product_price=product_price,
+                    product_description=product_description,
+                    one_size_stock=one_size_stock,
+                    small_stock=small_stock,
+                    medium_stock=medium_stock,
+                    large_stock=large_stock
+                )
+                StockLevel.add_products([product])
+        except IntegrityError:
+            raise ValueError("T-Shirt with this name exists")
+        after_commit(cache.catalog.invalidate)
+        after_commit(functools.partial(cache.product_names.add, product.id, product.product_name))
+        return product
+
+    @classmethod
+    def add_image(cls, id, product_image_path):
+        # only the path is written, saving the whole row could put back stock sold since it was read
+        cls.update(product_image_path=product_image_path).where(cls.id == id).execute()
+        after_commit(cache.catalog.invalidate)
+
+    @classmethod
+    def increase_tshirt_stock(cls, product_id, quantity, size):
+        cls.adjust_stock(product_id, size, quantity)
+        after_commit(cache.catalog.invalidate)
+
+    @classmethod
+    def reduce_tshirt_stock(cls, product_id, quantity, size):
+        cls.adjust_stock(product_id, size, -quantity)
+        after_commit(cache.catalog.invalidate)
+
+    @classmethod
+    def increase_other_stock(cls, product_id, quantity):
+        cls.adjust_stock(product_id, "one_size", quantity)
+        after_commit(cache.catalog.invalidate)
+
+    @classmethod
+    def reduce_other_stock(cls, product_id, quantity):
+        cls.adjust_stock(product_id, "one_size", -quantity)
+        after_commit(cache.catalog.invalidate)
+
+    @classmethod
+    @write_transaction
+    def remove_product(cls, product_id):
+        """
+        **Deletes a product along with its stock levels.**
+
+        :param product_id: product id (primary key)
+        """
+        StockLevel.remove_product(product_id)
+        cls.delete().where(cls.id == product_id).execute()
+
+    @classmethod
+    def stock_column(cls, size):
+        """
+        **Returns the stock column for a size.**
+
+        :param size: "small", "medium", "large" or "one_size"
+        :return: the field holding that sizes stock
+        """
+        return getattr(cls, size + '_stock')
+
+    @classmethod
+    def reserve_stock(cls, product_id, size, quantity):
+        """
+        **Takes stock for a basket if there is enough of it.**
+
+        The check and the decrease are one UPDATE statement, so two baskets can never
+        take the same stock. The caller is expected to clear the cached catalog.
+
+        :param product_id: product id (primary key)
+        :param size: "small", "medium", "large" or "one_size"
+        :param quantity: amount to take
+        :return: True if the stock was taken
+        """
+        column = cls.stock_column(size)
+        with db.atomic():
+            reserved = cls.update({column: column - quantity})\
+                .where(cls.id == product_id, column >= quantity)\
+                .execute()
+            if reserved:
+                StockLevel.adjust(product_id, size, -quantity)
+        return reserved == 1
+
+    @classmethod
+    def release_stock(cls, product_id, size, quantity):
+        """
+        **Puts stock taken by a basket back.**
+
+        :param product_id: product id (primary key)
+        :param size: "small", "medium", "large" or "one_size"
+        :param quantity: amount to put back
+        """
+        cls.adjust_stock(product_id, size, quantity)
+
+    @classmethod
+    def adjust_stock(cls, product_id, size, amount):
+        """
+        **Adds to, or with a negative amount takes from, the stock of one size.**
+
+        One UPDATE of the product and one of its stock level, rather than loading
+        and saving the product. The caller is expected to clear the cached catalog.
+
+        :param product_id: product id (primary key)
+        :param size: "small", "medium", "large" or "one_size"
+        :param amount: change in stock
+        """
+        column = cls.stock_column(size)
+        with db.atomic():
+            cls.update({column: column + amount}).where(cls.id == product_id).execute()
+            StockLevel.adjust(product_id, size, amount)
+
+    @classmethod
+    @write_transaction
+    def bulk_update(cls, rows):
+        """
+        **Changes the stock and prices of many products in one transaction.**
+
+        Each stock column and the price are changed with one UPDATE using a CASE
+        on the product id, then the totals of the open baskets holding a product
+        whose price changed are worked out again together. If anything is wrong,
+        nothing is changed.
+
+        :param rows: rows from :func:`~parse_bulk_update`
+        :return: dictionary with "changes", a list of (product id, product name, column,
+                 before, after), and "baskets", the number of open baskets re-totalled
+        :raises ValueError: with a message for each problem, e.g. stock going below 0
+        """
+        product_ids = list({row['product_id'] for row in rows})
+        # {size: {product id: ("add" or "set", amount)}}
+        stock = {}
+        prices = {}
+        errors = []
+        with db.atomic():
+            before = {product.id: product for product in cls.select().where(cls.id << product_ids)}
+            for row in rows:
+                product = before.get(row['product_id'])
+                if product is None:
+                    errors.append("Product {} does not exist".format(row['product_id']))
+                    continue
+                if row['stock'] is not None:
+                    sizes = TSHIRT_SIZES if product.product_category == "tshirt" else ("one_size",)
+                    if row['size'] not in sizes:
+                        errors.append("Product {} is not sold in size {}".format(product.id, row['size']))
+                    elif product.id in stock.get(row['size'], {}):
+                        errors.append("Product {} size {} is listed twice".format(product.id, row['size']))
+                    else:
+                        stock.setdefault(row['size'], {})[product.id] = row['stock']
+                if row['price'] is not None:
+                    if prices.get(product.id, row['price']) != row['price']:
+                        errors.append("Product {} is given two prices".format(product.id))
+                    prices[product.id] = row['price']
+            if errors:
+                raise ValueError(*errors)
+
+            for size, changes in stock.items():
+                column = cls.stock_column(size)
+                cls.update({column: Case(cls.id, [
+                    (product_id, column + amount if kind == "add" else amount)
+                    for product_id, (kind, amount) in changes.items()
+                ], column)}).where(cls.id << list(changes)).execute()
+                StockLevel.set_many(size, changes)
+            if prices:
+                cls.update(product_price=Case(cls.id, list(prices.items()), cls.product_price))\
+                    .where(cls.id << list(prices))\
+                    .execute()
+
+            after = {product.id: product for product in cls.select().where(cls.id << product_ids)}
+            changed = []
+            for product_id in sorted(after):
+                for column in ('small_stock', 'medium_stock', 'large_stock', 'one_size_stock', 'product_price'):
+                    old, new = getattr(before[product_id], column), getattr(after[product_id], column)
+                    if old != new:
+                        changed.append((product_id, after[product_id].product_name, column, old, new))
+                    if column.endswith('_stock') and new < 0:
+                        errors.append("Product {} would have {} {}".format(product_id, new, column.replace('_', ' ')))
+            if errors:
+                raise ValueError(*errors)
+
+            baskets = []
+            if prices:
+                baskets = [order_id for order_id, in OrderLine.select(OrderLine.order)
+                           .distinct()
+                           .join(Order)
+                           .where(OrderLine.product << list(prices), Order.order_status == "open")
+                           .tuples()]
+                Order.update_order_totals(baskets)
+        after_commit(cache.catalog.invalidate)
+        return {'changes': changed, 'baskets': len(baskets)}
+
+    @classmethod
+    def tshirt__in_stock(cls, quantity, product_id, size):
+        product = Product.get_by_id(product_id)
+        if size == "small":
+            if quantity > product.small_stock:
+                return False
+            else:
+                return True
+        elif size == "medium":
+                if quantity > product.medium_stock:
+                    return False
+                else:
+                    return True
+        elif size == "large":
+                if quantity > product.large_stock:
+                    return False
+                else:
+                    return True
+
+    @classmethod
+    def other_in_stock(cls, quantity, product_id):
+        product = Product.get_by_id(product_id)
+        if quantity > product.one_size_stock:
+            return False
+        else:
+            return True
+
+
+class StockLevel(BaseModel):
+    """
+    **Stock of each product and size, with the level it should be restocked at.**
+
+    A summary of the stock columns on Product, kept up to date by the Product
+    stock methods, so the inventory page never reads the whole product table.
+    ``headroom`` is the stock minus the threshold and is indexed, so the sizes
+    that need restocking are found, most urgent first, straight from the index.
+    """
+    id = PrimaryKeyField()
+    product = ForeignKeyField(Product, related_name='stock_levels')
+    size = CharField()
+    stock = IntegerField(default=0)
+    threshold = IntegerField(default=0)
+    headroom = IntegerField(default=0, index=True)
+
+    class Meta:
+        indexes = (
+            (('product', 'size'), True),
+        )
+
+    @classmethod
+    def adjust(cls, product_id, size, amount):
+        """
+        **Adds to, or with a negative amount takes from, the stock of one size.**
+
+        :param product_id: product id (primary key)
+        :param size: "small", "medium", "large" or "one_size"
+        :param amount: change in stock
+        """
+        cls.update(stock=cls.stock + amount, headroom=cls.headroom + amount)\
+            .where(cls.product == product_id, cls.size == size)\
+            .execute()
+
+    @classmethod
+    def adjust_many(cls, size, amounts):
+        """
+        **Changes the stock of one size of several products in one UPDATE.**
+
+        :param size: "small", "medium", "large" or "one_size"
+        :param amounts: dictionary of product id to change in stock
+        """
+        change = Case(cls.product, list(amounts.items()), 0)
+        cls.update(stock=cls.stock + change, headroom=cls.headroom + change)\
+            .where(cls.size == size, cls.product << list(amounts))\
+            .execute()
+
+    @classmethod
+    def set_many(cls, size, changes):
+        """
+        **Changes the stock of one size of several products in one UPDATE.**
+
+        :param size: "small", "medium", "large" or "one_size"
+        :param changes: dictionary of product id to ("add" or "set", amount)
+        """
+        stock = Case(cls.product, [
+            (product_id, cls.stock + amount if kind == "add" else amount)
+            for product_id, (kind, amount) in changes.items()
+        ], cls.stock)
+        cls.update(stock=stock, headroom=stock - cls.threshold)\
+            .where(cls.size == size, cls.product << list(changes))\
+            .execute()
+
+    @classmethod
+    def add_products(cls, products, thresholds=None):
+        """
+        **Creates the stock levels for new products.**
+
+        :param products: list of products
+        :param thresholds: dictionary of (product id, size) to threshold, anything
+                           missing gets ``low_stock_threshold``
+        """
+        thresholds = thresholds or {}
+        rows = []
+        for product in products:
+            sizes = TSHIRT_SIZES if product.product_category == "tshirt" else ("one_size",)
+            for size in sizes:
+                stock = getattr(product, size + '_stock')
+                threshold = thresholds.get((product.id, size), low_stock_threshold)
+                rows.append({'product': product.id, 'size': size, 'stock': stock,
+                             'threshold': threshold, 'headroom': stock - threshold})
+        # SQLite limits the number of variables in one statement
+        for start in range(0, len(rows), 100):
+            cls.insert_many(rows[start:start + 100]).execute()
+
+    @classmethod
+    def remove_product(cls, product_id):
+        cls.delete().where(cls.product == product_id).execute()
+
+    @classmethod
+    @write_transaction
+    def set_threshold(cls, stock_level_id, threshold):
+        cls.update(threshold=threshold, headroom=cls.stock - threshold)\
+            .where(cls.id == stock_level_id)\
+            .execute()
+
+    @classmethod
+    def rebuild(cls):
+        """
+        **Fills the table from the product table, keeping any thresholds already set.**
+        """
+        with db.atomic():
+            thresholds = {(product_id, size): threshold for product_id, size, threshold in
+                          cls.select(cls.product, cls.size, cls.threshold).tuples()}
+            cls.delete().execute()
+            cls.add_products(Product.select(), thresholds)
+
+    @classmethod
+    def low_stock_count(cls):
+        return cls.select().where(cls.headroom <= 0).count()
+
+    @classmethod
+    def inventory_page(cls, page, per_page=50, days=30):
+        """
+        **Gets a page of stock levels, most in need of restocking first.**
+
+        Sales come from the ProductSales rollup, so the time taken depends on
+        the page size, not on the size of the catalog or the order history.
+
+        :param page: page number, starting at 1
+        :param per_page: stock levels per page
+        :param days: number of days of sales to look at
+        :return: list of stock levels, each with ``product_name``, ``units_sold``, ``sell_through``
+                 (percent of the stock sold) and ``days_left`` (None if none sold)
+        """
+        # read in index order without a join, the names are looked up for this page only
+        levels = list(cls.select().order_by(cls.headroom, cls.id).paginate(page, per_page))
+        product_ids = list({level.product_id for level in levels})
+        names = dict(Product.select(Product.id, Product.product_name).where(Product.id << product_ids).tuples())
+        since = datetime.date.today() - datetime.timedelta(days=days)
+        sold = {(product_id, size): units for product_id, size, units in
+                ProductSales.select(ProductSales.product, ProductSales.size, fn.SUM(ProductSales.units))
+                            .where(ProductSales.day >= since, ProductSales.product << product_ids)
+                            .group_by(ProductSales.product, ProductSales.size)
+                            .tuples()}
+        for level in levels:
+            level.product_name = names.get(level.product_id)
+            level.units_sold = sold.get((level.product_id, level.size), 0)
+            total = level.units_sold + max(level.stock, 0)
+            level.sell_through = round(100 * level.units_sold / total) if total else 0
+            level.days_left = int(level.stock * days / level.units_sold) if level.units_sold > 0 else None
+        return levels
+
+
+def parse_bulk_update(text):
+    """
+    **Reads the CSV used to update the stock and prices of many products at once.**
+
+    Each row is ``product_id,size,stock,price``. A stock starting with + or - is
+    added to the current stock, any other number replaces it. The stock or the
+    price can be left empty to leave it as it is, the size is only needed with a
+    stock and a header row is optional.
+
+    :param text: contents of the CSV file
+    :return: list of dictionaries with a product_id, size, stock and price, the stock
+             is None or a tuple of ("add" or "set", amount) and the price is None or in pence
+    :raises ValueError: with a message for every row that couldn't be read
+    """
+    rows = []
+    errors = []
+    for number, record in enumerate(csv.reader(io.StringIO(text)), 1):
+        record = [field.strip() for field in record] + [''] * 4
+        product_id, size, stock, price = record[:4]
+        if not any(record):
+            continue
+        if number == 1 and product_id.lower() == "product_id":
+            continue
+        row = {'product_id': None, 'size': size or None, 'stock': None, 'price': None}
+        try:
+            row['product_id'] = int(product_id)
+        except ValueError:
+            errors.append("Row {}: product id must be a number".format(number))
+            continue
+        if stock:
+            try:
+                row['stock'] = ("add" if stock[0] in "+-" else "set", int(stock))
+            except ValueError:
+                errors.append("Row {}: stock must be a whole number".format(number))
+                continue
+            if row['size'] is None:
+                errors.append("Row {}: a size is needed to change the stock".format(number))
+                continue
+        if price:
+            try:
+                row['price'] = money.to_pence(price)
+            except decimal.InvalidOperation:
+                errors.append("Row {}: price must be a number".format(number))
+                continue
+            if row['price'] < 0:
+                errors.append("Row {}: price can't be below 0".format(number))
+                continue
+        if row['stock'] is None and row['price'] is None:
+            errors.append("Row {}: nothing to change".format(number))
+            continue
+        rows.append(row)
+    if errors:
+        raise ValueError(*errors)
+    return rows
+
+
+# categories a product can be in, the forms, the catalog API and the
+# product list filters all take them from here
+PRODUCT_CATEGORIES = ("tshirt", "hat", "cd")
+
+# sizes t-shirts come in, everything else is "one_size"
+TSHIRT_SIZES = ("small", "medium", "large")
+
+# operations accepted by Order.apply_basket_operations
+BASKET_OPERATIONS = ("add", "remove", "set")
+
+
+def _parse_basket_operations(operations):
+    """
+    **Checks a list of basket operations and combines them per product and size.**
+
+    :param operations: list of operation dictionaries
+    :return: dictionary of (product id, size) to a function that takes the current
+             quantity and returns the new one
+    """
+    changes = {}
+    for operation in operations:
+        try:
+            op = operation['op']
+            key = (int(operation['product_id']), operation['size'])
+            quantity = int(operation.get('quantity', 0))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each operation needs an op, product_id, size and quantity")
+        if op not in BASKET_OPERATIONS:
+            raise ValueError("Unknown operation {}".format(op))
+        if key[1] not in TSHIRT_SIZES and key[1] != "one_size":
+            raise ValueError("Unknown size {}".format(key[1]))
+        if quantity < 0 or (op == "add" and quantity == 0):
+            raise ValueError("Quantity must be a positive number")
+
+        previous = changes.get(key, lambda current: current)
+        if op == "add":
+            changes[key] = lambda current, previous=previous, quantity=quantity: previous(current) + quantity
+        elif op == "remove":
+            changes[key] = lambda current: 0
+        else:
+            changes[key] = lambda current, quantity=quantity: quantity
+    return changes
+
+
+class ShippingOption(BaseModel):
+    id = PrimaryKeyField()
+    name = CharField()
+    # in pence
+    cost = IntegerField()
+
+    @classmethod
+    def create_shipping_option(cls, name, cost):
+        cls.create(
+            name=name,
+            cost=cost
+        )
+        # shipping options are served from cache.reference
+        after_commit(cache.reference.invalidate)
+
+
+class Order(BaseModel):
+    id = PrimaryKeyField()
+    user = ForeignKeyField(User, related_name='orders')
+    address = ForeignKeyField(AddressDetails, related_name='address', null=True)
+    shipping = ForeignKeyField(ShippingOption, related_name='shipping', null=True, default=1)
+    order_status = CharField(default="open")
+    order_placed_on = DateTimeField(null=True, index=True)
+    order_dispatched_on = DateTimeField(null=True)
+    order_completed_on = DateTimeField(null=True)
+    order_cancelled_on = DateTimeField(null=True)
+    # in pence, without the shipping
+    order_total = IntegerField(default=0)
+    # in pence, the shipping charged, set when the order is placed so the
+    # sales rollups take off what was added even if the option's cost changes
+    shipping_cost = IntegerField(null=True)
+    # kept up to date with the lines by update_order_total, so the basket badge
+    # and empty basket checks don't need to read the lines
+    item_count = IntegerField(default=0)
+    line_count = IntegerField(default=0)
+    # id of the payment taken for the order, e.g. the Stripe charge
+    payment_reference = CharField(null=True)
+    # while a basket is being paid for, when the payment started and the Stripe
+    # customer made for it, which finds the charge if its result isn't known,
+    # see payments.check_pending_payments
+    payment_started_on = DateTimeField(null=True, index=True)
+    payment_attempt = CharField(null=True)
+
+    # see ArchivedOrder
+    archived = False
+
+    class Meta:
+        # every page looks up the users open order and the orders page
+        # filters on status, so both columns are indexed together
+        indexes = (
+            (('user', 'order_status'), False),
+        )
+
+    @classmethod
+    def find_order(cls, order_id):
+        """
+        **Gets an order whether or not it has been archived.**
+
+        :param order_id: order id (primary key)
+        :return: the Order or ArchivedOrder
+        """
+        try:
+            return cls.get_by_id(order_id)
+        except cls.DoesNotExist:
+            return ArchivedOrder.get_by_id(order_id)
+
+    @classmethod
+    def order_history(cls, user_id, statuses):
+        """
+        **Gets a users orders from both the order and archive tables.**
+
+        :param user_id: users id (primary key)
+        :param statuses: list of the order statuses wanted
+        :return: list of orders, most recently placed or cancelled first
+        """
+        orders = []
+        for model in (cls, ArchivedOrder):
+            orders.extend(model.select().where(model.user == user_id, model.order_status << statuses))
+        return sorted(orders, key=lambda order: order.order_placed_on or order.order_cancelled_on, reverse=True)
+
+    @classmethod
+    def update_order_total(cls, order_id):
+        # the total and the item and line counts are added up by SQLite in one
+        # query rather than a query per line, the prices are pence so SUM stays an integer
+        total, items, lines = OrderLine.select(
+            fn.COALESCE(fn.SUM(OrderLine.quantity * OrderLine.line_price()), 0),
+            fn.COALESCE(fn.SUM(OrderLine.quantity), 0),
+            fn.COUNT(OrderLine.id)
+        ).join(Product).where(OrderLine.order == order_id).tuples().get()
+        cls.update(order_total=total, item_count=items, line_count=lines).where(cls.id == order_id).execute()
+
+    @classmethod
+    def update_order_totals(cls, order_ids):
+        """
+        **Works out the totals and counts of several orders at once.**
+
+        One query adds up the lines of every order and one UPDATE writes them,
+        orders left with no lines go back to 0.
+
+        :param order_ids: list of order ids (primary keys)
+        """
+        order_ids = list(order_ids)
+        if not order_ids:
+            return
+        rows = list(OrderLine.select(OrderLine.order,
+                                     fn.SUM(OrderLine.quantity * OrderLine.line_price()),
+                                     fn.SUM(OrderLine.quantity),
+                                     fn.COUNT(OrderLine.id))
+                    .join(Product)
+                    .where(OrderLine.order << order_ids)
+                    .group_by(OrderLine.order)
+                    .tuples())
+        values = {'order_total': 0, 'item_count': 0, 'line_count': 0}
+        if rows:
+            for column, name in enumerate(('order_total', 'item_count', 'line_count'), 1):
+                values[name] = Case(cls.id, [(row[0], row[column]) for row in rows], 0)
+        cls.update(**values).where(cls.id << order_ids).execute()
+
+    @classmethod
+    def find_count_drift(cls):
+        """
+        **Finds orders whose item or line counts don't match their lines.**
+
+        :return: list of (order id, item count, line count, actual items, actual lines)
+        """
+        counted = OrderLine.select(OrderLine.order,
+                                   fn.SUM(OrderLine.quantity).alias('items'),
+                                   fn.COUNT(OrderLine.id).alias('lines'))\
+            .group_by(OrderLine.order)\
+            .alias('counted')
+        items = fn.COALESCE(counted.c.items, 0)
+        lines = fn.COALESCE(counted.c.lines, 0)
+        return list(cls.select(cls.id, cls.item_count, cls.line_count, items, lines)
+                    .join(counted, JOIN.LEFT_OUTER, on=(counted.c.order_id == cls.id))
+                    .where((cls.item_count != items) | (cls.line_count != lines))
+                    .order_by(cls.id)
+                    .tuples())
+
+    @classmethod
+    def create_order(cls, user):
+        with db.atomic():
+            order = cls.create(user=user)
+            OrderStatusCount.add("open", 1)
+        return order
+
+    @classmethod
+    def create_order_with_address(cls, user, address):
+        with db.atomic():
+            order = cls.create(
+                user=user,
+                address=address
+            )
+            OrderStatusCount.add("open", 1)
+        return order
+
+    @classmethod
+    @write_transaction
+    def apply_basket_operations(cls, user, address, operations):
+        """
+        **Applies a list of changes to the users basket in one transaction.**
+
+        Each operation is a dictionary with an ``op`` of "add", "remove" or "set",
+        a ``product_id``, a ``size`` ("one_size" for products that aren't t-shirts)
+        and a ``quantity`` for "add" and "set". The changes are worked out first,
+        then the stock for every changed line is reserved or released, the lines
+        are written and the total is added up once.
+
+        :param user: the logged in user
+        :param address: the users default address id, used if a new order is needed
+        :param operations: list of operations
+        :return: the basket from :func:`~basket_state`, with any lines that
+                 didn't have enough stock listed under "errors"
+        """
+        changes = _parse_basket_operations(operations)
+        products = {product.id: product for product in
+                    Product.select().where(Product.id << list({product_id for product_id, size in changes}))}
+        for product_id, size in changes:
+            if product_id not in products:
+                raise ValueError("Product {} does not exist".format(product_id))
+            if (products[product_id].product_category == "tshirt") != (size in TSHIRT_SIZES):
+                raise ValueError("Product {} is not sold in size {}".format(product_id, size))
+
+        errors = []
+        with db.atomic():
+            order = cls.find_current_order(user)
+            if order is None:
+                if address is not None:
+                    order = cls.create_order_with_address(user.id, address)
+                else:
+                    order = cls.create_order(user.id)
+            lines = {(line.product_id, line.size): line for line in order.order_lines}
+
+            stock_changed = False
+            for (product_id, size), change in changes.items():
+                line = lines.get((product_id, size))
+                current = line.quantity if line is not None else 0
+                target = max(change(current), 0)
+                difference = target - current
+                if difference > 0 and not Product.reserve_stock(product_id, size, difference):
+                    errors.append({'product_id': product_id, 'size': size, 'error': "Not enough stock"})
+                    continue
+                elif difference < 0:
+                    Product.release_stock(product_id, size, -difference)
+                elif difference == 0:
+                    continue
+                stock_changed = True
+
+                if line is None:
+                    OrderLine.create(product=product_id, order=order.id, quantity=target, size=size)
+                elif target == 0:
+                    OrderLine.delete().where(OrderLine.id == line.id).execute()
+                else:
+                    OrderLine.update(quantity=target).where(OrderLine.id == line.id).execute()
+
+            # any change to the basket keeps all of its stock held for longer
+            if stock_changed:
+                OrderLine.renew_reservations(order.id)
+            cls.update_order_total(order.id)
+        if stock_changed:
+            after_commit(cache.catalog.invalidate)
+
+        state = cls.basket_state(order.id)
+        state['errors'] = errors
+        return state
+
+    @classmethod
+    def basket_state(cls, order_id):
+        """
+        **Returns a basket as plain data, ready to be sent as JSON.**
+
+        :param order_id: the open orders id (primary key)
+        :return: dictionary with the order id, lines, item count and total in pounds
+        """
+        order = cls.get_by_id(order_id)
+        lines = [{
+            'line_id': line_id,
+            'product_id': product_id,
+            'size': size,
+            'quantity': quantity
+        } for line_id, product_id, size, quantity in
+            OrderLine.select(OrderLine.id, OrderLine.product, OrderLine.size, OrderLine.quantity)
+                     .where(OrderLine.order == order_id)
+                     .order_by(OrderLine.id)
+                     .tuples()]
+        return {
+            'order_id': order.id,
+            'lines': lines,
+            'item_count': sum(line['quantity'] for line in lines),
+            'order_total': money.format_pence(order.order_total)
+        }
+
+    @classmethod
+    def merge_basket(cls, user, address, items):
+        """
+        **Moves a basket kept in the session into the users open order.**
+
+        Adds every item with :func:`~apply_basket_operations`, so the stock is
+        reserved and the total worked out in a single transaction.
+
+        :param user: the logged in user
+        :param address: the users default address id, or None
+        :param items: list of (product id, size, quantity)
+        :return: list of the items that didn't have enough stock
+        """
+        state = cls.apply_basket_operations(user, address, [
+            {'op': 'add', 'product_id': product_id, 'size': size, 'quantity': quantity}
+            for product_id, size, quantity in items
+        ])
+        return [(error['product_id'], error['size']) for error in state['errors']]
+
+    @classmethod
+    @write_transaction
+    def add_address_to_order(cls, order_id, address):
+        cls.update(address=address).where(cls.id == order_id).execute()
+
+    @classmethod
+    def find_current_order(cls, user):
+        if user.is_authenticated:
+            order = cls.select().where(cls.user == user.id, cls.order_status == "open").first()
+            # later lookups of the basket in this request use the same instance
+            identity_map.add(order)
+            return order
+        else:
+            return None
+
+    @classmethod
+    @write_transaction
+    def place_order(cls, order_id):
+        """
+        **Places a basket, or places a cancelled order again.**
+
+        :param order_id: the orders id (primary key)
+        :return: True if the order was placed, False if it is already placed,
+                 dispatched or complete
+        """
+        with db.atomic():
+            order = cls.get_by_id(order_id)
+            # any other order is already counted as a sale, placing it again would count it twice
+            if order.order_status not in ("open", "cancelled"):
+                return False
+            OrderStatusCount.move(order.order_status, "placed")
+            order.order_status = "placed"
+            order.order_placed_on = datetime.datetime.now()
+            if order.shipping_cost is None:
+                order.shipping_cost = cache.reference.shipping_option(order.shipping_id).cost \
+                    if order.shipping_id else 0
+            # only the columns placing changes are written, the rest may have changed since
+            cls.update(order_status=order.order_status, order_placed_on=order.order_placed_on,
+                       shipping_cost=order.shipping_cost)\
+                .where(cls.id == order_id)\
+                .execute()
+            OrderLine.set_prices(order_id)
+            record_sale(order, 1)
+        return True
+
+    @classmethod
+    def price_basket(cls, order_id):
+        """
+        **Reads everything needed to take payment for a basket in one query.**
+
+        The first stage of a checkout, see :mod:`payments`. The order, its lines
+        and their products come back as one row per line, and the shipping cost
+        comes from :data:`cache.reference`.
+
+        :param order_id: the open orders id (primary key)
+        :return: dictionary with the order id, user id, shipping option id, "lines"
+                 as a list of (line id, quantity), "prices" of each line by its id,
+                 the "subtotal", "shipping" and
+                 "amount" to charge in pence, the item and line counts,
+                 "held_until", when the first of the lines' stock goes back on
+                 sale, "payment_reference", a charge waiting for its payment
+                 event, and "payment_started_on", set while the basket is being
+                 paid for, or None if the basket is empty or isn't open
+        """
+        rows = list(OrderLine.select(OrderLine.id, OrderLine.quantity, OrderLine.reserved_until,
+                                     Product.product_price, Order.user, Order.shipping, Order.payment_reference,
+                                     Order.payment_started_on)
+                    .join(Product)
+                    .switch(OrderLine)
+                    .join(Order)
+                    .where(OrderLine.order == order_id, Order.order_status == "open")
+                    .order_by(OrderLine.id)
+                    .tuples())
+        if not rows:
+            return None
+        line_ids, quantities, held, prices, user_ids, shipping_ids, references, started = zip(*rows)
+        subtotal = sum(price * quantity for price, quantity in zip(prices, quantities))
+        option = cache.reference.shipping_option(shipping_ids[0]) if shipping_ids[0] else None
+        shipping = option.cost if option else 0
+        return {
+            'order_id': order_id,
+            'user_id': user_ids[0],
+            'shipping_id': shipping_ids[0],
+            'lines': list(zip(line_ids, quantities)),
+            'prices': dict(zip(line_ids, prices)),
+            'subtotal': subtotal,
+            'shipping': shipping,
+            'amount': subtotal + shipping,
+            'item_count': sum(quantities),
+            'line_count': len(rows),
+            'held_until': None if None in held else min(held),
+            'payment_reference': references[0],
+            'payment_started_on': started[0]
+        }
+
+    @classmethod
+    def _lines_unchanged(cls, quote):
+        lines = OrderLine.select(OrderLine.id, OrderLine.quantity)\
+            .where(OrderLine.order == quote['order_id'])\
+            .order_by(OrderLine.id)\
+            .tuples()
+        return list(lines) == quote['lines']
+
+    @classmethod
+    @write_transaction
+    def hold_for_payment(cls, quote):
+        """
+        **Makes sure a priced basket still has its stock, and holds it while paying.**
+
+        The second stage of a checkout. The stock was taken when the items were
+        added to the basket, so this checks the sweeper hasn't put any of it
+        back on sale and the basket hasn't changed since it was priced, then
+        holds it for another ``reservation_time`` so it can't be released while
+        the card is charged. The basket is marked as being paid for, which
+        stops it being paid for twice at once and the sweeper releasing it
+        until the payment is finished.
+
+        :param quote: basket from :func:`~price_basket`
+        :return: True if the stock is held, False if the basket has changed
+                 or is already being paid for
+        """
+        if not cls._lines_unchanged(quote):
+            return False
+        started = cls.update(payment_started_on=datetime.datetime.now())\
+            .where(cls.id == quote['order_id'], cls.order_status == "open", cls.payment_started_on.is_null())\
+            .execute()
+        if not started:
+            return False
+        OrderLine.renew_reservations(quote['order_id'])
+        return True
+
+    @classmethod
+    def record_payment_attempt(cls, order_id, payment_attempt):
+        """
+        **Notes the Stripe customer a basket is about to be charged through.**
+
+        :param order_id: the orders id (primary key)
+        :param payment_attempt: the customer id
+        """
+        cls.update(payment_attempt=payment_attempt).where(cls.id == order_id).execute()
+
+    @classmethod
+    @write_transaction
+    def release_payment_hold(cls, quote):
+        """
+        **Undoes** :func:`~hold_for_payment` **after a payment fails.**
+
+        The stock goes back on sale when it would have before the payment was
+        tried, so an abandoned payment doesn't keep it any longer.
+
+        :param quote: basket from :func:`~price_basket`
+        """
+        OrderLine.update(reserved_until=quote['held_until'])\
+            .where(OrderLine.order == quote['order_id'], OrderLine.id << [line_id for line_id, quantity in quote['lines']])\
+            .execute()
+        cls.update(payment_started_on=None, payment_attempt=None)\
+            .where(cls.id == quote['order_id'], cls.order_status == "open", cls.payment_reference.is_null())\
+            .execute()
+
+    @classmethod
+    @write_transaction
+    def complete_payment(cls, quote, payment_reference):
+        """
+        **Places a paid for basket, in one transaction.**
+
+        The last stage of a checkout. The order is only placed if it is still
+        open and its lines are the ones that were paid for. The total, shipping
+        and line prices saved are the ones that were charged, even if a price
+        has changed since.
+
+        :param quote: basket from :func:`~price_basket`
+        :param payment_reference: id of the payment, e.g. the Stripe charge
+        :return: the placed order, or None if the basket changed while paying
+        """
+        if not cls._lines_unchanged(quote):
+            return None
+        placed_on = datetime.datetime.now()
+        placed = cls.update(
+            order_status="placed",
+            order_placed_on=placed_on,
+            order_total=quote['subtotal'],
+            shipping_cost=quote['shipping'],
+            item_count=quote['item_count'],
+            line_count=quote['line_count'],
+            payment_reference=payment_reference,
+            payment_started_on=None
+        ).where(cls.id == quote['order_id'], cls.order_status == "open").execute()
+        if not placed:
+            return None
+        OrderStatusCount.move("open", "placed")
+        OrderLine.set_prices(quote['order_id'], quote['prices'])
+        order = cls(id=quote['order_id'], user=quote['user_id'], shipping=quote['shipping_id'],
+                    order_status="placed", order_placed_on=placed_on, order_total=quote['subtotal'],
+                    shipping_cost=quote['shipping'], item_count=quote['item_count'],
+                    line_count=quote['line_count'], payment_reference=payment_reference)
+        record_sale(order, 1)
+        return order
+
+    @classmethod
+    def await_payment_event(cls, order_id, payment_reference):
+        """
+        **Marks an open order as paid for, waiting for the payment event to place it.**
+
+        Stops the basket being paid for twice while the event is on its way.
+        The event may already have placed the order, which is fine.
+
+        :param order_id: the orders id (primary key)
+        :param payment_reference: id of the payment, e.g. the Stripe charge
+        :return: False if the order is waiting on another payment
+        """
+        return bool(cls.update(payment_reference=payment_reference)
+                    .where(cls.id == order_id,
+                           cls.payment_reference.is_null() | (cls.payment_reference == payment_reference))
+                    .execute())
+
+    @classmethod
+    def placed_with(cls, order_id, payment_reference):
+        """
+        **Gets an order if it has already been placed by a payment.**
+
+        :param order_id: the orders id (primary key)
+        :param payment_reference: id of the payment, e.g. the Stripe charge
+        :return: the order, or None if the payment hasn't placed it
+        """
+        return cls.select().where(cls.id == order_id, cls.order_status != "open",
+                                  cls.payment_reference == payment_reference).first()
+
+    @classmethod
+    def cancel_payment_wait(cls, order_id, payment_attempt):
+        """
+        **Lets a basket be paid for again after its payment failed, or was refunded.**
+
+        Undoes :func:`~hold_for_payment` and :func:`~await_payment_event`,
+        other than the stock, which goes back on sale when the hold runs out.
+        Nothing is changed if the basket has moved on to another attempt.
+
+        :param order_id: the orders id (primary key)
+        :param payment_attempt: the Stripe customer of the payment, None if
+                                it failed before one was made
+        """
+        attempt = cls.payment_attempt.is_null() if payment_attempt is None else \
+            (cls.payment_attempt == payment_attempt)
+        cls.update(payment_reference=None, payment_started_on=None, payment_attempt=None)\
+            .where(cls.id == order_id, cls.order_status == "open", attempt)\
+            .execute()
+
+    @classmethod
+    def pending_payments(cls, started_before):
+        """
+        **Finds the baskets that have been being paid for too long.**
+
+        :param started_before: datetime, baskets whose payment started before this are returned
+        :return: list of (order id, payment attempt, payment reference)
+        """
+        return list(cls.select(cls.id, cls.payment_attempt, cls.payment_reference)
+                    .where(cls.payment_started_on < started_before, cls.order_status == "open")
+                    .order_by(cls.payment_started_on)
+                    .tuples())
+
+    @classmethod
+    @write_transaction
+    def dispatch_order(cls, order_id):
+        # another request may have moved the order on already
+        dispatched = cls.update(order_status="dispatched", order_dispatched_on=datetime.datetime.now())\
+            .where(cls.id == order_id, cls.order_status == "placed")\
+            .execute()
+        if dispatched:
+            OrderStatusCount.move("placed", "dispatched")
+
+    @classmethod
+    @write_transaction
+    def complete_order(cls, order_id):
+        completed = cls.update(order_status="complete", order_completed_on=datetime.datetime.now())\
+            .where(cls.id == order_id, cls.order_status == "dispatched")\
+            .execute()
+        if completed:
+            OrderStatusCount.move("dispatched", "complete")
+
+    @classmethod
+    @write_transaction
+    def cancel_order(cls, order_id):
+        with db.atomic():
+            order = cls.get_by_id(order_id)
+            # the sale is taken off the day it was placed, before the date is cleared
+            if order.order_placed_on is not None:
+                record_sale(order, -1)
+            OrderStatusCount.move(order.order_status, "cancelled")
+            cls.update(order_status="cancelled", order_placed_on=None, order_cancelled_on=datetime.datetime.now())\
+                .where(cls.id == order_id)\
+                .execute()
+
+    @classmethod
+    def get_current_basket(cls, order, user):
+        if user.is_authenticated and order is not None:
+            return order.item_count
+        else:
+            return None
+
+    @classmethod
+    def check_order_status(cls, user_id):
+        orders = cls.select().where(cls.user == user_id)
+        for order in orders:
+            if order.order_status == "placed":
+                if order.order_placed_on + datetime.timedelta(minutes=15) < datetime.datetime.now():
+                    cls.dispatch_order(order.id)
+            if order.order_status == "dispatched":
+                if order.order_placed_on + datetime.timedelta(minutes=30) < datetime.datetime.now():
+                    cls.complete_order(order.id)
+
+    @classmethod
+    @write_transaction
+    def change_shipping(cls, shipping_id, order_id):
+        cls.update(shipping=shipping_id).where(cls.id == order_id).execute()
+
+    @classmethod
+    def generate_order_report(cls, start_date, end_date):
+        start_date = datetime.datetime.combine(start_date, datetime.time())
+        end_date = datetime.datetime.combine(end_date, datetime.time())
+        # reads the archived orders as well
+        orders = []
+        for model in (cls, ArchivedOrder):
+            orders.extend(model.select().where(model.order_placed_on >= start_date,
+                                               model.order_placed_on <= end_date))
+        if not orders:
+            return None
+        else:
+            fieldnames = []
+            file_name = uuid.uuid4().hex + '.csv'
+            for key in orders[0].__data__:
+                if key != 'order_cancelled_on':
+                    if key == 'address':
+                        fieldnames.extend(['shipping_address_line_1', 'shipping_address_line_2',
+                                           'shipping_address_city', 'shipping_address_postcode'])
+                    elif key == 'shipping':
+                        fieldnames.append('shipping_option')
+                    else:
+                        fieldnames.append(key)
+            with open('static\\tmp_reports\\' + file_name, 'w+', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=fieldnames)
+                writer.writeheader()
+                for order in orders:
+                    order_dict = dict(order.__data__.items())
+                    address = AddressDetails.get_by_id(order.address_id)
+                    shipping = cache.reference.shipping_option(order.shipping_id)
+                    user = User.get_by_id(order.user_id)
+                    order_dict.pop('order_cancelled_on', None)
+                    order_dict.pop('address', None)
+                    order_dict.pop('shipping', None)
+                    order_dict.update({
+                        'user': user.email_address,
+                        'shipping_address_line_1': address.address_line_1,
+                        'shipping_address_line_2': address.address_line_2,
+                        'shipping_address_city': address.city,
+                        'shipping_address_postcode': address.postcode,
+                        'shipping_option': shipping.name,
+                        'order_total': money.format_pence(order.order_total)
+                    })
+                    order_dict.update({'order_placed_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
+                    order_dict.update({'order_dispatched_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
+                    order_dict.update({'order_completed_on': order.order_placed_on.strftime('%d/%m/%y %H:%M:%S')})
+                    writer.writerow(order_dict)
+            return file_name
+
+
+class OrderLine(BaseModel):
+    id = PrimaryKeyField()
+    product = ForeignKeyField(Product, related_name='order_line')
+    order = ForeignKeyField(Order, related_name='order_lines')
+    quantity = IntegerField(default=0)
+    size = CharField()
+    # in pence, the price the line was sold at, set when the order is placed,
+    # before then the line costs the products current price
+    unit_price = IntegerField(null=True)
+    # when the stock taken by a line in an open basket goes back on sale,
+    # indexed so the sweeper only reads the expired lines
+    reserved_until = DateTimeField(null=True, index=True)
+
+    @classmethod
+    def line_price(cls):
+        """
+        **Returns the price of a line as an SQL expression, needs a join to Product.**
+
+        :return: the price sold at, or the products price if the line isn't sold yet
+        """
+        return fn.COALESCE(cls.unit_price, Product.product_price)
+
+    @classmethod
+    def set_prices(cls, order_id, prices=None):
+        """
+        **Saves the price each line of an order is sold at.**
+
+        Lines that already have a price keep it, so an order that is cancelled
+        and placed again is sold at the same prices.
+
+        :param order_id: the orders id (primary key)
+        :param prices: dictionary of line id to the price charged, lines not in
+                       it are given their products current price
+        """
+        if prices:
+            cls.update(unit_price=Case(cls.id, list(prices.items())))\
+                .where(cls.order == order_id, cls.id << list(prices), cls.unit_price.is_null())\
+                .execute()
+        cls.update(unit_price=Product.select(Product.product_price).where(Product.id == cls.product))\
+            .where(cls.order == order_id, cls.unit_price.is_null())\
+            .execute()
+
+    @classmethod
+    @write_transaction
+    def renew_reservations(cls, order_id):
+        """
+        **Holds the stock in a basket for another** ``reservation_time``.
+
+        :param order_id: the open orders id (primary key)
+        """
+        cls.update(reserved_until=datetime.datetime.now() + reservation_time)\
+            .where(cls.order == order_id)\
+            .execute()
+
+    @classmethod
+    def release_expired(cls, now=None, batch_size=500):
+        """
+        **Puts the stock held by abandoned baskets back on sale.**
+
+        Lines in open orders whose reservation has run out are removed in batches.
+        Baskets being paid for are left alone until the payment is finished.
+        Each batch is one transaction, with one UPDATE per stock column adding the
+        quantities back, one DELETE for the lines and one UPDATE for the order totals.
+
+        :param now: time to compare the reservations with, defaults to now
+        :param batch_size: number of lines handled per transaction
+        :return: tuple of (lines removed, units put back on sale)
+        """
+        now = now or datetime.datetime.now()
+        removed = units = 0
+        with metrics.registry.timer('reservations.sweep_seconds'):
+            while True:
+                with db.atomic():
+                    batch = list(cls.select(cls.id, cls.order, cls.product, cls.size, cls.quantity)
+                                 .join(Order)
+                                 .where(cls.reserved_until < now, Order.order_status == "open",
+                                        Order.payment_started_on.is_null())
+                                 .order_by(cls.reserved_until)
+                                 .limit(batch_size)
+                                 .tuples())
+                    if not batch:
+                        break
+
+                    # {size: {product id: quantity}}
+                    returned = {}
+                    for line_id, order_id, product_id, size, quantity in batch:
+                        sizes = returned.setdefault(size, {})
+                        sizes[product_id] = sizes.get(product_id, 0) + quantity
+                    for size, quantities in returned.items():
+                        column = Product.stock_column(size)
+                        Product.update({column: column + Case(Product.id, list(quantities.items()), 0)})\
+                            .where(Product.id << list(quantities))\
+                            .execute()
+                        StockLevel.adjust_many(size, quantities)
+                    cls.delete().where(cls.id << [line[0] for line in batch]).execute()
+                    Order.update_order_totals({line[1] for line in batch})
+
+                removed += len(batch)
+                units += sum(line[4] for line in batch)
+                if len(batch) < batch_size:
+                    break
+        if removed:
+            after_commit(cache.catalog.invalidate)
+        metrics.registry.increment('reservations.reclaimed_lines', removed)
+        metrics.registry.increment('reservations.reclaimed_units', units)
+        return removed, units
+
+    @classmethod
+    def create_order_line(cls, product, order, quantity, size):
+        with db.atomic():
+            cls.create(
+                product=product,
+                order=order,
+                quantity=quantity,
+                size=size
+            )
+            Order.update_order_total(order)
+
+    @classmethod
+    @write_transaction
+    def return_order_line(cls, order_line_id):
+        """
+        **Takes a line off a placed order and puts its stock back.**
+
+        An order can't be left with no lines, so the last line is kept for the
+        order to be cancelled, though its stock is still put back.
+
+        :param order_line_id: order line id (primary key)
+        :return: False if it was the orders last line
+        """
+        line = cls.get_by_id(order_line_id)
+        if Product.get_by_id(line.product_id).product_category == "tshirt":
+            Product.increase_tshirt_stock(line.product_id, line.quantity, line.size)
+        else:
+            Product.increase_other_stock(line.product_id, line.quantity)
+        if cls.select().where(cls.order == line.order_id).count() == 1:
+            return False
+        order = Order.get_by_id(line.order_id)
+        if order.order_placed_on is not None:
+            amount = line.unit_price * line.quantity
+            day = order.order_placed_on.date()
+            add_to_rollup(DailySales, {'day': day}, revenue=-amount)
+            add_to_rollup(ProductSales, {'day': day, 'product': line.product_id, 'size': line.size},
+                          units=-line.quantity, revenue=-amount)
+        # also updates the orders total and counts
+        cls.remove_order_line(order_line_id)
+        return True
+
+    @classmethod
+    def remove_order_line(cls, order_line_id):
+        with db.atomic():
+            order_line = cls.get(id=order_line_id)
+            order_line.delete_instance()
+            Order.update_order_total(order_line.order_id)
+
+    @classmethod
+    def increase_line_quantity(cls, order_line_id, quantity_to_add):
+        with db.atomic():
+            cls.update(quantity=cls.quantity + quantity_to_add).where(cls.id == order_line_id).execute()
+            Order.update_order_total(cls.get(id=order_line_id).order_id)
+
+    @classmethod
+    def edit_line_quantity(cls, order_line_id, new_quantity):
+        with db.atomic():
+            cls.update(quantity=new_quantity).where(cls.id == order_line_id).execute()
+            Order.update_order_total(cls.get(id=order_line_id).order_id)
+
+
+class ArchivedOrder(BaseModel):
+    """
+    **Closed orders moved out of the order table.**
+
+    Completed and cancelled orders are moved here once they are old enough (see
+    :func:`~archive_orders`), so the queries run on every page only read the
+    orders still in progress. The columns match Order, the id is kept so links
+    to an order keep working.
+    """
+    id = IntegerField(primary_key=True)
+    user = ForeignKeyField(User, related_name='archived_orders')
+    address = ForeignKeyField(AddressDetails, related_name='archived_orders', null=True)
+    shipping = ForeignKeyField(ShippingOption, related_name='archived_orders', null=True)
+    order_status = CharField()
+    order_placed_on = DateTimeField(null=True, index=True)
+    order_dispatched_on = DateTimeField(null=True)
+    order_completed_on = DateTimeField(null=True)
+    order_cancelled_on = DateTimeField(null=True)
+    order_total = IntegerField(default=0)
+    shipping_cost = IntegerField(null=True)
+    item_count = IntegerField(default=0)
+    line_count = IntegerField(default=0)
+    payment_reference = CharField(null=True)
+    payment_started_on = DateTimeField(null=True)
+    payment_attempt = CharField(null=True)
+
+    # lets templates tell archived orders apart, they can't be changed or re-placed
+    archived = True
+
+    class Meta:
+        indexes = (
+            (('user', 'order_status'), False),
+        )
+
+    @classmethod
+    def archive_orders(cls, older_than, batch_size=500):
+        """
+        **Moves closed orders into the archive tables.**
+
+        Orders completed or cancelled before ``older_than`` are copied across with
+        INSERT ... SELECT and deleted, a batch at a time, each batch in its own
+        transaction.
+
+        :param older_than: datetime, orders closed before this are moved
+        :param batch_size: number of orders moved per transaction
+        :return: number of orders moved
+        """
+        closed = (((Order.order_status == "complete") & (Order.order_completed_on < older_than)) |
+                  ((Order.order_status == "cancelled") & (Order.order_cancelled_on < older_than)))
+        # SQLite gives a new row the highest id plus one, so the newest order is
+        # always left behind, otherwise its id could be given to a new order
+        newest = Order.select(fn.MAX(Order.id)).scalar()
+        order_fields = cls._meta.sorted_fields
+        # archived lines get new ids, nothing links to them
+        line_fields = [field for field in ArchivedOrderLine._meta.sorted_fields if field.name != 'id']
+        moved = 0
+        while True:
+            with db.atomic():
+                order_ids = [order_id for order_id, in Order.select(Order.id)
+                             .where(closed, Order.id < newest)
+                             .order_by(Order.id)
+                             .limit(batch_size)
+                             .tuples()]
+                if not order_ids:
+                    break
+                cls.insert_from(
+                    Order.select(*[getattr(Order, field.name) for field in order_fields])
+                         .where(Order.id << order_ids),
+                    order_fields
+                ).execute()
+                ArchivedOrderLine.insert_from(
+                    OrderLine.select(*[getattr(OrderLine, field.name) for field in line_fields])
+                             .where(OrderLine.order << order_ids),
+                    line_fields
+                ).execute()
+                OrderLine.delete().where(OrderLine.order << order_ids).execute()
+                Order.delete().where(Order.id << order_ids).execute()
+            moved += len(order_ids)
+            if len(order_ids) < batch_size:
+                break
+        metrics.registry.increment('archive.orders_moved', moved)
+        return moved
+
+
+class ArchivedOrderLine(BaseModel):
+    id = PrimaryKeyField()
+    product = ForeignKeyField(Product, related_name='archived_order_lines')
+    order = ForeignKeyField(ArchivedOrder, related_name='order_lines')
+    quantity = IntegerField(default=0)
+    size = CharField()
+    unit_price = IntegerField(null=True)
+
+
+class DailySales(BaseModel):
+    """
+    **Sales per day.**
+
+    Rollup table updated as orders are placed and cancelled, so reports never
+    have to add up the orders themselves.
+    """
+    id = PrimaryKeyField()
+    day = DateField(unique=True)
+    orders = IntegerField(default=0)
+    # in pence
+    revenue = IntegerField(default=0)
+    shipping = IntegerField(default=0)
+
+
+class ProductSales(BaseModel):
+    """
+    **Units and revenue per product, size and day.**
+
+    Rollup table updated as orders are placed and cancelled.
+    """
+    id = PrimaryKeyField()
+    day = DateField()
+    product = ForeignKeyField(Product, related_name='sales')
+    size = CharField()
+    units = IntegerField(default=0)
+    # in pence
+    revenue = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('day', 'product', 'size'), True),
+        )
+
+    @classmethod
+    def generate_sales_report(cls, start_date, end_date):
+        """
+        **Creates a CSV of sales per product and day.**
+
+        Only reads the rollup tables, so it takes the same time however many orders there are.
+
+        :param start_date: first day of the report
+        :param end_date: last day of the report
+        :return: the name of the file created, or None if nothing was sold
+        """
+        sales = cls.select(cls, Product.product_name)\
+            .join(Product)\
+            .where(cls.day >= start_date, cls.day <= end_date, cls.units != 0)\
+            .order_by(cls.day, Product.product_name)
+        if not sales.exists():
+            return None
+        else:
+            file_name = uuid.uuid4().hex + '.csv'
+            fieldnames = ['day', 'product', 'product_name', 'size', 'units', 'revenue']
+            with open('static\\tmp_reports\\' + file_name, 'w+', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=fieldnames)
+                writer.writeheader()
+                for sale in sales:
+                    writer.writerow({
+                        'day': sale.day.strftime('%d/%m/%y'),
+                        'product': sale.product_id,
+                        'product_name': sale.product.product_name,
+                        'size': sale.size,
+                        'units': sale.units,
+                        'revenue': money.format_pence(sale.revenue)
+                    })
+            return file_name
+
+
+class CoPurchase(BaseModel):
+    """
+    **Number of orders that had both of two products in them.**
+
+    Rollup table updated as orders are placed and cancelled, so the products
+    bought together never have to be found by joining the order lines to
+    themselves. Each pair is stored both ways round, so everything bought with
+    a product is one range of the ``(product, other)`` index.
+    """
+    id = PrimaryKeyField()
+    product = ForeignKeyField(Product, related_name='co_purchases')
+    other = ForeignKeyField(Product, related_name='co_purchased_with')
+    orders = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('product', 'other'), True),
+        )
+
+    @classmethod
+    def add_order(cls, product_ids, amount):
+        """
+        **Adds an order to the count of every pair of products in it.**
+
+        :param product_ids: the different products in the order
+        :param amount: 1 when the order is placed, -1 when it is cancelled
+        """
+        product_ids = set(product_ids)
+        pairs = {(product, other) for product in product_ids for other in product_ids if product != other}
+        if not pairs:
+            return
+        # the pairs already counted are updated in one statement
+        updated = cls.update(orders=cls.orders + amount)\
+            .where(cls.product << list(product_ids), cls.other << list(product_ids), cls.product != cls.other)\
+            .execute()
+        if updated < len(pairs):
+            existing = cls.select(cls.product, cls.other)\
+                .where(cls.product << list(product_ids), cls.other << list(product_ids))\
+                .tuples()
+            for product, other in pairs - set(existing):
+                add_to_rollup(cls, {'product': product, 'other': other}, orders=amount)
+
+    @classmethod
+    def suggestions(cls, order_id, limit):
+        """
+        **Finds the products most often bought with the ones in a basket.**
+
+        One query, which looks up the products in the basket in the
+        ``(product, other)`` index. Products already in the basket or out of
+        stock aren't suggested.
+
+        :param order_id: the baskets id (primary key)
+        :param limit: most products to return
+        :return: list of products, each with ``bought_together``, the number of orders shared
+        """
+        in_basket = OrderLine.select(OrderLine.product).where(OrderLine.order == order_id)
+        bought_together = fn.SUM(cls.orders)
+        return list(Product.select(Product, bought_together.alias('bought_together'))
+                    .join(cls, on=(cls.other == Product.id))
+                    .where(cls.product << in_basket, cls.other.not_in(in_basket), cls.orders > 0,
+                           Product.one_size_stock + Product.small_stock + Product.medium_stock +
+                           Product.large_stock > 0)
+                    .group_by(Product.id)
+                    .order_by(bought_together.desc(), Product.id)
+                    .limit(limit))
+
+    @classmethod
+    def rebuild(cls):
+        """
+        **Fills the table from the full order history.**
+
+        Used once to backfill the table, by ``manage.py backfill-co-purchases``,
+        or to repair it. Anything already in it is replaced.
+        """
+        with db.atomic():
+            cls.delete().execute()
+            for order_model, line_model in ((Order, OrderLine), (ArchivedOrder, ArchivedOrderLine)):
+                other_line = line_model.alias()
+                query = line_model.select(line_model.product, other_line.product,
+                                          fn.COUNT(fn.DISTINCT(line_model.order)))\
+                    .join(other_line, on=((other_line.order == line_model.order) &
+                                          (other_line.product != line_model.product)))\
+                    .switch(line_model)\
+                    .join(order_model)\
+                    .where(order_model.order_status << ["placed", "dispatched", "complete"])\
+                    .group_by(line_model.product, other_line.product)
+                if order_model is Order:
+                    cls.insert_from(query, [cls.product, cls.other, cls.orders]).execute()
+                else:
+                    # archived orders are added on top of the rows made from the hot tables
+                    for product, other, orders in query.tuples():
+                        add_to_rollup(cls, {'product': product, 'other': other}, orders=orders)
+
+
+class OrderStatusCount(BaseModel):
+    """
+    **Number of orders in each status.**
+
+    Rollup table updated by every order status change.
+    """
+    id = PrimaryKeyField()
+    order_status = CharField(unique=True)
+    orders = IntegerField(default=0)
+
+    @classmethod
+    def add(cls, order_status, amount):
+        add_to_rollup(cls, {'order_status': order_status}, orders=amount)
+
+    @classmethod
+    def move(cls, old_status, new_status):
+        if old_status != new_status:
+            cls.add(old_status, -1)
+            cls.add(new_status, 1)
+
+
+class PaymentEvent(BaseModel):
+    """
+    **Queue of the payment events sent to the Stripe webhook.**
+
+    The webhook only stores each event, a consumer (``manage.py
+    process-payment-events``) takes them off the queue in batches, see
+    :func:`~payments.process_payment_events`. Stripe can send an event more than
+    once, so ``event_id`` is unique and a repeat is dropped.
+    """
+    id = PrimaryKeyField()
+    event_id = CharField(unique=True)
+    event_type = CharField()
+    payload = TextField()
+    received_on = DateTimeField(default=datetime.datetime.now)
+    processed_on = DateTimeField(null=True)
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+    # events that have failed this many times are left for someone to look at
+    MAX_ATTEMPTS = 10
+
+    class Meta:
+        indexes = (
+            (('processed_on', 'id'), False),
+        )
+
+    @classmethod
+    @write_transaction
+    def enqueue(cls, event_id, event_type, payload):
+        """
+        **Adds an event to the queue, unless it is already there.**
+
+        :param event_id: Stripe's id for the event
+        :param event_type: e.g. "charge.succeeded"
+        :param payload: the event as JSON text
+        :return: True if the event is new
+        """
+        return bool(cls.insert(event_id=event_id, event_type=event_type, payload=payload)
+                    .on_conflict_ignore()
+                    .execute())
+
+    @classmethod
+    def next_batch(cls, batch_size):
+        """
+        **Returns the oldest events that haven't been processed.**
+
+        :param batch_size: most events to return
+        :return: list of events, oldest first
+        """
+        return list(cls.select()
+                    .where(cls.processed_on.is_null(), cls.attempts < cls.MAX_ATTEMPTS)
+                    .order_by(cls.id)
+                    .limit(batch_size))
+
+    @classmethod
+    def mark_processed(cls, event_ids):
+        """
+        **Takes events off the queue.**
+
+        :param event_ids: ids (primary keys) of the events
+        """
+        if event_ids:
+            cls.update(processed_on=datetime.datetime.now()).where(cls.id << list(event_ids)).execute()
+
+    @classmethod
+    def record_failure(cls, event_id, error):
+        """
+        **Leaves an event on the queue to be tried again, noting why it failed.**
+
+        :param event_id: id (primary key) of the event
+        :param error: what went wrong
+        """
+        cls.update(attempts=cls.attempts + 1, last_error=str(error)).where(cls.id == event_id).execute()
+
+    @classmethod
+    def backlog(cls):
+        """
+        **Counts the events waiting to be processed.**
+
+        :return: number of events
+        """
+        return cls.select().where(cls.processed_on.is_null(), cls.attempts < cls.MAX_ATTEMPTS).count()
+
+
+def add_to_rollup(model, key, **amounts):
+    """
+    **Adds amounts to the counters of a rollup row, creating the row if it isn't there.**
+
+    :param model: the rollup model
+    :param key: dictionary of the columns that identify the row
+    :param amounts: the amount to add to each counter column
+    """
+    query = model.update({getattr(model, name): getattr(model, name) + amount for name, amount in amounts.items()})\
+        .where(*[getattr(model, name) == value for name, value in key.items()])
+    if not query.execute():
+        values = dict(key)
+        values.update(amounts)
+        try:
+            with db.atomic():
+                model.create(**values)
+        except IntegrityError:
+            # another request created the row first
+            query.execute()
+
+
+def record_sale(order, sign):
+    """
+    **Adds an order to, or takes it off, the sales rollups for the day it was placed.**
+
+    The amounts are the ones saved when the order was placed, so cancelling an
+    order takes off exactly what placing it added. The products in it are
+    counted as bought together too, see :class:`CoPurchase`.
+
+    :param order: the order
+    :param sign: 1 when the order is placed, -1 when it is cancelled
+    """
+    day = order.order_placed_on.date()
+    add_to_rollup(DailySales, {'day': day}, orders=sign,
+                  revenue=sign * order.order_total, shipping=sign * order.shipping_cost)
+    lines = OrderLine.select(OrderLine.product, OrderLine.size, OrderLine.quantity, OrderLine.unit_price)\
+        .where(OrderLine.order == order.id)\
+        .tuples()
+    product_ids = set()
+    for product_id, size, quantity, price in lines:
+        add_to_rollup(ProductSales, {'day': day, 'product': product_id, 'size': size},
+                      units=sign * quantity, revenue=sign * price * quantity)
+        product_ids.add(product_id)
+    CoPurchase.add_order(product_ids, sign)
+
+
+def rebuild_rollups():
+    """
+    **Fills the rollup tables from the full order history.**
+
+    Used once to backfill the tables, or to repair them. Anything already in
+    them is replaced.
+    """
+    with db.atomic():
+        StockLevel.rebuild()
+        DailySales.delete().execute()
+        ProductSales.delete().execute()
+        OrderStatusCount.delete().execute()
+        for model, key, amounts, query in _rollup_sources(Order, OrderLine):
+            model.insert_from(query, [getattr(model, name) for name in key + amounts]).execute()
+        # archived orders are added on top of the rows made from the hot tables
+        for model, key, amounts, query in _rollup_sources(ArchivedOrder, ArchivedOrderLine):
+            for row in query.tuples():
+                add_to_rollup(model, dict(zip(key, row)), **dict(zip(amounts, row[len(key):])))
+
+
+def _rollup_sources(order_model, line_model):
+    """
+    **Returns the grouped queries the rollup tables are filled from.**
+
+    :param order_model: Order or ArchivedOrder
+    :param line_model: the matching order line model
+    :return: list of (rollup model, key columns, counter columns, query)
+    """
+    sold = (order_model.order_status << ["placed", "dispatched", "complete"])
+    day = fn.date(order_model.order_placed_on)
+    return [
+        (DailySales, ['day'], ['orders', 'revenue', 'shipping'],
+         order_model.select(day, fn.COUNT(order_model.id), fn.SUM(order_model.order_total),
+                            fn.SUM(order_model.shipping_cost))
+                    .where(sold)
+                    .group_by(day)),
+        (ProductSales, ['day', 'product', 'size'], ['units', 'revenue'],
+         line_model.select(day, line_model.product, line_model.size, fn.SUM(line_model.quantity),
+                           fn.SUM(line_model.quantity * line_model.unit_price))
+                   .join(order_model)
+                   .where(sold)
+                   .group_by(day, line_model.product, line_model.size)),
+        (OrderStatusCount, ['order_status'], ['orders'],
+         order_model.select(order_model.order_status, fn.COUNT(order_model.id))
+                    .group_by(order_model.order_status)),
+    ]
+
+
+MODELS = [User, AddressDetails, ShippingOption, Product, StockLevel, Order, OrderLine,
+          ArchivedOrder, ArchivedOrderLine, DailySales, ProductSales, CoPurchase, OrderStatusCount,
+          PaymentEvent]
+
+
+def configure_database(path, pool_size=None, pragmas=None):
+    """
+    **Points every model at a database.**
+
+    :param path: path of the SQLite database file
+    :param pool_size: number of connections to keep open, None opens a new one each time
+    :param pragmas: dictionary of SQLite pragmas set on each connection
+    :return: the database
+    """
+    global db
+    pragmas = tuple((pragmas or {}).items())
+    if pool_size:
+        from playhouse.pool import PooledSqliteDatabase
+        database = PooledSqliteDatabase(path, max_connections=pool_size, stale_timeout=300, pragmas=pragmas)
+    else:
+        database = SqliteDatabase(path, pragmas=pragmas)
+    database.bind(MODELS)
+    db = database
+    return db
+
+
+def add_missing_columns():
+    """
+    **Adds columns that have been added to the models to existing tables.**
+
+    ``create_tables`` only creates tables that don't exist, so a database made
+    before a column was added needs it adding with an ALTER TABLE. New columns
+    must either allow NULL or have a default.
+
+    :return: list of the columns added, as "table.column"
+    """
+    from playhouse.migrate import SqliteMigrator, migrate
+    migrator = SqliteMigrator(db)
+    tables = db.get_tables()
+    added = []
+    for model in MODELS:
+        table = model._meta.table_name
+        if table not in tables:
+            continue
+        existing = {column.name for column in db.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                # the index is made afterwards by create_tables
+                index, field.index = field.index, False
+                try:
+                    migrate(migrator.add_column(table, field.column_name, field))
+                finally:
+                    field.index = index
+                added.append(table + '.' + field.column_name)
+    return added
+
+
+# version of the data kept in SQLite's user_version, moved on by migrate_data
+SCHEMA_VERSION = 3
+
+# columns holding money, kept in pounds as decimals before schema version 1 and in pence since
+MONEY_COLUMNS = [(Product, 'product_price'), (ShippingOption, 'cost'), (Order, 'order_total'),
+                 (ArchivedOrder, 'order_total'), (DailySales, 'revenue'), (DailySales, 'shipping'),
+                 (ProductSales, 'revenue')]
+
+
+def migrate_data(tables):
+    """
+    **Changes the data in an existing database to match the models.**
+
+    :func:`~add_missing_columns` deals with the columns, this deals with data
+    that is stored differently. The database's ``user_version`` records the
+    last change made, so each one is only made once:
+
+    1. money is stored in whole pence rather than pounds, the columns keep
+       their old DECIMAL type, which stores whole numbers as integers
+    2. orders placed before the shipping cost and line prices were saved are
+       given the current ones, the closest there is to what was charged
+    3. baskets left waiting for a payment event from before the start of a
+       payment was saved are given one, so they are checked with Stripe by
+       :func:`~payments.check_pending_payments` like the rest
+
+    :param tables: the tables in the database before any were created
+    :return: list of the versions the data was moved through
+    """
+    version = db.execute_sql('PRAGMA user_version').fetchone()[0]
+    migrated = []
+    if version < 1 and tables:
+        for model, column in MONEY_COLUMNS:
+            if model._meta.table_name in tables:
+                db.execute_sql('UPDATE "{0}" SET "{1}" = CAST(ROUND("{1}" * 100) AS INTEGER)'.format(
+                    model._meta.table_name, column))
+        migrated.append(1)
+    if version < 2 and tables:
+        for order_model, line_model in ((Order, OrderLine), (ArchivedOrder, ArchivedOrderLine)):
+            if order_model._meta.table_name not in tables:
+                continue
+            placed = order_model.select(order_model.id).where(order_model.order_placed_on.is_null(False))
+            line_model.update(unit_price=Product.select(Product.product_price).where(Product.id == line_model.product))\
+                .where(line_model.unit_price.is_null(), line_model.order << placed)\
+                .execute()
+            # MAX gives one row, and COALESCE makes it 0 for an order without a shipping option
+            cost = ShippingOption.select(fn.COALESCE(fn.MAX(ShippingOption.cost), 0))\
+                .where(ShippingOption.id == order_model.shipping)
+            order_model.update(shipping_cost=cost)\
+                .where(order_model.shipping_cost.is_null(), order_model.order_placed_on.is_null(False))\
+                .execute()
+        migrated.append(2)
+    if version < 3 and tables and Order._meta.table_name in tables:
+        Order.update(payment_started_on=datetime.datetime.now())\
+            .where(Order.order_status == "open", Order.payment_reference.is_null(False),
+                   Order.payment_started_on.is_null())\
+            .execute()
+        migrated.append(3)
+    if version < SCHEMA_VERSION:
+        db.execute_sql('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+    return migrated
+
+
+def initialize():
+    """
+    **Creates any missing tables, columns and indexes, and migrates the data.**
+
+    :return: list of the columns added to existing tables
+    """
+    db.connect()
+    try:
+        with db.atomic():
+            tables = db.get_tables()
+            added = add_missing_columns()
+            migrate_data(tables)
+            if AddressDetails._meta.table_name in tables:
+                AddressDetails.remove_extra_defaults()
+            db.create_tables(MODELS, safe=True)
+            # a database made before the stock levels were added needs them filling in
+            if StockLevel._meta.table_name not in tables:
+                StockLevel.rebuild()
+    finally:
+        db.close()
+    return added
+
+
+def seed_defaults():
+    """
+    **Creates the admin user and shipping options if they don't exist yet.**
+
+    Safe to run more than once.
+    """
+    with db.atomic():
+        if not User.select().where(User.email_address == "contact@nativesins.com").exists():
+            User.create_user(
+                first_name="Admin",
+                last_name="User",
+                email_address="contact@nativesins.com",
+                password="password",
+                user_role="admin"
+            )
+        for name, cost in (("first_class", 200), ("second_class", 100)):
+            if not ShippingOption.select().where(ShippingOption.name == name).exists():
+                ShippingOption.create_shipping_option(name=name, cost=cost)
@@ -0,0 +1,51 @@
+"""
+    money.py converts between the amounts people type and read, in pounds, and
+    the whole pence the database stores.
+
+    Prices, shipping costs, order totals and the sales rollups are all kept as
+    integers, so SQLite adds them up with an integer SUM and nothing is lost to
+    rounding. Amounts only become pounds at the edges, when a form is read or a
+    page, report or API response is made::
+
+        product_price = money.to_pence(form.product_price.data)   # 12.5 -> 1250
+        money.format_pence(1250)                                   # "12.50"
+
+    Templates use the ``money`` filter, e.g. ``£{{ order.order_total|money }}``.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import decimal
+
+
+def to_pence(pounds):
+    """
+    **Turns an amount in pounds into whole pence, rounding half a penny up.**
+
+    :param pounds: the amount, e.g. 12.5, "12.50" or a Decimal
+    :return: the amount in pence as an int
+    :raises decimal.InvalidOperation: if the amount isn't a number
+    """
+    pence = decimal.Decimal(str(pounds)) * 100
+    return int(pence.quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+
+
+def to_pounds(pence):
+    """
+    **Turns whole pence into pounds.**
+
+    :param pence: the amount in pence
+    :return: the amount as a Decimal with two decimal places
+    """
+    return (decimal.Decimal(int(pence or 0)) / 100).quantize(decimal.Decimal('0.01'))
+
+
+def format_pence(pence):
+    """
+    **Formats whole pence as pounds for showing, without the £ sign.**
+
+    :param pence: the amount in pence, None is shown as 0.00
+    :return: e.g. "12.50" or "-0.99"
+    """
+    return str(to_pounds(pence))
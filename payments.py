@@ -0,0 +1,451 @@
+"""
+    payments.py takes payment for a basket and places the order, in four stages:
+
+    1. price, the order, its lines, products and shipping are read in one query
+    2. reserve, the basket's stock is checked and held while paying
+    3. charge, the card is charged through Stripe
+    4. commit, the order is placed and the payment saved in one transaction
+
+    When a stage fails, what the stages before it did is undone. A failed charge
+    lets the stock go back on sale when it would have anyway, and a basket that
+    changes while the card is charged gets the payment refunded. A charge that
+    times out may still go through, so its basket stays held until
+    :func:`~check_pending_payments` asks Stripe what happened.
+
+    Each stage is timed in :data:`metrics.registry` as ``checkout.<stage>_seconds``.
+
+    With ``PAYMENT_CONFIRMATION = 'webhook'`` the commit stage is left to
+    Stripe's charge.succeeded event. The webhook queues each event in
+    :class:`~models.PaymentEvent` and :func:`~process_payment_events` places
+    the orders a batch at a time, so /pay returns once the card is charged.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+import metrics
+import models
+import resilience
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutError(Exception):
+    """
+    **A checkout that couldn't be finished, the message can be shown to the customer.**
+    """
+
+
+class BasketChanged(CheckoutError):
+    """
+    **The basket expired or changed, so it has to be checked before paying again.**
+    """
+
+
+class PaymentFailed(CheckoutError):
+    """
+    **The card wasn't charged.**
+    """
+
+
+class PaymentPending(CheckoutError):
+    """
+    **Stripe didn't answer in time, so whether the card was charged isn't known yet.**
+    """
+
+
+class RefundFailed(CheckoutError):
+    """
+    **The card was charged but the order couldn't be placed or the payment refunded.**
+
+    ``charge_id`` is the payment that needs refunding by hand.
+    """
+
+    def __init__(self, message, charge_id):
+        super(RefundFailed, self).__init__(message)
+        self.charge_id = charge_id
+
+
+class SignatureError(Exception):
+    """
+    **A webhook request that wasn't signed by Stripe with the shared secret, or isn't an event.**
+    """
+
+
+def basket_key(quote):
+    """
+    **Describes the lines of a priced basket, so a payment can be matched to them later.**
+
+    :param quote: basket from :func:`~models.Order.price_basket`
+    :return: e.g. "12x2,13x1" for line 12 with 2 items and line 13 with 1
+    """
+    return ",".join("{}x{}".format(line_id, quantity) for line_id, quantity in quote['lines'])
+
+
+def create_customer(stripe, email, token):
+    """
+    **Creates the Stripe customer an attempt to pay is charged through.**
+
+    Each attempt has a customer of its own, so its charge can be found by the
+    customer. It isn't given an idempotency key, making an extra one does no harm.
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param email: customers email address
+    :param token: card token from Stripe Checkout
+    :return: the customer id
+    """
+    return resilience.call('stripe', stripe.Customer.create, email=email, source=token).id
+
+
+def charge_card(stripe, quote, customer_id):
+    """
+    **Charges a customer for a priced basket.**
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param quote: basket from :func:`~models.Order.price_basket`
+    :param customer_id: customer from :func:`~create_customer`
+    :return: the charge id
+    """
+    charge = resilience.call(
+        'stripe',
+        stripe.Charge.create,
+        customer=customer_id,
+        amount=quote['amount'],
+        currency='gbp',
+        description='Native Sins',
+        metadata={'order_id': quote['order_id'], 'basket': basket_key(quote)},
+        # a request sent again after a timeout can't charge the basket twice, the
+        # customer makes the key different for each attempt, as Stripe turns away
+        # a key sent again with other parameters
+        idempotency_key='order-{}-{}'.format(quote['order_id'], customer_id)
+    )
+    return charge.id
+
+
+def refund_charge(stripe, charge_id):
+    """
+    **Refunds a charge in full.**
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param charge_id: the charge to refund
+    """
+    resilience.call('stripe', stripe.Refund.create, charge=charge_id,
+                    idempotency_key='refund-{}'.format(charge_id))
+
+
+def pay_for_order(order_id, email, token, stripe, wait_for_event=False):
+    """
+    **Takes payment for a basket and places the order.**
+
+    :param order_id: the open orders id (primary key)
+    :param email: customers email address
+    :param token: card token from Stripe Checkout
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param wait_for_event: leave placing the order to the charge.succeeded event
+    :return: the placed order, or None when waiting for the event
+    :raises BasketChanged: if the basket expired or changed, nothing was charged
+                           or the charge was refunded
+    :raises PaymentFailed: if the card was declined or Stripe isn't working
+    :raises PaymentPending: if Stripe didn't answer in time, the basket stays held
+    :raises RefundFailed: if the order couldn't be placed and the refund failed
+    :raises CheckoutError: if the basket is already being paid for
+    """
+    with metrics.registry.timer('checkout.price_seconds'):
+        quote = models.Order.price_basket(order_id)
+    if quote is None:
+        raise BasketChanged("Your basket expired, please add the items again")
+    if quote['payment_started_on'] is not None or quote['payment_reference'] is not None:
+        raise CheckoutError("Your payment is already being processed")
+
+    with metrics.registry.timer('checkout.reserve_seconds'):
+        held = models.Order.hold_for_payment(quote)
+    if not held:
+        raise BasketChanged("Your basket changed, please check it before paying")
+
+    customer_id = None
+    try:
+        with metrics.registry.timer('checkout.charge_seconds'):
+            customer_id = create_customer(stripe, email, token)
+            models.Order.record_payment_attempt(order_id, customer_id)
+            charge_id = charge_card(stripe, quote, customer_id)
+    except stripe.error.CardError as error:
+        models.Order.release_payment_hold(quote)
+        metrics.registry.increment('checkout.declined')
+        raise PaymentFailed(error.user_message or "Your card was declined")
+    except (resilience.ServiceUnavailable, stripe.error.StripeError) as error:
+        if customer_id is not None and isinstance(error, (resilience.ServiceTimeout,
+                                                          stripe.error.APIConnectionError)):
+            # the charge may still go through, so the stock stays held until
+            # check_pending_payments finds out from Stripe
+            metrics.registry.increment('checkout.charge_unknown')
+            raise PaymentPending("We couldn't confirm your payment yet, your basket is held while we "
+                                 "check and your order will be placed if the payment went through")
+        models.Order.release_payment_hold(quote)
+        metrics.registry.increment('checkout.charge_failures')
+        raise PaymentFailed("Payments aren't working right now, please try again in a few minutes")
+
+    if wait_for_event:
+        if models.Order.await_payment_event(order_id, charge_id):
+            metrics.registry.increment('checkout.awaiting_event')
+            return None
+        order = None
+        failure = "Your basket was paid for at the same time"
+    else:
+        try:
+            with metrics.registry.timer('checkout.commit_seconds'):
+                order = models.Order.complete_payment(quote, charge_id)
+        except Exception:
+            order = None
+            failure = "Your order couldn't be placed"
+        else:
+            failure = "Your basket changed while paying"
+    if order is None:
+        # the charge's event may have placed the order first, which isn't a reason to refund it
+        order = models.Order.placed_with(order_id, charge_id)
+    if order is not None:
+        metrics.registry.increment('checkout.placed')
+        return order
+
+    try:
+        refund_charge(stripe, charge_id)
+    except Exception:
+        metrics.registry.increment('checkout.refund_failures')
+        raise RefundFailed(failure + ", the payment will be refunded", charge_id)
+    models.Order.cancel_payment_wait(order_id, customer_id)
+    metrics.registry.increment('checkout.refunded')
+    raise BasketChanged(failure + " and the payment has been refunded, please try again")
+
+
+def read_webhook(payload, signature, secret, tolerance=300, now=None):
+    """
+    **Checks the signature of a webhook request and reads the event in it.**
+
+    Stripe signs ``"<timestamp>.<payload>"`` with HMAC-SHA256 and sends
+    ``t=<timestamp>,v1=<signature>`` in the Stripe-Signature header. Old
+    timestamps are turned away so a captured request can't be sent again.
+
+    :param payload: body of the request as bytes
+    :param signature: the Stripe-Signature header
+    :param secret: the webhook's signing secret
+    :param tolerance: oldest timestamp accepted, in seconds
+    :param now: time in seconds, defaults to the current time
+    :return: the event as a dictionary
+    :raises SignatureError: if the signature is missing, wrong or too old
+    """
+    if not secret:
+        raise SignatureError("No webhook secret is set")
+    parts = [part.split("=", 1) for part in signature.split(",") if "=" in part]
+    timestamps = [value for key, value in parts if key == "t"]
+    signatures = [value for key, value in parts if key == "v1"]
+    if not timestamps or not signatures:
+        raise SignatureError("Signature header is missing its timestamp or signature")
+    expected = hmac.new(secret.encode(), timestamps[0].encode() + b"." + payload, hashlib.sha256).hexdigest()
+    if not any(hmac.compare_digest(expected, value) for value in signatures):
+        raise SignatureError("Signature doesn't match")
+    try:
+        age = (time.time() if now is None else now) - int(timestamps[0])
+    except ValueError:
+        raise SignatureError("Timestamp isn't a number")
+    if abs(age) > tolerance:
+        raise SignatureError("Timestamp is too old")
+    try:
+        event = json.loads(payload.decode())
+    except ValueError:
+        raise SignatureError("Payload isn't JSON")
+    if not isinstance(event, dict) or 'id' not in event or 'type' not in event:
+        raise SignatureError("Payload isn't an event")
+    return event
+
+
+def settle_charge(event_type, charge):
+    """
+    **Works out what a charge event means for the order it paid for.**
+
+    Runs in the transaction of :func:`~apply_payment_events`. A charge that
+    matches its basket places the order, a failed charge or one for a basket
+    that has changed lets the basket be paid for again.
+
+    :param event_type: e.g. "charge.succeeded"
+    :param charge: the charge in the event
+    :return: "placed", "refund" if the basket changed after it was charged,
+             or "ignored" if there is nothing to do
+    """
+    metadata = charge.get('metadata') or {}
+    if 'order_id' not in metadata:
+        return "ignored"
+    order_id = int(metadata['order_id'])
+    if event_type == "charge.failed":
+        models.Order.cancel_payment_wait(order_id, charge.get('customer'))
+        return "ignored"
+    if event_type != "charge.succeeded":
+        return "ignored"
+    quote = models.Order.price_basket(order_id)
+    if (quote is not None and basket_key(quote) == metadata.get('basket')
+            and quote['amount'] == charge['amount'] and quote['payment_reference'] in (None, charge['id'])):
+        if models.Order.complete_payment(quote, charge['id']) is not None:
+            return "placed"
+    elif models.Order.placed_with(order_id, charge['id']) is not None:
+        # a repeat of an event that has already placed the order
+        return "ignored"
+    # the basket can be paid for again once it has been checked
+    models.Order.cancel_payment_wait(order_id, charge.get('customer'))
+    return "refund"
+
+
+@models.write_transaction
+def apply_charge(event_type, charge):
+    """
+    **Runs** :func:`~settle_charge` **in a transaction of its own.**
+    """
+    return settle_charge(event_type, charge)
+
+
+@models.write_transaction
+def apply_payment_events(events):
+    """
+    **Applies a batch of events to the orders, in one transaction.**
+
+    An event that fails is left on the queue with its error and tried again
+    later, see :meth:`~models.PaymentEvent.record_failure`, so it doesn't stop
+    the events behind it being applied.
+
+    :param events: list of :class:`~models.PaymentEvent`
+    :return: list of (event, charge id) for the charges that need refunding,
+             the other events that worked are marked as processed
+    """
+    refunds = []
+    done = []
+    for event in events:
+        try:
+            # a savepoint, so an event that fails part way changes nothing
+            with models.db.atomic():
+                charge = json.loads(event.payload)['data']['object']
+                outcome = settle_charge(event.event_type, charge)
+        except (ValueError, TypeError, KeyError) as error:
+            # nothing can be done with a malformed event, trying it again won't help
+            models.PaymentEvent.update(last_error="Malformed event: {}".format(error))\
+                .where(models.PaymentEvent.id == event.id).execute()
+            outcome = "ignored"
+        except Exception as error:
+            logger.exception("Payment event %s couldn't be applied", event.event_id)
+            metrics.registry.increment('payments.event_failures')
+            models.PaymentEvent.record_failure(event.id, error)
+            continue
+        metrics.registry.increment('payments.events_' + outcome)
+        if outcome == "refund":
+            refunds.append((event, charge['id']))
+        else:
+            done.append(event.id)
+    models.PaymentEvent.mark_processed(done)
+    return refunds
+
+
+def process_payment_events(stripe, batch_size=100):
+    """
+    **Takes a batch of events off the queue and places the orders they paid for.**
+
+    The orders are placed in one transaction and the refunds are made after
+    it. An event whose refund fails stays on the queue to be tried again,
+    refunds are idempotent so this never refunds a charge twice.
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param batch_size: most events to take
+    :return: number of events taken
+    """
+    with metrics.registry.timer('payments.batch_seconds'):
+        events = models.PaymentEvent.next_batch(batch_size)
+        if not events:
+            return 0
+        refunds = apply_payment_events(events)
+        refunded = []
+        for event, charge_id in refunds:
+            try:
+                refund_charge(stripe, charge_id)
+            except Exception as error:
+                metrics.registry.increment('payments.refund_failures')
+                models.PaymentEvent.record_failure(event.id, error)
+            else:
+                refunded.append(event.id)
+        models.PaymentEvent.mark_processed(refunded)
+    now = datetime.datetime.now()
+    for event in events:
+        metrics.registry.observe('payments.event_wait_seconds', (now - event.received_on).total_seconds())
+    return len(events)
+
+
+def find_charge(stripe, order_id, payment_attempt, payment_reference=None):
+    """
+    **Asks Stripe for the charge made by an attempt to pay for a basket.**
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param order_id: the orders id (primary key)
+    :param payment_attempt: the Stripe customer of the attempt, or None
+    :param payment_reference: the charge waiting for its event, used when there
+                              is no attempt, e.g. for a payment made before
+                              attempts were saved
+    :return: the charge as a dictionary, like the one in an event, or None if
+             the basket wasn't charged
+    """
+    if payment_attempt is None:
+        if payment_reference is None:
+            return None
+        return resilience.call('stripe', stripe.Charge.retrieve, payment_reference).to_dict()
+    charges = resilience.call('stripe', stripe.Charge.list, customer=payment_attempt, limit=10)
+    for charge in charges.data:
+        # stripe objects aren't dictionaries, settle_charge reads the same keys from an event
+        charge = charge.to_dict()
+        if (charge.get('metadata') or {}).get('order_id') == str(order_id):
+            return charge
+    return None
+
+
+def check_pending_payments(stripe, started_before):
+    """
+    **Finishes the payments that have been going on for too long.**
+
+    A payment is left going on when Stripe didn't answer the charge in time,
+    or when the charge.succeeded event never reaches the webhook. Each basket's
+    charge is looked up, then the order is placed or the charge refunded as if
+    its event had come, and a basket that wasn't charged can be paid for again.
+    The stock isn't let go until Stripe has said what happened.
+
+    :param stripe: the stripe module, see :func:`~app.get_stripe`
+    :param started_before: datetime, payments started before this are checked
+    :return: dictionary counting the outcomes, "placed", "refund", "released",
+             "pending" and "failed", the charges that couldn't be refunded are in
+             "unrefunded"
+    """
+    outcomes = {'placed': 0, 'refund': 0, 'released': 0, 'pending': 0, 'failed': 0, 'unrefunded': []}
+    for order_id, payment_attempt, payment_reference in models.Order.pending_payments(started_before):
+        try:
+            charge = find_charge(stripe, order_id, payment_attempt, payment_reference)
+        except (resilience.ServiceUnavailable, stripe.error.StripeError):
+            # tried again next time
+            outcomes['failed'] += 1
+            continue
+        if charge is not None and charge['status'] == "pending":
+            outcome = "pending"
+        elif charge is None or charge['status'] != "succeeded" or charge.get('refunded'):
+            models.Order.cancel_payment_wait(order_id, payment_attempt)
+            outcome = "released"
+        else:
+            outcome = apply_charge("charge.succeeded", charge)
+            if outcome == "ignored":
+                # an event placed the order first
+                outcome = "placed"
+        if outcome == "refund":
+            try:
+                refund_charge(stripe, charge['id'])
+            except Exception:
+                metrics.registry.increment('payments.refund_failures')
+                outcomes['unrefunded'].append(charge['id'])
+        metrics.registry.increment('payments.pending_' + outcome)
+        outcomes[outcome] += 1
+    return outcomes
@@ -0,0 +1,268 @@
+"""
+    query_plans.py guards the queries behind the busiest pages of the shop.
+
+    It seeds a throwaway database, records the SQL that the hot model methods
+    and routes send to SQLite, runs ``EXPLAIN QUERY PLAN`` on each statement and
+    fails if a table that should be searched through an index is scanned instead,
+    or if a page runs more queries than its budget allows.
+
+    Run it from the project folder with ``python query_plans.py``. It exits with
+    a status of 1 when any check fails so it can be used as a build step.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import datetime
+import os
+import re
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import models
+
+# matches a plan line that walks a whole table without an index, the optional
+# "TABLE" keeps it working on older versions of SQLite
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(?!.*\bUSING\b)')
+
+# matches a plan line where SQLite has to sort the rows itself
+TEMP_SORT = re.compile(r'USE TEMP B-TREE FOR ORDER BY')
+
+# the most queries each page is allowed to run for a logged in customer
+ROUTE_BUDGETS = {
+    '/': 6,
+    '/products': 6,
+    '/about': 6,
+    '/basket/{user_id}': 12,
+    '/orders/{user_id}': 20,
+}
+
+# password given to the seeded customer so the routes can be requested logged in
+SEED_PASSWORD = 'password'
+
+
+@contextmanager
+def record_queries(database):
+    """
+    **Records every statement sent to the database.**
+
+    Wraps :func:`~peewee.Database.execute_sql` for the length of the ``with``
+    block and appends each ``(sql, params)`` pair to the list it yields.
+
+    :param database: the peewee database to watch
+    :return: list of the statements executed
+    """
+    queries = []
+    execute_sql = database.execute_sql
+
+    def recording_execute_sql(sql, params=None, *args, **kwargs):
+        queries.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    database.execute_sql = recording_execute_sql
+    try:
+        yield queries
+    finally:
+        del database.execute_sql
+
+
+def explain(database, sql, params):
+    """
+    **Returns the query plan for a statement.**
+
+    :param database: the peewee database the statement belongs to
+    :param sql: the SQL that was executed
+    :param params: the parameters it was executed with
+    :return: list of plan lines, e.g. ``SEARCH order USING INDEX ...``
+    """
+    cursor = database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def plan_problems(plan, sorted_query=False):
+    """
+    **Finds the lines in a query plan that should not be there.**
+
+    :param plan: list of plan lines from :func:`~explain`
+    :param sorted_query: True if the rows are expected to come out of an index already sorted
+    :return: list of the offending plan lines
+    """
+    problems = []
+    for line in plan:
+        if FULL_SCAN.match(line):
+            problems.append(line)
+        elif sorted_query and TEMP_SORT.search(line):
+            problems.append(line)
+    return problems
+
+
+def seed(customers=200, products=60, orders_per_customer=5):
+    """
+    **Fills the current database with enough rows for the planner to prefer indexes.**
+
+    :param customers: number of customers to create
+    :param products: number of products to create
+    :param orders_per_customer: number of orders each customer has
+    :return: the customer that the route checks log in as
+    """
+    now = datetime.datetime.now()
+    categories = ['tshirt', 'hat', 'cd']
+    with models.db.atomic():
+        models.User.create_user('Query', 'Plans', 'plans@nativesins.com', SEED_PASSWORD, 'customer')
+        models.User.insert_many([{
+            'first_name': 'Customer',
+            'last_name': str(number),
+            'email_address': 'customer{}@nativesins.com'.format(number),
+            'password': 'not-a-real-hash',
+            'date_created': now - datetime.timedelta(days=number),
+        } for number in range(customers)]).execute()
+        models.ShippingOption.create_shipping_option(name='first_class', cost=200)
+        models.ShippingOption.create_shipping_option(name='second_class', cost=100)
+        models.Product.insert_many([{
+            'product_category': categories[number % 3],
+            'product_name': 'Product {}'.format(number),
+            'product_price': (5 + number % 20) * 100,
+            'product_description': 'Seeded product',
+            'one_size_stock': 50,
+            'small_stock': 50,
+            'medium_stock': 50,
+            'large_stock': 50,
+        } for number in range(products)]).execute()
+        for user in models.User.select():
+            address = models.AddressDetails.create(
+                user_id=user.id, address_line_1='1 Street', address_line_2='',
+                town='Town', city='City', postcode='AB1 2CD', default=True)
+            for number in range(orders_per_customer):
+                status = ['placed', 'dispatched', 'complete', 'cancelled', 'open'][number % 5]
+                order = models.Order.create(
+                    user=user.id, address=address.id, order_status=status,
+                    order_placed_on=now - datetime.timedelta(days=number),
+                    order_cancelled_on=now if status == 'cancelled' else None)
+                models.OrderLine.create(product=1 + (user.id + number) % products, order=order.id,
+                                        quantity=1, size='small')
+        # each product has been bought with the two either side of it
+        models.CoPurchase.insert_many([{
+            'product': 1 + number,
+            'other': 1 + (number + offset) % products,
+            'orders': 3 - abs(offset),
+        } for number in range(products) for offset in (-2, -1, 1, 2)]).execute()
+    models.db.execute_sql('ANALYZE')
+    return models.User.get(models.User.email_address == 'plans@nativesins.com')
+
+
+def model_checks(user):
+    """
+    **Lists the hot model queries to check.**
+
+    Each entry is ``(name, function, sorted_query)``, the function runs the
+    queries that :func:`~check_model_queries` records.
+
+    :param user: the seeded customer
+    :return: list of checks
+    """
+    today = datetime.date.today()
+    month_ago = today - datetime.timedelta(days=30)
+    order = models.Order.select().where(models.Order.user == user.id).get()
+
+    def orders_page(status):
+        return lambda: models.Order.order_history(user.id, [status])
+
+    return [
+        ('find_current_order', lambda: models.Order.find_current_order(user), False),
+        ('get_default_address', lambda: models.AddressDetails.get_default_address(user.id), False),
+        ('get_current_basket', lambda: models.Order.get_current_basket(order, user), False),
+        ('check_order_status', lambda: models.Order.check_order_status(user.id), False),
+        ('orders placed', orders_page('placed'), False),
+        ('orders complete', orders_page('complete'), False),
+        ('orders cancelled', orders_page('cancelled'), False),
+        ('user report', lambda: list(models.User.select().where(
+            models.User.date_created >= month_ago, models.User.date_created <= today)), False),
+        ('order report', lambda: list(models.Order.select().where(
+            models.Order.order_placed_on >= month_ago, models.Order.order_placed_on <= today)), False),
+        ('catalog by name', lambda: list(models.Product.select().order_by(models.Product.product_name)), True),
+        ('catalog by price', lambda: list(models.Product.select().order_by(models.Product.product_price)), True),
+        ('catalog by price desc', lambda: list(
+            models.Product.select().order_by(models.Product.product_price.desc())), True),
+        ('expired reservations', lambda: models.OrderLine.release_expired(), True),
+        ('inventory page', lambda: models.StockLevel.inventory_page(1), True),
+        ('low stock count', lambda: models.StockLevel.low_stock_count(), False),
+        ('price basket', lambda: models.Order.price_basket(order.id), True),
+        ('payment event queue', lambda: models.PaymentEvent.next_batch(100), True),
+        ('pending payments', lambda: models.Order.pending_payments(datetime.datetime.now()), True),
+        ('basket suggestions', lambda: models.CoPurchase.suggestions(order.id, 4), False),
+        ('catalog t-shirts', lambda: list(
+            models.Product.select().where(models.Product.product_category == "tshirt")), False),
+    ]
+
+
+def check_model_queries(user):
+    """
+    **Explains the SQL emitted by each hot model query.**
+
+    :param user: the seeded customer
+    :return: list of failure messages
+    """
+    failures = []
+    for name, run, sorted_query in model_checks(user):
+        with record_queries(models.db) as queries:
+            run()
+        for sql, params in queries:
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            problems = plan_problems(explain(models.db, sql, params), sorted_query)
+            if problems:
+                failures.append('{}: {} in {}'.format(name, '; '.join(problems), sql))
+    return failures
+
+
+def check_route_budgets(user, database_path):
+    """
+    **Counts the queries each page runs for a logged in customer.**
+
+    :param user: the seeded customer
+    :param database_path: path of the seeded database
+    :return: list of failure messages
+    """
+    import app as shop
+
+    app = shop.create_app(DATABASE=database_path, SECRET_KEY='query-plans', WTF_CSRF_ENABLED=False,
+                          CACHE_STAMP_FOLDER=os.path.join(os.path.dirname(database_path), 'cache_stamps'))
+    client = app.test_client()
+    client.post('/login', data={'email_address': user.email_address, 'password': SEED_PASSWORD})
+
+    failures = []
+    for route, budget in ROUTE_BUDGETS.items():
+        path = route.format(user_id=user.id)
+        with record_queries(models.db) as queries:
+            response = client.get(path)
+        if response.status_code != 200:
+            failures.append('{}: returned {}'.format(path, response.status_code))
+        elif len(queries) > budget:
+            failures.append('{}: ran {} queries, budget is {}'.format(path, len(queries), budget))
+    return failures
+
+
+def main():
+    """
+    **Seeds a temporary database, runs every check and prints the results.**
+
+    :return: exit status, 0 if everything passed
+    """
+    database_path = os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+    models.configure_database(database_path)
+    models.initialize()
+    models.db.connect()
+    user = seed()
+    failures = check_model_queries(user)
+    models.db.close()
+    failures += check_route_budgets(user, database_path)
+
+    for failure in failures:
+        print('FAIL ' + failure)
+    print('{} problem(s) found'.format(len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+    rate_limit.py limits how often one client can use the routes that are slow
+    to serve, like logging in, which hashes a password, or the contact form,
+    which sends an email.
+
+    Every IP address and account gets a token bucket for each limited route.
+    A bucket holds up to ``requests`` tokens and is topped up at ``requests``
+    tokens every ``seconds``. Each request takes a token, and with none left it
+    is turned away until the bucket has topped up again::
+
+        retry_after = rate_limit.limiter.hit('login', ['ip:127.0.0.1'], (10, 60))
+        if retry_after:
+            ...
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from cache import LRUCache
+
+
+def take_token(bucket, capacity, rate, now):
+    """
+    **Tops up a bucket for the time since it was last used, then takes a token from it.**
+
+    :param bucket: tuple of (tokens, last used), None for a new bucket which starts full
+    :param capacity: most tokens the bucket holds
+    :param rate: tokens added a second
+    :param now: time in seconds
+    :return: tuple of the bucket after the request and the seconds until a token
+             is free, 0 if one was taken
+    """
+    tokens, updated = bucket if bucket is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBackend(object):
+    """
+    **Buckets kept in memory, shared by the threads of one process.**
+
+    Each worker of a preforking server has its own buckets, so a client can
+    make the number of requests allowed to every worker.
+    """
+
+    def __init__(self, maxsize=10000):
+        # the least active clients are forgotten first, which gives them a full bucket
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            bucket, retry_after = take_token(self._buckets.get(key), capacity, rate, now)
+            self._buckets.set(key, bucket)
+        return retry_after
+
+
+class SQLiteBackend(object):
+    """
+    **Buckets kept in an SQLite file, shared by every process using it.**
+
+    The file is kept apart from the shop's database, so counting requests never
+    waits for a checkout to finish writing.
+    """
+
+    # how many requests a connection handles between clearing out full buckets
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # each thread has its own connection, and a forked worker opens new ones
+        # rather than using its parent's
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = wal")
+            connection.execute("CREATE TABLE IF NOT EXISTS bucket ("
+                               "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                               "full_on REAL NOT NULL) WITHOUT ROWID")
+            connection.execute("CREATE INDEX IF NOT EXISTS bucket_full_on ON bucket (full_on)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.requests = 0
+        return self._local.connection
+
+    def take(self, key, capacity, rate, now):
+        connection = self._connection()
+        # the write lock is taken before reading, so two workers can't take the same token
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            (tokens, updated), retry_after = take_token(row, capacity, rate, now)
+            connection.execute("REPLACE INTO bucket (key, tokens, updated, full_on) VALUES (?, ?, ?, ?)",
+                               (key, tokens, updated, now + (capacity - tokens) / rate))
+            self._local.requests += 1
+            if self._local.requests % self.PRUNE_EVERY == 0:
+                # a bucket that has topped up is the same as one that was never used
+                connection.execute("DELETE FROM bucket WHERE full_on <= ?", (now,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+class RateLimiter(object):
+    """
+    **Counts requests against limits, storing the buckets in a backend.**
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    def hit(self, name, keys, limit, now=None):
+        """
+        **Takes a token from the bucket of each key.**
+
+        :param name: what is limited, e.g. the endpoint
+        :param keys: who the request is from, e.g. "ip:127.0.0.1" and "account:a@b.com"
+        :param limit: tuple of (requests, seconds)
+        :param now: time in seconds, defaults to the current time
+        :return: seconds until the request would be allowed, 0 if it is allowed
+        """
+        requests, seconds = limit
+        now = time.time() if now is None else now
+        return max([self.backend.take(name + ':' + key, requests, requests / seconds, now)
+                    for key in keys] or [0])
+
+
+def configure(config):
+    """
+    **Picks the backend from the app config.**
+
+    :param config: the Flask config
+    """
+    if config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        limiter.backend = SQLiteBackend(config['RATE_LIMIT_DATABASE'])
+    else:
+        limiter.backend = MemoryBackend()
+
+
+# limiter used by the app
+limiter = RateLimiter()
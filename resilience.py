@@ -0,0 +1,214 @@
+"""
+    resilience.py guards the calls the shop makes to outside services, Stripe
+    and the SMTP server, so a slow or broken service can't tie up every worker.
+
+    Each service has a :class:`CircuitBreaker`. A call gets a time limit, and
+    after a number of failures in a row the breaker opens and calls fail
+    straight away for a while. Then one call is let through to see if the
+    service is back::
+
+        try:
+            charge = resilience.call('stripe', stripe.Charge.create, amount=100, ...)
+        except resilience.ServiceUnavailable:
+            ...
+
+    Timings and counts go to :data:`metrics.registry` under
+    ``breaker.<service>``.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import concurrent.futures
+import threading
+import time
+
+import metrics
+
+
+class ServiceUnavailable(Exception):
+    """
+    **The service is failing or too slow, so the call was given up on.**
+    """
+
+
+class CircuitOpenError(ServiceUnavailable):
+    """
+    **The breaker is open, so the service wasn't called.**
+    """
+
+
+class ServiceTimeout(ServiceUnavailable):
+    """
+    **The service didn't answer in time.**
+    """
+
+
+class CircuitBreaker(object):
+    """
+    **Stops calling a service that keeps failing.**
+
+    The breaker starts closed and lets every call through. After
+    ``failure_threshold`` failures in a row it opens and turns calls away for
+    ``reset_timeout`` seconds. Then it is half open, the next call is let
+    through as a probe while the others are still turned away, and the
+    breaker closes if the probe works or opens again if it doesn't.
+
+    Calls run on a few threads of the breakers own, so a call can be given up
+    on after ``timeout`` seconds even if the library it uses waits forever.
+    The thread carries on until the call returns, there is no way to stop it,
+    but while the breaker is open no more are started.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, timeout=10.0, threads=4):
+        """
+        :param name: name of the service, used in the metrics
+        :param failure_threshold: failures in a row that open the breaker
+        :param reset_timeout: seconds the breaker stays open before a probe
+        :param timeout: seconds a call can take, None waits as long as the call does
+        :param threads: most calls to the service at once
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        # errors that mean the service answered, like a declined card,
+        # and so don't count as failures
+        self.ignored = ()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix=name)
+
+    def _allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def _record(self, failed):
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    metrics.registry.increment('breaker.{}.opened'.format(self.name))
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def call(self, function, *args, **kwargs):
+        """
+        **Calls a function that uses the service, unless the breaker is open.**
+
+        :param function: function to call
+        :param args: positional arguments for the function
+        :param kwargs: keyword arguments for the function
+        :return: what the function returns
+        :raises CircuitOpenError: if the breaker is open
+        :raises ServiceTimeout: if the call took longer than ``timeout``
+        """
+        if not self._allow():
+            metrics.registry.increment('breaker.{}.rejected'.format(self.name))
+            raise CircuitOpenError("{} is unavailable".format(self.name))
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+            try:
+                result = future.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                raise ServiceTimeout("{} took longer than {}s".format(self.name, self.timeout))
+        except self.ignored:
+            self._record(failed=False)
+            raise
+        except Exception:
+            metrics.registry.increment('breaker.{}.failures'.format(self.name))
+            self._record(failed=True)
+            raise
+        else:
+            self._record(failed=False)
+            return result
+        finally:
+            metrics.registry.observe('breaker.{}.seconds'.format(self.name), time.perf_counter() - start)
+
+    def status(self):
+        """
+        **Returns the state of the breaker as plain data, ready to be sent as JSON.**
+
+        :return: dictionary of the state, failures in a row and seconds until a probe
+        """
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(self.opened_at + self.reset_timeout - time.time(), 0), 1)
+            return {'state': self.state, 'failures': self.failures, 'retry_in': retry_in}
+
+
+# breaker for each service, set up by configure
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    **Creates a breaker for each service in the app config.**
+
+    :param config: the Flask config
+    """
+    breakers.clear()
+    for name, settings in config['SERVICES'].items():
+        breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=settings['failures'],
+            reset_timeout=settings['reset_seconds'],
+            timeout=settings['timeout']
+        )
+
+
+def breaker(service):
+    """
+    **Returns the breaker of a service.**
+
+    A service :func:`configure` hasn't been called for, e.g. in a script that
+    doesn't create the app, gets a breaker with the default settings.
+
+    :param service: name of the service, e.g. "stripe"
+    :return: the :class:`CircuitBreaker`
+    """
+    with _breakers_lock:
+        if service not in breakers:
+            breakers[service] = CircuitBreaker(service)
+        return breakers[service]
+
+
+def call(service, function, *args, **kwargs):
+    """
+    **Calls a function through the breaker of a service.**
+
+    :param service: name of the service, e.g. "stripe"
+    :param function: function to call
+    :return: what the function returns
+    """
+    return breaker(service).call(function, *args, **kwargs)
+
+
+def status():
+    """
+    **Returns the state of every breaker.**
+
+    :return: dictionary of service name to :meth:`CircuitBreaker.status`
+    """
+    return {name: breaker.status() for name, breaker in breakers.items()}
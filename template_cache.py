@@ -0,0 +1,74 @@
+"""
+    template_cache.py adds a ``{% cache %}`` tag to the templates, so parts of a
+    page that are the same on every request are only rendered once.
+
+    Usage::
+
+        {% cache 'product_card', product.id, version %}
+            ...
+        {% endcache %}
+
+    The values after the tag make up the key. Anything the fragment depends on,
+    such as the catalog version, has to be part of the key, old fragments are
+    never removed and just drop out of the cache as new ones are added.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import os
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from cache import LRUCache
+
+
+class FragmentCacheExtension(Extension):
+    """
+    **Jinja extension providing the ``{% cache %}`` tag.**
+
+    The fragments are kept in ``environment.fragment_cache``, an
+    :class:`~cache.LRUCache` shared by every template.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache(1000))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_fragment', [nodes.List(key)]), [], [], body)\
+            .set_lineno(lineno)
+
+    def _render_fragment(self, key, caller):
+        key = tuple(key)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            self.environment.fragment_cache.set(key, fragment)
+        return fragment
+
+
+def configure(environment, fragment_cache_size, bytecode_cache_folder):
+    """
+    **Sets up the fragment and bytecode caches for a Jinja environment.**
+
+    The bytecode cache keeps compiled templates on disk, so a new worker loads
+    them without compiling them again.
+
+    :param environment: the apps Jinja environment
+    :param fragment_cache_size: number of fragments to keep in memory
+    :param bytecode_cache_folder: folder for compiled templates, None turns it off
+    """
+    environment.fragment_cache = LRUCache(fragment_cache_size)
+    if bytecode_cache_folder:
+        os.makedirs(bytecode_cache_folder, exist_ok=True)
+        environment.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_folder)
+    else:
+        environment.bytecode_cache = None
@@ -0,0 +1,22 @@
+"""
+    wsgi.py is the entry point for running the shop in production behind a
+    preforking WSGI server, for example::
+
+        gunicorn --preload --workers 4 wsgi:application
+
+    ``--preload`` makes the server import this file once before forking, so the
+    catalog, templates and shipping options loaded by :func:`~app.prewarm` are
+    shared by every worker.
+
+    The settings class can be changed with the ``NATIVESINS_CONFIG`` environment
+    variable.
+
+    :author: Andrew Bruce
+    :year: 2018
+"""
+
+import os
+
+from app import create_app
+
+application = create_app(os.environ.get('NATIVESINS_CONFIG', 'config.ProductionConfig'))